@@ -0,0 +1,228 @@
+"""
+Copy every document matching a query from one Elasticsearch index (or query pass-through) to another,
+reading the source in parallel slices and writing to the target through _bulk requests, with a checkpoint
+file so that an interrupted copy can be resumed.
+
+    stats = bulkcopy.copy("http://doaj.org/query/journal,article/_search", "http://localhost:9200/doaj/article",
+                          slices=8, checkpoint="doajclone.json")
+"""
+import json, os, sys, threading, time, requests
+from urlparse import urlparse
+from doaj2oag import harvest, oag
+
+def copy(source_url, target_url, **kwargs):
+    """
+    Run a BulkCopy (see there for the options), returning its stats
+    """
+    return BulkCopy(source_url, target_url, **kwargs).run()
+
+def hex_partitions(slices):
+    """
+    Split points dividing a space of hex identifiers (such as DOAJ's ids) into the given number of ranges
+    """
+    width = 1 if slices <= 16 else 2
+    space = 16 ** width
+    return ["%0*x" % (width, i * space // slices) for i in range(1, slices)]
+
+class BulkCopy(object):
+    """
+    source_url - the _search endpoint to read from
+    target_url - the index (e.g. http://localhost:9200/doaj) or index and type (http://localhost:9200/doaj/article)
+        to write to.  Given only an index, each document keeps its source type
+    slices - the number of parts to read and write at once
+    mode - how the source is divided and paged:
+        range - each slice is a range of sort_field (split at the given partitions, or by default evenly
+            over hex ids), keyset paged.  This works on any ES version and through query pass-throughs
+        search_after - the same slices, paged with ES 5+ search_after
+        scroll - an ES 5+ sliced scroll.  An interrupted slice has to start again, as scrolls expire
+    bulk_bytes - the size of each _bulk request
+    checkpoint - a file in which to record each slice's progress once it has been written to the target.  If
+        it exists, the copy carries on from where it says.  It is removed once the copy is complete, so the
+        next copy starts from the beginning
+    report_every - seconds between progress reports
+    high_water - a harvest.HighWaterMark, to copy only the documents changed since the last copy.  Once the
+        copy is complete the mark is moved on
+    """
+    def __init__(self, source_url, target_url, query=None, slices=4, mode="range", sort_field="id", partitions=None,
+                 page_size=1000, bulk_bytes=5 * 1024 * 1024, checkpoint=None, report_every=10, retry_policy=None, verbose=True, high_water=None):
+        if mode not in harvest.MODES:
+            raise ValueError("mode must be one of " + ", ".join(harvest.MODES))
+        self.source_url = source_url
+        self.target_url = target_url.rstrip("/")
+        self.high_water = high_water
+        self.since = high_water.since if high_water is not None else None
+        self.query = query if query is not None else {"query" : {"match_all" : {}}}
+        if high_water is not None:
+            self.query = high_water.query(self.query)
+        self.slices = slices
+        self.mode = mode
+        self.sort_field = sort_field
+        self.partitions = partitions
+        self.page_size = page_size
+        self.bulk_bytes = bulk_bytes
+        self.checkpoint = checkpoint
+        self.report_every = report_every
+        self.retry_policy = retry_policy if retry_policy is not None else oag.RetryPolicy()
+        self.verbose = verbose
+
+        self.keep_types = len([p for p in urlparse(self.target_url).path.split("/") if p != ""]) < 2
+        self._lock = threading.Lock()
+        self._progress = self._load_checkpoint()
+        self._docs = 0
+        self._failed = 0
+        self._errors = []
+        self._started = None
+        self._reported = None
+
+    def run(self):
+        self._started = self._reported = time.time()
+        workers = []
+        for i, query in enumerate(self._slice_queries()):
+            key = "slice-" + str(i)
+            if self._progress.get(key, {}).get("done"):
+                continue
+            w = threading.Thread(target=self._copy_slice, args=(i, key, query))
+            w.daemon = True
+            w.start()
+            workers.append(w)
+        for w in workers:
+            w.join()
+
+        stats = self.stats()
+        if self.verbose:
+            print "Copied", stats["docs"], "documents in", "%.0f" % stats["seconds"], "seconds (" + "%.1f" % stats["rate"], "docs/sec);", stats["failed"], "failed"
+        if len(self._errors) > 0:
+            raise self._errors[0][0], self._errors[0][1], self._errors[0][2]
+        if self.high_water is not None:
+            self.high_water.commit()
+        if self.checkpoint is not None and os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+        return stats
+
+    def stats(self):
+        seconds = time.time() - self._started if self._started is not None else 0
+        return {
+            "docs" : self._docs,
+            "failed" : self._failed,
+            "seconds" : seconds,
+            "rate" : self._docs / seconds if seconds > 0 else 0
+        }
+
+    def _slice_queries(self):
+        base = self.query.get("query", {"match_all" : {}})
+        if self.mode == "scroll":
+            return [dict(self.query) for i in range(self.slices)]
+        points = self.partitions if self.partitions is not None else hex_partitions(self.slices)
+        bounds = [None] + list(points) + [None]
+        queries = []
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            r = {}
+            if lo is not None:
+                r["gte"] = lo
+            if hi is not None:
+                r["lt"] = hi
+            q = dict(self.query)
+            if len(r) > 0:
+                q["query"] = {"filtered" : {"query" : base, "filter" : {"range" : {self.sort_field : r}}}}
+            queries.append(q)
+        return queries
+
+    def _copy_slice(self, i, key, query):
+        try:
+            session = requests.Session()
+            progress = self._progress.get(key, {})
+            kwargs = {"page_size" : self.page_size, "mode" : self.mode, "sort_field" : self.sort_field, "session" : session}
+            if self.mode == "scroll":
+                kwargs["slice"] = (i, self.slices)
+            else:
+                kwargs["after"] = progress.get("after")
+
+            lines = []
+            size = 0
+            last = progress.get("after")
+            for hit in harvest.hits(self.source_url, query, **kwargs):
+                if self.high_water is not None:
+                    self.high_water.track(hit.get("_source", {}))
+                meta = {"_id" : hit.get("_id")}
+                if self.keep_types:
+                    meta["_type"] = hit.get("_type")
+                pair = json.dumps({"index" : meta}) + "\n" + json.dumps(hit.get("_source")) + "\n"
+                lines.append(pair)
+                size += len(pair)
+                last = hit.get("sort", [last])[0]
+                if size >= self.bulk_bytes:
+                    self._write(session, key, lines, last)
+                    lines = []
+                    size = 0
+            self._write(session, key, lines, last, done=True)
+        except Exception:
+            with self._lock:
+                self._errors.append(sys.exc_info())
+
+    def _write(self, session, key, lines, last, done=False):
+        failed = self._bulk(session, "".join(lines)) if len(lines) > 0 else 0
+        with self._lock:
+            self._docs += len(lines)
+            self._failed += failed
+            progress = self._progress.setdefault(key, {"docs" : 0})
+            progress["docs"] = progress.get("docs", 0) + len(lines)
+            progress["after"] = last
+            progress["done"] = done
+            self._save_checkpoint()
+            self._report()
+
+    def _bulk(self, session, data):
+        """
+        Send one _bulk request, retrying it as the OAG client would, and return the number of documents the
+        target rejected
+        """
+        policy = self.retry_policy
+        attempt = 0
+        while True:
+            resp = None
+            try:
+                resp = session.post(self.target_url + "/_bulk", data=data)
+            except requests.exceptions.RequestException as e:
+                if not policy.retryable(exc=e) or attempt >= policy.max_retries:
+                    raise
+            else:
+                if resp.status_code < 300:
+                    break
+                if not policy.retryable(resp=resp) or attempt >= policy.max_retries:
+                    resp.raise_for_status()
+            policy.sleep(policy.delay(attempt, resp))
+            attempt += 1
+
+        failed = 0
+        for item in resp.json().get("items", []):
+            for action, result in item.iteritems():
+                if result.get("error") is not None or result.get("status", 200) >= 300:
+                    failed += 1
+        return failed
+
+    def _report(self):
+        now = time.time()
+        if not self.verbose or now - self._reported < self.report_every:
+            return
+        self._reported = now
+        stats = self.stats()
+        print "Copied", stats["docs"], "documents;", "%.1f" % stats["rate"], "docs/sec"
+
+    def _load_checkpoint(self):
+        if self.checkpoint is None or not os.path.exists(self.checkpoint):
+            return {}
+        with open(self.checkpoint) as f:
+            saved = json.load(f)
+        # a checkpoint from a copy divided differently cannot be picked up
+        if saved.get("slices") != self.slices or saved.get("mode") != self.mode or saved.get("since") != self.since:
+            raise ValueError("checkpoint " + self.checkpoint + " is for a copy with different slices, mode or high water mark")
+        return saved.get("progress", {})
+
+    def _save_checkpoint(self):
+        if self.checkpoint is None:
+            return
+        # write and rename, so that a crash mid-write does not lose the checkpoint
+        tmp = self.checkpoint + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"slices" : self.slices, "mode" : self.mode, "since" : self.since, "progress" : self._progress}, f)
+        os.rename(tmp, self.checkpoint)
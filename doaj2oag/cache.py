@@ -0,0 +1,82 @@
+"""
+An on-disk cache of OAG results, so that identifiers we have had a result for recently are answered locally
+rather than sent to the lookup service again.
+"""
+import sqlite3, json, time, threading
+
+class ResultCache(object):
+    """
+    OAG results in a SQLite database, keyed on the case-folded identifier.  Successes are kept for ttl
+    seconds and errors (negative results) for error_ttl seconds.  When there are more than max_entries, the
+    oldest are evicted.
+
+    The database may be shared by several processes on the same host
+    """
+    def __init__(self, path, ttl=30 * 24 * 60 * 60, error_ttl=24 * 60 * 60, max_entries=1000000, evict_every=100):
+        self.path = path
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self.max_entries = max_entries
+        self.evict_every = evict_every
+        self._puts = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, error INTEGER, result TEXT, stored REAL, expires REAL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS results_expires ON results (expires)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS results_stored ON results (stored)")
+        self._conn.commit()
+
+    @classmethod
+    def key(cls, identifier):
+        return identifier.strip().lower()
+
+    def get(self, identifiers):
+        """
+        Return a dict of identifier to (is_error, result) for each of the identifiers with an unexpired entry
+        """
+        keys = dict([(self.key(i), i) for i in identifiers])
+        found = {}
+        now = time.time()
+        with self._lock:
+            # stay well inside SQLite's limit on the number of parameters
+            ks = keys.keys()
+            for i in range(0, len(ks), 500):
+                chunk = ks[i:i + 500]
+                sql = "SELECT key, error, result FROM results WHERE expires > ? AND key IN (" + ",".join(["?"] * len(chunk)) + ")"
+                for k, error, result in self._conn.execute(sql, [now] + chunk):
+                    found[keys[k]] = (bool(error), json.loads(result))
+        return found
+
+    def put(self, result):
+        """
+        Cache the successes and errors in a response from the lookup service
+        """
+        now = time.time()
+        rows = []
+        for s in result.get("results", []):
+            rows.append((self.key(s.get("identifier")[0].get("id")), 0, json.dumps(s), now, now + self.ttl))
+        for e in result.get("errors", []):
+            rows.append((self.key(e.get("identifier").get("id")), 1, json.dumps(e), now, now + self.error_ttl))
+        if len(rows) == 0:
+            return
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO results (key, error, result, stored, expires) VALUES (?, ?, ?, ?, ?)", rows)
+            self._conn.commit()
+            self._puts += 1
+            evict = self._puts % self.evict_every == 0
+
+        # counting the entries is a scan of the table, so only check the size bound every so often
+        if evict:
+            self.evict()
+
+    def evict(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM results WHERE expires <= ?", [time.time()])
+            count = self._conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute("DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY stored LIMIT ?)", [count - self.max_entries])
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -1,6 +1,18 @@
-import esprit
+from portality.core import config
+from doaj2oag import bulkcopy, harvest
+import argparse
 
-local = esprit.raw.Connection("http://localhost:9200", "doaj")
-ooz = esprit.raw.Connection("http://ooz.cottagelabs.com:9200", "monitor")
+source = "http://localhost:9200/doaj/article/_search"
+target = "http://ooz.cottagelabs.com:9200/monitor/article"
 
-esprit.tasks.copy(local, "article", ooz, "article")
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--slices", type=int, default=config.get("CLONE_SLICES", 8), help="number of parts of the index to copy at once")
+    parser.add_argument("-c", "--checkpoint", default="clone2server.json", help="file to record progress in, and resume from")
+    parser.add_argument("-i", "--incremental", action="store_true", help="only copy the articles changed since the last incremental copy")
+    args = parser.parse_args()
+
+    high_water = harvest.HighWaterMark(config.get("HIGH_WATER_FILE"), source) if args.incremental else None
+
+    bulkcopy.copy(source, target, slices=args.slices, mode="range", checkpoint=args.checkpoint, high_water=high_water,
+                  bulk_bytes=config.get("CLONE_BULK_BYTES", 5 * 1024 * 1024))
@@ -0,0 +1,232 @@
+"""
+A RequestState kept in a SQLite database rather than in memory, for jobs too large to hold every identifier
+(e.g. the whole DOAJ DOI set) in the process.
+
+    state = diskstate.DiskRequestState("job.db", dois.get_dois())
+    oag.Scheduler(client, callback=callback).run(state)
+
+Only the due identifiers of the current cycle and the results not yet flushed are held in memory.
+"""
+import sqlite3, json, uuid, threading
+from datetime import timedelta
+from itertools import islice
+from doaj2oag import oag
+
+PENDING = 0
+SUCCESS = 1
+ERROR = 2
+
+def _seconds(dt):
+    return (dt - oag._EPOCH).total_seconds()
+
+def _datetime(seconds):
+    return oag._EPOCH + timedelta(seconds=seconds)
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+class DiskRequestState(object):
+    """
+    The same interface as oag.RequestState as far as the Scheduler, OAGClient and the callbacks are
+    concerned (get_due, next_due, record_result, finished, flush_success/flush_error, add_identifiers), with
+    one row per identifier in the entries table, indexed on (status, maxed, due).
+
+    The job's parameters are stored alongside the entries, so a job can be picked up again after a restart
+    with DiskRequestState.open(path).  get_due returns at most due_limit identifiers per cycle; the rest are
+    still due, so the Scheduler comes straight back for them
+    """
+    def __init__(self, path, identifiers=None, timeout=None, back_off_factor=1, max_back_off=120, max_retries=None, batch_size=1000, start=None, clock=None, index=None, due_limit=100000, chunk_size=10000):
+        self.path = path
+        self.clock = clock if clock is not None else oag.SYSTEM_CLOCK
+        self.due_limit = due_limit
+        self.chunk_size = chunk_size
+        self.index = index
+
+        self.success_buffer = []
+        self.error_buffer = []
+
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS entries (id TEXT PRIMARY KEY, status INTEGER, maxed INTEGER, init REAL, due REAL, found REAL, requested INTEGER)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_due ON entries (status, maxed, due)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._conn.commit()
+
+        params = self._load_params()
+        if params is None:
+            self.id = uuid.uuid4().hex
+            self.start = self.clock.now() if start is None else start
+            self.timeout = self.start + timedelta(seconds=timeout) if timeout is not None else None
+            self.back_off_factor = back_off_factor
+            self.max_back_off = max_back_off
+            self.max_retries = max_retries
+            self._batch_size = batch_size
+            self._save_params()
+        else:
+            self.id = params.get("id")
+            self.start = _datetime(params.get("start"))
+            self.timeout = _datetime(params.get("timeout")) if params.get("timeout") is not None else None
+            self.back_off_factor = params.get("back_off_factor")
+            self.max_back_off = params.get("max_back_off")
+            self.max_retries = params.get("max_retries")
+            self._batch_size = params.get("batch_size")
+
+        self._counts = dict([(s, 0) for s in [PENDING, SUCCESS, ERROR]])
+        for status, count in self._conn.execute("SELECT status, COUNT(*) FROM entries GROUP BY status"):
+            self._counts[status] = count
+
+        if identifiers is not None:
+            self.add_identifiers(identifiers, self.start)
+
+    @classmethod
+    def open(cls, path, clock=None, **kwargs):
+        """
+        Pick up the job already stored at path
+        """
+        return cls(path, clock=clock, **kwargs)
+
+    # the batch size is tuned as the job runs (see oag.AdaptiveBatchSize), so it is saved when it changes
+    def _get_batch_size(self):
+        return self._batch_size
+
+    def _set_batch_size(self, size):
+        if size != self._batch_size:
+            self._batch_size = size
+            self._save_params()
+
+    batch_size = property(_get_batch_size, _set_batch_size)
+
+    def add_identifiers(self, identifiers, due=None):
+        """
+        Add the identifiers, which may be any iterable (e.g. a generator over a harvest), to the pending
+        list in chunks, so that they are never all in memory.  Identifiers which we already know about are
+        ignored
+        """
+        due = _seconds(self.clock.now() if due is None else due)
+        for chunk in _chunks(identifiers, self.chunk_size):
+            if self.index is not None:
+                chunk = self.index.filter(chunk)
+            with self._lock:
+                cursor = self._conn.executemany("INSERT OR IGNORE INTO entries (id, status, maxed, init, due, requested) VALUES (?, ?, 0, ?, ?, 0)",
+                                                [(ident, PENDING, due, due) for ident in chunk])
+                self._counts[PENDING] += cursor.rowcount
+                self._conn.commit()
+
+    def remove_identifiers(self, identifiers):
+        for chunk in _chunks(identifiers, self.chunk_size):
+            with self._lock:
+                cursor = self._conn.executemany("DELETE FROM entries WHERE id = ? AND status = ?", [(ident, PENDING) for ident in chunk])
+                self._counts[PENDING] -= cursor.rowcount
+                self._conn.commit()
+
+    def print_parameters(self):
+        params = "Timeout: " + str(self.timeout) + "\n"
+        params += "Back Off Factor: " + str(self.back_off_factor) + "\n"
+        params += "Max Back Off: " + str(self.max_back_off) + "\n"
+        params += "Max Tries per Identifier: " + str(self.max_retries) + "\n"
+        params += "Batch Size: " + str(self.batch_size)
+        return params
+
+    def print_status_report(self):
+        return str(self._counts[SUCCESS]) + " received; " + str(self._counts[ERROR]) + " errors; " + str(self._counts[PENDING]) + " pending"
+
+    def finished(self):
+        if self._counts[PENDING] == 0:
+            return True
+        if self.timeout is not None:
+            if self.clock.now() > self.timeout:
+                return True
+        with self._lock:
+            row = self._conn.execute("SELECT 1 FROM entries WHERE status = ? AND maxed = 0 LIMIT 1", [PENDING]).fetchone()
+        return row is None
+
+    def get_due(self):
+        now = _seconds(self.clock.now())
+        with self._lock:
+            rows = self._conn.execute("SELECT id FROM entries WHERE status = ? AND maxed = 0 AND due < ? ORDER BY due LIMIT ?", [PENDING, now, self.due_limit])
+            return [row[0] for row in rows]
+
+    def next_due(self):
+        with self._lock:
+            row = self._conn.execute("SELECT MIN(due) FROM entries WHERE status = ? AND maxed = 0", [PENDING]).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return _datetime(row[0])
+
+    def record_result(self, result, buffer=True):
+        now = _seconds(self.clock.now())
+
+        successes = result.get("results", [])
+        errors = result.get("errors", [])
+        processing = result.get("processing", [])
+
+        with self._lock:
+            self._found([s.get("identifier")[0].get("id") for s in successes], SUCCESS, now)
+            self._found([e.get("identifier").get("id") for e in errors], ERROR, now)
+            self._processing([p.get("identifier").get("id") for p in processing])
+            self._conn.commit()
+
+        if buffer:
+            self.success_buffer.extend(successes)
+            self.error_buffer.extend(errors)
+
+    def flush_success(self):
+        buffer = self.success_buffer
+        self.success_buffer = []
+        return buffer
+
+    def flush_error(self):
+        buffer = self.error_buffer
+        self.error_buffer = []
+        return buffer
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _found(self, ids, status, now):
+        if len(ids) == 0:
+            return
+        cursor = self._conn.executemany("UPDATE entries SET status = ?, found = ?, due = NULL, requested = requested + 1 WHERE id = ? AND status = ?",
+                                        [(status, now, ident, PENDING) for ident in ids])
+        self._counts[PENDING] -= cursor.rowcount
+        self._counts[status] += cursor.rowcount
+
+    def _processing(self, ids):
+        for chunk in _chunks(ids, 500):
+            sql = "SELECT id, requested FROM entries WHERE status = ? AND maxed = 0 AND id IN (" + ",".join(["?"] * len(chunk)) + ")"
+            updates = []
+            for ident, requested in self._conn.execute(sql, [PENDING] + chunk).fetchall():
+                requested += 1
+                maxed = 1 if self.max_retries is not None and requested >= self.max_retries else 0
+                updates.append((requested, maxed, _seconds(self._backoff(requested)), ident))
+            self._conn.executemany("UPDATE entries SET requested = ?, maxed = ?, due = ? WHERE id = ?", updates)
+
+    def _backoff(self, times):
+        now = self.clock.now()
+        seconds = 2**times * self.back_off_factor
+        seconds = seconds if seconds < self.max_back_off else self.max_back_off
+        return now + timedelta(seconds=seconds)
+
+    def _load_params(self):
+        row = self._conn.execute("SELECT value FROM meta WHERE key = 'params'").fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def _save_params(self):
+        params = {
+            "id" : self.id,
+            "start" : _seconds(self.start),
+            "timeout" : _seconds(self.timeout) if self.timeout is not None else None,
+            "back_off_factor" : self.back_off_factor,
+            "max_back_off" : self.max_back_off,
+            "max_retries" : self.max_retries,
+            "batch_size" : self._batch_size
+        }
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('params', ?)", [json.dumps(params)])
+            self._conn.commit()
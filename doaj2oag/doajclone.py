@@ -1,8 +1,9 @@
-import esprit
-from portality.core import app
+from portality.core import config
+from doaj2oag import bulkcopy, harvest
+import argparse
 
-doaj = esprit.raw.Connection("http://doaj.org", "query", port=80)
-local = esprit.raw.Connection("http://localhost:9200", "doaj")
+source = "http://doaj.org/query/journal,article/_search"
+target = "http://localhost:9200/doaj/article"
 
 query = {
     "query" : {
@@ -12,4 +13,15 @@ query = {
     }
 }
 
-esprit.tasks.copy(doaj, "journal,article", local, "article", limit=100000, method="GET", q=query)
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--slices", type=int, default=config.get("CLONE_SLICES", 8), help="number of parts of the index to copy at once")
+    parser.add_argument("-c", "--checkpoint", default="doajclone.json", help="file to record progress in, and resume from")
+    parser.add_argument("-i", "--incremental", action="store_true", help="only copy the articles changed since the last incremental copy")
+    args = parser.parse_args()
+
+    high_water = harvest.HighWaterMark(config.get("HIGH_WATER_FILE"), source) if args.incremental else None
+
+    # the public query endpoint does not allow scrolling, so it is read in id ranges
+    bulkcopy.copy(source, target, query=query, slices=args.slices, mode="range", checkpoint=args.checkpoint, high_water=high_water,
+                  bulk_bytes=config.get("CLONE_BULK_BYTES", 5 * 1024 * 1024))
@@ -0,0 +1,114 @@
+"""
+DOI normalisation, and an index of the DOIs we already have OAG results for, so that they are not looked
+up again by every job and every re-harvest.
+"""
+import re
+from datetime import timedelta
+from doaj2oag import oag
+
+# what OAG will accept as a DOI: a 10. prefix, a registrant code, and a printable ASCII suffix
+_doi_re = re.compile(r"^10\.\d{4,9}/[\x21-\x7e]+$")
+_prefix_re = re.compile(r"^(doi:\s*|https?://(dx\.)?doi\.org/)", re.IGNORECASE)
+
+def normalise(doi):
+    """
+    Strip whitespace and any doi: or doi.org URL prefix from the DOI, returning None if what is left is not
+    something OAG can look up.  The case is kept, as DOAJ's exact identifier match is case sensitive
+    """
+    if doi is None:
+        return None
+    doi = _prefix_re.sub("", doi.strip())
+    if _doi_re.match(doi) is None:
+        return None
+    return str(doi)
+
+def key(doi):
+    """
+    The form of a (normalised) DOI to compare on: DOIs are case insensitive
+    """
+    return doi.lower()
+
+def unique(dois):
+    """
+    Yield the normalised form of each distinct DOI, in the order they are first seen, dropping any which
+    cannot be normalised
+    """
+    seen = set()
+    for doi in dois:
+        doi = normalise(doi)
+        if doi is None:
+            continue
+        k = key(doi)
+        if k in seen:
+            continue
+        seen.add(k)
+        yield doi
+
+class DOIIndex(object):
+    """
+    Records when we last got a result for each DOI, and whether it was a success or an error.  Results are
+    trusted for staleness seconds (errors for error_staleness seconds), or forever if that is None.
+
+    This keeps the index in memory; subclasses persist it by overriding lookup and store (see
+    oagr.ESDOIIndex)
+    """
+    def __init__(self, staleness=None, error_staleness=None, clock=None):
+        self.staleness = staleness
+        self.error_staleness = error_staleness if error_staleness is not None else staleness
+        self.clock = clock
+        self._entries = {}
+
+    def lookup(self, keys):
+        """
+        Return a dict of key to (found, status) for each of the keys which has an entry
+        """
+        return dict([(k, self._entries[k]) for k in keys if k in self._entries])
+
+    def store(self, entries):
+        """
+        Save the dict of key to (found, status)
+        """
+        self._entries.update(entries)
+
+    def fresh(self, dois):
+        """
+        The set of keys of the DOIs which have a result recent enough to be trusted
+        """
+        now = self._now()
+        fresh = set()
+        for k, (found, status) in self.lookup([key(d) for d in dois]).iteritems():
+            staleness = self.staleness if status == "success" else self.error_staleness
+            if staleness is None or found > now - timedelta(seconds=staleness):
+                fresh.add(k)
+        return fresh
+
+    def filter(self, dois):
+        """
+        The distinct, normalised DOIs which do not have a fresh result
+        """
+        dois = list(unique(dois))
+        fresh = self.fresh(dois)
+        return [d for d in dois if key(d) not in fresh]
+
+    def prune(self, state):
+        """
+        Remove any pending identifiers which have a fresh result from the state
+        """
+        fresh = self.fresh(state.pending.keys())
+        state.remove_identifiers([p for p in state.pending.keys() if key(p) in fresh])
+
+    def record(self, changes):
+        """
+        Record the results in the output of RequestState.changes()
+        """
+        entries = {}
+        times = {}
+        for status in ["success", "error"]:
+            for obj in changes.get(status, []):
+                found = oag.RequestState.parse_time(obj.get("found"), times)
+                entries[key(obj.get("id"))] = (found, status)
+        if len(entries) > 0:
+            self.store(entries)
+
+    def _now(self):
+        return (self.clock if self.clock is not None else oag.SYSTEM_CLOCK).now()
@@ -1,9 +1,7 @@
-import requests, json, csv, esprit, sys
-from portality.core import app
-from doaj2oag import oag, oagr
+from portality.core import config
+from doaj2oag import oag, oagr, harvest, doiindex
 from datetime import datetime, timedelta
-
-conn = esprit.raw.Connection(app.config.get("ELASTIC_SEARCH_HOST"), app.config.get("ELASTIC_SEARCH_DB"))
+import argparse
 
 """
 query = {
@@ -33,67 +31,51 @@ query = {
     }
 }
 
-def do_query(query):
-    source = json.dumps(query)
-    base_url = app.config.get("QUERY_ENDPOINT")
-    url = base_url + "?source=" + source
-    resp = requests.get(url)
-    return json.loads(resp.text)
-
-def iterate(q, page_size=1000, limit=None):
-    q["size"] = page_size
-    q["from"] = 0
-    if "sort" not in q: # to ensure complete coverage on a changing index, sort by id is our best bet
-        q["sort"] = [{"id" : {"order" : "asc"}}]
-    counter = 0
-    while True:
-        # apply the limit
-        if limit is not None and counter >= limit:
-            break
-
-        res = do_query(q)
-        rs = [r.get("_source") if "_source" in r else r.get("fields") for r in res.get("hits", {}).get("hits", [])]
+def get_dois(q=None, mode="scroll", page_size=1000, limit=None, high_water=None):
+    """
+    Stream the distinct, normalised DOIs of the DOAJ articles matching the query (by default, the module's
+    query) from the QUERY_ENDPOINT, leaving out any which the OAG cannot handle.  With a harvest.HighWaterMark,
+    only the articles changed since it was last committed are read
+    """
+    q = query if q is None else q
+    return doiindex.unique(harvest.dois(config.get("QUERY_ENDPOINT"), q, high_water=high_water, mode=mode, page_size=page_size, limit=limit))
 
-        if len(rs) == 0:
-            break
-        for r in rs:
-            # apply the limit (again)
-            if limit is not None and counter >= limit:
-                break
-            counter += 1
-            yield r
-        q["from"] += page_size
+def make_jobs(dois, job_size=2000, lag=900, start=None):
+    """
+    Create OAG jobs of job_size DOIs each from the iterable of DOIs, starting lag seconds apart (900s = 15 mins).
+    DOIs which already have a fresh result in the DOI index are dropped from each job as it is made
+    """
+    doibatch = []
+    for d in dois:
+        doibatch.append(d)
+        if len(doibatch) >= job_size:
+            start = _make_job(doibatch, start, lag)
+            doibatch = []
 
-print "Initialising ... requesting all DOIs from DOAJ ..."
-iterator = iterate(query)
-doibatch = []
-job_size = 2000
-start = None
-lag = 900 # 900s = 15 mins
-for res in iterator:
-    thisdois = [ident.get("id").strip() for ident in res.get("bibjson", {}).get("identifier", [])
-                if ident.get("type") == "doi" and ident.get("id") is not None]
-    # FIXME: OAG does not currently handle unicode characters
-    cleaned = []
-    for d in thisdois:
-        try:
-            d.decode("ascii")
-            cleaned.append(d)
-        except:
-            pass
-    # FIXME: note that we do not de-duplicate, but there probably are duplicates
-    doibatch += cleaned
-    if len(doibatch) >= job_size:
-        start = datetime.now() if start is None else start + timedelta(seconds=lag)
-        print "Creating job with", len(doibatch), "DOIs, to start at " + start.strftime("%Y-%m-%d %H:%M:%S")
-        state = oag.RequestState(doibatch, timeout=None, back_off_factor=10, max_back_off=1800, max_retries=100, batch_size=100, start=start)
-        oagr.JobRunner.make_job(state)
-        doibatch = []
+    if len(doibatch) > 0:
+        _make_job(doibatch, start, lag)
 
-if len(doibatch) > 0:
-    start = datetime.now() if start is None else start + timedelta(seconds=lag)
+def _make_job(doibatch, previous, lag):
+    start = datetime.now() if previous is None else previous + timedelta(seconds=lag)
     print "Creating job with", len(doibatch), "DOIs, to start at " + start.strftime("%Y-%m-%d %H:%M:%S")
     state = oag.RequestState(doibatch, timeout=None, back_off_factor=10, max_back_off=1800, max_retries=100, batch_size=100, start=start)
-    oagr.JobRunner.make_job(state)
+    if oagr.JobRunner.make_job(state) is None:
+        # nothing was scheduled, so the next job can have this start time
+        return previous
+    return start
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-i", "--incremental", action="store_true", help="only harvest the articles changed since the last incremental run")
+    args = parser.parse_args()
 
+    high_water = None
+    if args.incremental:
+        # DOIs we already have results for are dropped by the DOI index, so only the new ones become jobs
+        high_water = harvest.HighWaterMark(config.get("HIGH_WATER_FILE"), config.get("QUERY_ENDPOINT"))
+        print "Initialising ... requesting DOIs changed since", high_water.since, "from DOAJ ..."
+    else:
+        print "Initialising ... requesting all DOIs from DOAJ ..."
+    make_jobs(get_dois(high_water=high_water))
+    if high_water is not None:
+        high_water.commit()
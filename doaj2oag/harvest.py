@@ -0,0 +1,211 @@
+"""
+Streaming harvest of every document matching a query from an Elasticsearch search endpoint, without
+from/size paging (which gets more expensive the deeper it goes, and stops at the result window limit).
+
+    for record in harvest.iterate(app.config.get("QUERY_ENDPOINT"), query, source=["bibjson.identifier"]):
+        ...
+"""
+import json, os, threading, requests
+from urlparse import urlparse
+
+MODES = ["scroll", "search_after", "range"]
+
+# each page is parsed whole, so the page size is what bounds the memory a harvest holds
+MAX_PAGE_SIZE = 1000
+
+def iterate(search_url, query=None, page_size=1000, source=None, mode="scroll", keepalive="1m", sort_field="id", limit=None, session=None):
+    """
+    Yield the _source (or fields) of each document which matches the query, one at a time, holding no more
+    than one page of results in memory.
+
+    search_url - the _search endpoint to harvest from, e.g. http://localhost:9200/doaj/article/_search
+    query - the ES query object (the "query" part and anything else, such as "filter"); defaults to match_all
+    source - the list of fields to restrict each document's _source to
+    mode - how to page through the results:
+        scroll - an ES scroll context, for direct access to the index
+        search_after - ES 5+ search_after on sort_field
+        range - keyset paging, with a range filter on sort_field above the last value seen.  This works on
+            any ES version and through query pass-throughs which do not support scroll
+    sort_field - a unique, sortable field to page on in the search_after and range modes
+    limit - stop after this many documents
+    page_size - the number of documents to fetch per request, at most MAX_PAGE_SIZE
+    """
+    for hit in hits(search_url, query, page_size=page_size, source=source, mode=mode, keepalive=keepalive, sort_field=sort_field, limit=limit, session=session):
+        yield _unpack(hit)
+
+def hits(search_url, query=None, page_size=1000, source=None, mode="scroll", keepalive="1m", sort_field="id", limit=None, session=None, after=None, slice=None):
+    """
+    As iterate, but yielding the whole of each hit (with its _id, _type and, in the keyset modes, its sort
+    value), for copying documents rather than reading them.
+
+    after - in the keyset modes, start after this value of sort_field (e.g. to resume an earlier harvest)
+    slice - in scroll mode, a tuple of (slice id, number of slices) to harvest one part of an ES 5+ sliced
+        scroll
+    """
+    if mode not in MODES:
+        raise ValueError("mode must be one of " + ", ".join(MODES))
+    if page_size < 1 or page_size > MAX_PAGE_SIZE:
+        raise ValueError("page_size must be between 1 and " + str(MAX_PAGE_SIZE))
+
+    q = dict(query) if query is not None else {"query" : {"match_all" : {}}}
+    q["size"] = page_size
+    q.pop("from", None)
+    if source is not None:
+        q["_source"] = source
+    session = session if session is not None else requests.Session()
+
+    if mode == "scroll":
+        if slice is not None:
+            q["slice"] = {"id" : slice[0], "max" : slice[1]}
+        pages = _scroll(session, search_url, q, keepalive)
+    else:
+        pages = _keyset(session, search_url, q, sort_field, mode == "search_after", after)
+
+    counter = 0
+    for page in pages:
+        for hit in page:
+            if limit is not None and counter >= limit:
+                pages.close()
+                return
+            counter += 1
+            yield hit
+        # let the page go before the next one is fetched, so that only one is ever held
+        page = hit = None
+
+def dois(search_url, query=None, high_water=None, **kwargs):
+    """
+    Yield each DOI in the bibjson identifiers of the documents matching the query, fetching nothing but the
+    identifiers.  Takes the same keyword arguments as iterate.
+
+    high_water - a HighWaterMark, to fetch only the documents changed since its last commit (and to track
+        the latest change seen in this harvest)
+    """
+    source = ["bibjson.identifier"]
+    if high_water is not None:
+        query = high_water.query(query)
+        source.append(high_water.field)
+    for record in iterate(search_url, query, source=source, **kwargs):
+        if high_water is not None:
+            high_water.track(record)
+        for ident in record.get("bibjson", {}).get("identifier", []):
+            if ident.get("type") == "doi" and ident.get("id") is not None:
+                yield ident.get("id").strip()
+
+class HighWaterMark(object):
+    """
+    The latest value of a document's change timestamp (by default last_updated) seen from a source, kept in
+    a JSON file shared by any number of sources, so that a later harvest or copy need only fetch what has
+    changed since.
+
+    Documents whose field equals the mark are fetched again, so that none changed in the same second as it
+    are missed; re-reading a handful of documents is harmless.  The mark only moves on commit(), which
+    should be called once everything harvested has been dealt with
+    """
+    def __init__(self, path, source, field="last_updated"):
+        self.path = path
+        self.source = source
+        self.field = field
+        self.seen = None
+        self._lock = threading.Lock()
+        saved = self._load().get(source, {})
+        self.since = saved.get("value") if saved.get("field") == field else None
+
+    def query(self, query=None):
+        """
+        Restrict the query to the documents changed since the mark (if there is one)
+        """
+        q = dict(query) if query is not None else {"query" : {"match_all" : {}}}
+        if self.since is None:
+            return q
+        q["query"] = {
+            "filtered" : {
+                "query" : q.get("query", {"match_all" : {}}),
+                "filter" : {"range" : {self.field : {"gte" : self.since}}}
+            }
+        }
+        return q
+
+    def track(self, record):
+        value = record
+        for part in self.field.split("."):
+            value = value.get(part) if isinstance(value, dict) else None
+        if value is None:
+            return
+        with self._lock:
+            if self.seen is None or value > self.seen:
+                self.seen = value
+
+    def commit(self):
+        with self._lock:
+            if self.seen is None or (self.since is not None and self.seen <= self.since):
+                return
+            marks = self._load()
+            marks[self.source] = {"field" : self.field, "value" : self.seen}
+            # write and rename, so that a crash mid-write does not lose the other sources' marks
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(marks, f, indent=2)
+            os.rename(tmp, self.path)
+            self.since = self.seen
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
+
+def _unpack(hit):
+    return hit.get("_source") if "_source" in hit else hit.get("fields")
+
+def _post(session, url, data, params=None, content_type="application/json"):
+    # without the content type, a query pass-through will not read the body as a query
+    resp = session.post(url, data=data, params=params, headers={"Content-Type" : content_type})
+    resp.raise_for_status()
+    return resp.json()
+
+def _scroll(session, search_url, q, keepalive):
+    parts = urlparse(search_url)
+    scroll_url = parts.scheme + "://" + parts.netloc + "/_search/scroll"
+    res = _post(session, search_url, json.dumps(q), params={"scroll" : keepalive})
+    scroll_id = res.get("_scroll_id")
+    try:
+        while True:
+            hits = res.get("hits", {}).get("hits", [])
+            if len(hits) == 0:
+                break
+            yield hits
+            hits = res = None
+            # the scroll id is sent bare, so it is not JSON
+            res = _post(session, scroll_url, scroll_id, params={"scroll" : keepalive}, content_type="text/plain")
+            scroll_id = res.get("_scroll_id", scroll_id)
+    finally:
+        # free the scroll context rather than waiting for it to time out
+        if scroll_id is not None:
+            try:
+                session.delete(scroll_url, data=scroll_id)
+            except requests.exceptions.RequestException:
+                pass
+
+def _keyset(session, search_url, q, sort_field, search_after, last=None):
+    q["sort"] = [{sort_field : {"order" : "asc"}}]
+    base = q.get("query", {"match_all" : {}})
+    while True:
+        if last is not None:
+            if search_after:
+                q["search_after"] = [last]
+            else:
+                q["query"] = {
+                    "filtered" : {
+                        "query" : base,
+                        "filter" : {"range" : {sort_field : {"gt" : last}}}
+                    }
+                }
+        res = _post(session, search_url, json.dumps(q))
+        hits = res.get("hits", {}).get("hits", [])
+        if len(hits) == 0:
+            break
+        yield hits
+        last = hits[-1].get("sort", [None])[0]
+        if last is None or len(hits) < q["size"]:
+            break
+        hits = res = None
@@ -1,13 +1,87 @@
 from datetime import datetime, timedelta
-import json, requests, time, csv, sys, uuid
-from copy import deepcopy
+import json, requests, time, sys, uuid, heapq, threading, signal, gzip, random, gc, Queue
+from contextlib import contextmanager
+from collections import deque
+from email.utils import parsedate_tz, mktime_tz
+from cStringIO import StringIO
+from requests.adapters import HTTPAdapter
+from doaj2oag import output
+
+# a faster encoder for the (large) job documents, where one is installed
+try:
+    import ujson as fastjson
+except ImportError:
+    fastjson = json
+
+def dumps(obj):
+    return fastjson.dumps(obj)
+
+def loads(s):
+    with _gc_paused():
+        return fastjson.loads(s)
+
+@contextmanager
+def _gc_paused():
+    # building hundreds of thousands of small objects at once sets off repeated full collections which find
+    # nothing to free, and can take as long as the work itself
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+_EPOCH = datetime(1970, 1, 1)
+
+class Clock(object):
+    """
+    The source of time for request states and the scheduler.  Substitute another implementation
+    to drive time forward without really waiting (e.g. in tests)
+    """
+    def now(self):
+        return datetime.now()
+
+    def wait(self, seconds, wakeup=None):
+        """
+        Sleep for up to the given number of seconds, returning early if the wakeup event is set
+        """
+        if seconds <= 0:
+            return
+        if wakeup is None:
+            time.sleep(seconds)
+        else:
+            wakeup.wait(seconds)
+
+SYSTEM_CLOCK = Clock()
+
+class Entry(object):
+    """
+    The tracking record for one identifier in a RequestState.  Pending entries have a due time, and
+    successes and errors have the time they were found instead.
+
+    There is one of these for every identifier in a job, so it uses slots rather than a dict
+    """
+    __slots__ = ("init", "due", "found", "requested", "maxed")
+
+    def __init__(self, init, due=None, found=None, requested=0, maxed=False):
+        self.init = init
+        self.due = due
+        self.found = found
+        self.requested = requested
+        self.maxed = maxed
 
 class RequestState(object):
     # _timestamp_format = "%Y-%m%dT%H:%M:%S.%fZ"
     _timestamp_format = "%Y-%m-%dT%H:%M:%SZ"
 
-    def __init__(self, identifiers, timeout=None, back_off_factor=1, max_back_off=120, max_retries=None, batch_size=1000, start=None):
+    def __init__(self, identifiers, timeout=None, back_off_factor=1, max_back_off=120, max_retries=None, batch_size=1000, start=None, clock=None, index=None):
+        """
+        index - a doiindex.DOIIndex to normalise and de-duplicate the identifiers through, leaving out any
+            which already have a fresh result
+        """
         self.id = uuid.uuid4().hex
+        self.clock = clock if clock is not None else SYSTEM_CLOCK
 
         self.success = {}
         self.error = {}
@@ -16,7 +90,15 @@ class RequestState(object):
         self.success_buffer = []
         self.error_buffer = []
 
-        self.start = datetime.now() if start is None else start
+        # min-heap of (due, id) for the pending items.  Entries are invalidated lazily:
+        # an entry is only current if the id is still pending, unmaxed, and due at that time
+        self._schedule = []
+        self._unmaxed = 0
+
+        # ids whose entries have changed since the state was last saved
+        self._dirty = set()
+
+        self.start = self.clock.now() if start is None else start
 
         self.timeout = self.start + timedelta(seconds=timeout) if timeout is not None else None
         self.back_off_factor = back_off_factor
@@ -24,8 +106,32 @@ class RequestState(object):
         self.max_retries = max_retries
         self.batch_size = batch_size
 
+        if index is not None:
+            identifiers = index.filter(identifiers)
+        self.add_identifiers(identifiers, self.start)
+
+    def add_identifiers(self, identifiers, due=None):
+        """
+        Add more identifiers to the pending list, due at the given time (default now).  Identifiers which
+        we already know about are ignored
+        """
+        due = self.clock.now() if due is None else due
+        for ident in identifiers:
+            if ident in self.pending or ident in self.success or ident in self.error:
+                continue
+            self.pending[ident] = Entry(due, due=due)
+            self._dirty.add(ident)
+            heapq.heappush(self._schedule, (due, ident))
+            self._unmaxed += 1
+
+    def remove_identifiers(self, identifiers):
+        """
+        Stop tracking the given pending identifiers altogether
+        """
         for ident in identifiers:
-            self.pending[ident] = {"init" : self.start, "due" : self.start, "requested" : 0, "maxed" : False}
+            if ident in self.pending:
+                self._unschedule(ident)
+                self._dirty.add(ident)
 
     def print_parameters(self):
         params = "Timeout: " + str(self.timeout) + "\n"
@@ -40,29 +146,44 @@ class RequestState(object):
         return status
 
     def finished(self):
-        if len(self.pending.keys()) == 0:
+        if len(self.pending) == 0:
             return True
         if self.timeout is not None:
-            if datetime.now() > self.timeout:
+            if self.clock.now() > self.timeout:
                 return True
-        unmaxed = [p for p in self.pending.keys() if not self.pending[p].get("maxed")]
-        if len(unmaxed) == 0:
+        if self._unmaxed == 0:
             return True
         return False
 
     def get_due(self):
-        now = datetime.now()
-        return [p for p in self.pending.keys() if self.pending[p].get("due") < now and not self.pending[p].get("maxed")]
+        now = self.clock.now()
+        due = []
+        seen = set()
+        while len(self._schedule) > 0 and self._schedule[0][0] < now:
+            entry = heapq.heappop(self._schedule)
+            if entry[1] in seen or not self._is_current(entry):
+                continue
+            seen.add(entry[1])
+            due.append(entry)
+
+        # the items remain pending until a result is recorded for them, so put them back
+        for entry in due:
+            heapq.heappush(self._schedule, entry)
+        return [entry[1] for entry in due]
 
     def next_due(self):
-        earliest = None
-        for p, o in self.pending.iteritems():
-            if earliest is None or o.get("due") < earliest:
-                earliest = o.get("due")
-        return earliest
+        while len(self._schedule) > 0 and not self._is_current(self._schedule[0]):
+            heapq.heappop(self._schedule)
+        if len(self._schedule) == 0:
+            return None
+        return self._schedule[0][0]
 
-    def record_result(self, result):
-        now = datetime.now()
+    def record_result(self, result, buffer=True):
+        """
+        buffer - keep the successes and errors for flush_success and flush_error.  Not wanted when they are
+            being streamed to a sink instead
+        """
+        now = self.clock.now()
 
         successes = result.get("results", [])
         errors = result.get("errors", [])
@@ -70,29 +191,21 @@ class RequestState(object):
 
         for s in successes:
             id = s.get("identifier")[0].get("id")
-            ourrecord = self.pending.get(id)
-            if ourrecord is None:
+            if id not in self.pending:
                 print "No record of pending id " + id
                 continue
-            self.success[id] = deepcopy(ourrecord)
-            self.success[id]["requested"] += 1
-            self.success[id]["found"] = now
-            del self.success[id]["due"]
-            del self.pending[id]
-        self.success_buffer.extend(successes)
+            self.success[id] = self._found(id, now)
+        if buffer:
+            self.success_buffer.extend(successes)
 
         for e in errors:
             id = e.get("identifier").get("id")
-            ourrecord = self.pending.get(id)
-            if ourrecord is None:
+            if id not in self.pending:
                 print "No record of pending id " + id
                 continue
-            self.error[id] = deepcopy(ourrecord)
-            self.error[id]["requested"] += 1
-            self.error[id]["found"] = now
-            del self.error[id]["due"]
-            del self.pending[id]
-        self.error_buffer.extend(errors)
+            self.error[id] = self._found(id, now)
+        if buffer:
+            self.error_buffer.extend(errors)
 
         for p in processing:
             id = p.get("identifier").get("id")
@@ -100,10 +213,20 @@ class RequestState(object):
             if ourrecord is None:
                 print "No record of pending id " + id
                 continue
-            self.pending[id]["requested"] += 1
-            self.pending[id]["due"] = self._backoff(self.pending[id]["requested"])
-            if self.max_retries is not None and self.pending[id]["requested"] >= self.max_retries:
-                self.pending[id]["maxed"] = True
+            if ourrecord.maxed:
+                continue
+            ourrecord.requested += 1
+            ourrecord.due = self._backoff(ourrecord.requested)
+            self._dirty.add(id)
+            if self.max_retries is not None and ourrecord.requested >= self.max_retries:
+                ourrecord.maxed = True
+                self._unmaxed -= 1
+            else:
+                heapq.heappush(self._schedule, (ourrecord.due, id))
+
+        # stale entries are only dropped lazily, so compact the heap if they start to dominate it
+        if len(self._schedule) > 2 * len(self.pending) + 1000:
+            self._rebuild_schedule()
 
     def flush_success(self):
         buffer = self.success_buffer
@@ -116,8 +239,8 @@ class RequestState(object):
         return buffer
 
     @classmethod
-    def from_json(cls, j):
-        state = RequestState([])
+    def from_json(cls, j, clock=None):
+        state = RequestState([], clock=clock)
 
         state.id = j.get("id")
         if j.get("timetout"):
@@ -129,23 +252,17 @@ class RequestState(object):
         if j.get("max_retries"):
             state.max_retries = j.get("max_retries")
 
-        for s in j.get("success", []):
-            obj = deepcopy(s)
-            obj["init"] = datetime.strptime(obj["init"], cls._timestamp_format)
-            obj["found"] = datetime.strptime(obj["found"], cls._timestamp_format)
-            state.success[s.get("id")] = obj
+        times = {}
+        with _gc_paused():
+            for s in j.get("success", []):
+                state.success[s.get("id")] = cls._entry_from_json(s, "found", times)
 
-        for s in j.get("error", []):
-            obj = deepcopy(s)
-            obj["init"] = datetime.strptime(obj["init"], cls._timestamp_format)
-            obj["found"] = datetime.strptime(obj["found"], cls._timestamp_format)
-            state.error[s.get("id")] = obj
+            for s in j.get("error", []):
+                state.error[s.get("id")] = cls._entry_from_json(s, "found", times)
 
-        for s in j.get("pending", []):
-            obj = deepcopy(s)
-            obj["init"] = datetime.strptime(obj["init"], cls._timestamp_format)
-            obj["due"] = datetime.strptime(obj["due"], cls._timestamp_format)
-            state.pending[s.get("id")] = obj
+            for s in j.get("pending", []):
+                state.pending[s.get("id")] = cls._entry_from_json(s, "due", times)
+            state._rebuild_schedule()
 
         return state
 
@@ -162,151 +279,789 @@ class RequestState(object):
             data["max_retries"] = self.max_retries
         data["batch_size"] = self.batch_size
 
-        data["success"] = []
-        for k in self.success:
-            obj = {"id" : k}
-            obj.update(self.success[k])
-            obj["init"] = datetime.strftime(obj["init"], self._timestamp_format)
-            obj["found"] = datetime.strftime(obj["found"], self._timestamp_format)
-            data["success"].append(obj)
-
-        data["error"] = []
-        for k in self.error:
-            obj = {"id" : k}
-            obj.update(self.error[k])
-            obj["init"] = datetime.strftime(obj["init"], self._timestamp_format)
-            obj["found"] = datetime.strftime(obj["found"], self._timestamp_format)
-            data["error"].append(obj)
-
-        data["pending"] = []
-        for k in self.pending:
-            obj = {"id" : k}
-            obj.update(self.pending[k])
-            obj["init"] = datetime.strftime(obj["init"], self._timestamp_format)
-            obj["due"] = datetime.strftime(obj["due"], self._timestamp_format)
-            data["pending"].append(obj)
+        with _gc_paused():
+            data["success"] = [self._entry_json(k, v, "found") for k, v in self.success.iteritems()]
+            data["error"] = [self._entry_json(k, v, "found") for k, v in self.error.iteritems()]
+            data["pending"] = [self._entry_json(k, v, "due") for k, v in self.pending.iteritems()]
 
         return data
 
+    def changes(self):
+        """
+        The entries which have been added or have changed since clear_changes() was last called, in the same
+        form as json(), so that they can be saved on top of an earlier copy of the state.  The ids of pending
+        entries which have since been removed are listed under "removed"
+        """
+        data = {"batch_size" : self.batch_size, "success" : [], "error" : [], "pending" : [], "removed" : []}
+        for k in self._dirty:
+            if k in self.success:
+                data["success"].append(self._entry_json(k, self.success[k], "found"))
+            elif k in self.error:
+                data["error"].append(self._entry_json(k, self.error[k], "found"))
+            elif k in self.pending:
+                data["pending"].append(self._entry_json(k, self.pending[k], "due"))
+            else:
+                data["removed"].append(k)
+        return data
+
+    def clear_changes(self):
+        self._dirty = set()
+
+    def apply_changes(self, changes):
+        """
+        Bring the state up to date with the output of changes() from a later copy of it
+        """
+        if changes.get("batch_size") is not None:
+            self.batch_size = changes.get("batch_size")
+        times = {}
+        for s in changes.get("success", []):
+            self.pending.pop(s.get("id"), None)
+            self.success[s.get("id")] = self._entry_from_json(s, "found", times)
+        for s in changes.get("error", []):
+            self.pending.pop(s.get("id"), None)
+            self.error[s.get("id")] = self._entry_from_json(s, "found", times)
+        for s in changes.get("pending", []):
+            self.pending[s.get("id")] = self._entry_from_json(s, "due", times)
+        for id in changes.get("removed", []):
+            self.pending.pop(id, None)
+        self._rebuild_schedule()
+
+    @classmethod
+    def parse_time(cls, value, times=None):
+        """
+        Read an entry timestamp, which is either epoch seconds or (in states saved by older versions) a string
+        in _timestamp_format.  Entries share a handful of distinct times, so times may be a dict in which to
+        remember the ones already converted
+        """
+        if times is not None and value in times:
+            return times[value]
+        if isinstance(value, basestring):
+            dt = datetime.strptime(value, cls._timestamp_format)
+        else:
+            dt = _EPOCH + timedelta(seconds=value)
+        if times is not None:
+            times[value] = dt
+        return dt
+
+    @classmethod
+    def epoch(cls, dt):
+        delta = dt - _EPOCH
+        return delta.days * 86400 + delta.seconds
+
+    @classmethod
+    def _entry_from_json(cls, s, time_field, times=None):
+        entry = Entry(cls.parse_time(s["init"], times), requested=s.get("requested", 0), maxed=s.get("maxed", False))
+        setattr(entry, time_field, cls.parse_time(s[time_field], times))
+        return entry
+
+    def _entry_json(self, k, record, time_field):
+        return {
+            "id" : k,
+            "init" : self.epoch(record.init),
+            time_field : self.epoch(getattr(record, time_field)),
+            "requested" : record.requested,
+            "maxed" : record.maxed
+        }
+
+    def _found(self, id, now):
+        # move the entry out of pending as it is, rather than copying it
+        record = self._unschedule(id)
+        record.requested += 1
+        record.found = now
+        record.due = None
+        self._dirty.add(id)
+        return record
+
+    def _is_current(self, entry):
+        record = self.pending.get(entry[1])
+        return record is not None and not record.maxed and record.due == entry[0]
+
+    def _unschedule(self, id):
+        # the heap entry is left behind, and discarded when it is next encountered
+        record = self.pending.pop(id)
+        if not record.maxed:
+            self._unmaxed -= 1
+        return record
+
+    def _rebuild_schedule(self):
+        self._schedule = [(o.due, p) for p, o in self.pending.iteritems() if not o.maxed]
+        heapq.heapify(self._schedule)
+        self._unmaxed = len(self._schedule)
+
     def _backoff(self, times):
-        now = datetime.now()
+        now = self.clock.now()
         seconds = 2**times * self.back_off_factor
         seconds = seconds if seconds < self.max_back_off else self.max_back_off
         return now + timedelta(seconds=seconds)
 
 
+class RateLimiter(object):
+    """
+    Spaces out acquisitions so that no more than the given number happen per second, across all the
+    threads which share the limiter.  A rate of None imposes no limit
+    """
+    def __init__(self, requests_per_second=None):
+        self.interval = 1.0 / requests_per_second if requests_per_second else 0
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def acquire(self):
+        if self.interval <= 0:
+            return
+        with self._lock:
+            now = time.time()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+class RetryBudget(object):
+    """
+    A pool of retries to be shared between all the batches of one job's cycle, so that a failing service
+    does not get max_retries attempts for every single batch.  A limit of None is unlimited
+    """
+    def __init__(self, retries=None):
+        self.remaining = retries
+        self._lock = threading.Lock()
+
+    def spend(self):
+        with self._lock:
+            if self.remaining is None:
+                return True
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+class RetryPolicy(object):
+    """
+    Decides whether and when to retry a failed request to the lookup service.
+
+    Server errors (5xx), connection errors and timeouts are retried, as are the client errors in
+    retry_statuses (by default 408 and 429); any other 4xx is raised straight away.  The wait between
+    attempts is drawn uniformly from [0, min(cap, base * 2**attempt)] (i.e. "full jitter") so that jobs
+    which fail together do not retry together, unless the service sends a Retry-After, which is honoured
+    up to max_retry_after seconds.
+    """
+    def __init__(self, max_retries=10, base=2, cap=60, max_retry_after=600, retry_statuses=None, job_budget=None, sleep=None, rng=None):
+        self.max_retries = max_retries
+        self.base = base
+        self.cap = cap
+        self.max_retry_after = max_retry_after
+        self.retry_statuses = retry_statuses if retry_statuses is not None else [408, 429]
+        self.job_budget = job_budget
+        self.sleep = sleep if sleep is not None else time.sleep
+        self.rng = rng if rng is not None else random.Random()
+
+    def budget(self):
+        return RetryBudget(self.job_budget)
+
+    def retryable(self, resp=None, exc=None):
+        if exc is not None:
+            return isinstance(exc, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+        if resp.status_code >= 500:
+            return True
+        return resp.status_code in self.retry_statuses
+
+    def delay(self, attempt, resp=None):
+        if resp is not None:
+            retry_after = self._retry_after(resp)
+            if retry_after is not None:
+                return min(retry_after, self.max_retry_after)
+        return self.rng.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+    def _retry_after(self, resp):
+        header = resp.headers.get("retry-after")
+        if header is None:
+            return None
+        try:
+            return max(float(header), 0)
+        except ValueError:
+            pass
+        # otherwise it should be an HTTP date
+        parsed = parsedate_tz(header)
+        if parsed is None:
+            return None
+        return max(mktime_tz(parsed) - time.time(), 0)
+
+class AdaptiveBatchSize(object):
+    """
+    Tunes a job's batch size to how the lookup service is responding, by additive increase/multiplicative
+    decrease: each full batch answered within the target latency grows the batch size by the step, and
+    each attempt which is slow or fails (timeout, connection error, 5xx, 429) cuts it by the factor.
+    The chosen size is kept on the state, so it is saved with the job
+    """
+    def __init__(self, target_latency=10, min_size=10, max_size=1000, step=10, factor=0.5):
+        self.target_latency = target_latency
+        self.min_size = min_size
+        self.max_size = max_size
+        self.step = step
+        self.factor = factor
+        self._lock = threading.Lock()
+
+    def observe(self, state, size, latency, failed=False):
+        with self._lock:
+            if failed or latency > self.target_latency:
+                state.batch_size = max(self.min_size, int(state.batch_size * self.factor))
+            elif size >= state.batch_size:
+                state.batch_size = min(self.max_size, state.batch_size + self.step)
+
 class OAGClient(object):
-    def __init__(self, lookup_url):
+    def __init__(self, lookup_url, concurrency=1, rate_limiter=None, pool_size=None, timeout=None, compress=False, session=None, retry_policy=None, batch_controller=None, cache=None, sink=None):
+        """
+        concurrency - the number of batches that may be in flight at once.  With more than one, batches are
+            dispatched from a pool of worker threads, and spaced out by the rate limiter rather than by
+            sleeping between them
+        rate_limiter - a RateLimiter to share between cycles (and clients).  With concurrency, this is the
+            only limit on the rate of requests (the throttle between batches does not apply), so if it is
+            omitted the pool is unlimited
+        pool_size - the number of keep-alive connections to hold open to the lookup service (defaults to
+            enough for the concurrency)
+        timeout - seconds to wait for the lookup service to respond to a batch, or None to wait indefinitely
+        compress - gzip the request bodies, and ask for gzipped responses
+        session - a requests.Session to use instead of creating a pooled one
+        retry_policy - the RetryPolicy for failed requests, including the retry budget for each job's cycle
+        batch_controller - an AdaptiveBatchSize which tunes each job's batch size to the service's response
+            times.  If omitted, the job's batch size is used as it is
+        cache - a cache.ResultCache to answer identifiers from before going to the lookup service, and to
+            store the service's results in
+        sink - a StreamingSink to hand the results of each batch to as soon as they are recorded, rather than
+            leaving them buffered in the state until the end of the cycle
+        """
         self.lookup_url = lookup_url
+        self.concurrency = concurrency
+        self.rate_limiter = rate_limiter if rate_limiter is not None or concurrency <= 1 else RateLimiter()
+        self.timeout = timeout
+        self.compress = compress
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.batch_controller = batch_controller
+        self.cache = cache
+        self.sink = sink
+        self.session = session if session is not None else self._make_session(pool_size if pool_size is not None else max(concurrency, 10))
+
+    def _make_session(self, pool_size):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers.update({"Accept" : "application/json", "Connection" : "keep-alive"})
+        return session
 
     def cycle(self, state, throttle=0, verbose=False):
-        due = state.get_due()
-        batches = self._batch(due, state.batch_size)
+        due = self._due(state, verbose)
         if verbose:
-            print str(len(due)) + " due; requesting in " + str(len(batches)) + " batches"
+            print str(len(due)) + " due; requesting in batches of " + str(state.batch_size)
+        print "Processing batch ",
+        budget = self.retry_policy.budget()
+        batches = self._feed(due, state)
+        if self.concurrency > 1 and len(due) > state.batch_size:
+            self._dispatch(state, batches, self.rate_limiter, budget)
+        else:
+            self._sequential(state, batches, throttle, budget)
+        print ""
+        if self.sink is not None:
+            # everything recorded in the state has been written before the state is saved
+            self.sink.flush(state.id)
+        if verbose and self.batch_controller is not None:
+            print "Batch size is now " + str(state.batch_size)
+        return state
+
+    def _due(self, state, verbose=False):
+        # the identifiers due for lookup, once any the cache can answer have been recorded
+        due = state.get_due()
+        if self.cache is not None and len(due) > 0:
+            answered = self._from_cache(state, due)
+            if verbose:
+                print str(len(answered)) + " of " + str(len(due)) + " due answered from the cache"
+            due = [d for d in due if d not in answered]
+        return due
+
+    def _sequential(self, state, batches, throttle, budget=None):
         first = True
         i = 1
-        print "Processing batch ",
         for batch in batches:
             if first:
                 first = False
             elif throttle > 0:
                 time.sleep(throttle)
-            result = self._query(batch)
-            state.record_result(result)
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            result = self._query(batch, budget, self._observer(state, batch))
+            self._record(state, result)
 
             print i,
             sys.stdout.flush()
             i += 1
-        print ""
-        return state
 
-    def _batch(self, ids, batch_size=1000):
-        batches = []
+    def _dispatch(self, state, batches, limiter, budget=None):
+        # the batch feed and the state are not thread safe, so batches are taken and results are
+        # recorded one at a time
+        lock = threading.Lock()
+        failures = []
+        progress = [0]
+
+        def work():
+            while len(failures) == 0:
+                with lock:
+                    batch = next(batches, None)
+                if batch is None:
+                    return
+                limiter.acquire()
+                try:
+                    result = self._query(batch, budget, self._observer(state, batch))
+                    with lock:
+                        # a sink which fails to take the results fails the cycle, as a failed lookup does
+                        self._record(state, result)
+                        progress[0] += 1
+                        print progress[0],
+                        sys.stdout.flush()
+                except Exception:
+                    failures.append(sys.exc_info())
+                    return
+
+        workers = [threading.Thread(target=work) for i in range(self.concurrency)]
+        for w in workers:
+            w.daemon = True
+            w.start()
+        for w in workers:
+            w.join()
+
+        # as in the sequential case, a batch which fails outright fails the cycle (once the batches
+        # already in flight have been recorded)
+        if len(failures) > 0:
+            raise failures[0][0], failures[0][1], failures[0][2]
+
+    def _record(self, state, result):
+        self._deliver(state, result)
+        if self.cache is not None:
+            self.cache.put(result)
+
+    def _deliver(self, state, result):
+        state.record_result(result, buffer=self.sink is None)
+        if self.sink is not None:
+            self.sink.write(result.get("results", []), result.get("errors", []), state.id)
+
+    def _from_cache(self, state, due):
+        """
+        Record the cached results for any of the due identifiers in the state, as if they had come from the
+        lookup service, and return the identifiers which were answered
+        """
+        result = {"results" : [], "errors" : []}
+        hits = self.cache.get(due)
+        for ident, (is_error, obj) in hits.iteritems():
+            # the cache is case insensitive, so make sure the result carries the identifier as we asked for it
+            if is_error:
+                obj["identifier"]["id"] = ident
+                result["errors"].append(obj)
+            else:
+                obj["identifier"][0]["id"] = ident
+                result["results"].append(obj)
+        self._deliver(state, result)
+        return hits
+
+    def _feed(self, ids, state):
+        # batches are cut as they are needed, so that they pick up any change the batch controller
+        # has made to the state's batch size
         start = 0
-        while True:
-            batch = ids[start:start + batch_size]
-            if len(batch) == 0: break
-            batches.append(batch)
-            start += batch_size
-        return batches
+        while start < len(ids):
+            size = max(int(state.batch_size), 1)
+            yield ids[start:start + size]
+            start += size
+
+    def _observer(self, state, batch):
+        if self.batch_controller is None:
+            return None
+        def observe(latency, failed):
+            self.batch_controller.observe(state, len(batch), latency, failed)
+        return observe
 
-    def _query(self, batch, retries=10, retry_throttle=2):
+    def _encode(self, batch):
         data = json.dumps(batch)
-        counter = 0
+        headers = {"Content-Type" : "application/json"}
+        if self.compress:
+            buf = StringIO()
+            with gzip.GzipFile(fileobj=buf, mode="wb") as f:
+                f.write(data)
+            data = buf.getvalue()
+            headers["Content-Encoding"] = "gzip"
+            headers["Accept-Encoding"] = "gzip"
+        return data, headers
+
+    def _query(self, batch, budget=None, observe=None):
+        """
+        observe - if given, called with the latency of each attempt and whether the service failed it
+            (timeouts, connection errors, 5xx and 429) - this is how the batch controller learns
+        """
+        data, headers = self._encode(batch)
+        policy = self.retry_policy
+        attempt = 0
         while True:
-            resp = requests.post(self.lookup_url, headers={'Accept':'application/json'}, data=data)
-            if resp.status_code == requests.codes.ok:
-                return resp.json()
-            elif counter >= retries:
-                resp.raise_for_status()
+            resp = None
+            sent = time.time()
+            try:
+                resp = self.session.post(self.lookup_url, headers=headers, data=data, timeout=self.timeout)
+            except requests.exceptions.RequestException as e:
+                if observe is not None and policy.retryable(exc=e):
+                    observe(time.time() - sent, True)
+                if not policy.retryable(exc=e) or not self._may_retry(attempt, budget):
+                    raise
+                print "(retry: " + e.__class__.__name__ + ")",
             else:
-                counter += 1
-                time.sleep(retry_throttle)
-                print "(retry)"
-        return resp.json()
-
-def csv_closure(success_file, error_file):
-    def csv_callback(state):
-        successes = state.flush_success()
-        errors = state.flush_error()
-        with open(success_file, "a") as f:
-            writer = csv.writer(f)
-            for s in successes:
-                identifier = s.get("identifier", [{}])[0].get("id")
-                ltitle = s.get("license", [{}])[0].get("title")
-                csv_row = [identifier, ltitle]
-                clean_row = [unicode(c).encode("utf8", "replace") if c is not None else "" for c in csv_row]
-                writer.writerow(clean_row)
-
-        with open(error_file, "a") as f:
-            writer = csv.writer(f)
-            for e in errors:
-                identifier = e.get("identifier", [{}]).get("id")
-                msg = e.get("error")
-                csv_row = [identifier, msg]
-                clean_row = [unicode(c).encode("utf8", "replace") if c is not None else "" for c in csv_row]
-                writer.writerow(clean_row)
-    return csv_callback
+                if observe is not None:
+                    observe(time.time() - sent, resp.status_code >= 500 or resp.status_code == 429)
+                if resp.status_code == requests.codes.ok:
+                    return resp.json()
+                if not policy.retryable(resp=resp) or not self._may_retry(attempt, budget):
+                    resp.raise_for_status()
+                    # raise_for_status does not raise for 1xx/3xx, but we still can't use the response
+                    raise requests.exceptions.HTTPError(str(resp.status_code) + " response from lookup service")
+                print "(retry: " + str(resp.status_code) + ")",
 
-def oag_it(lookup_url, identifiers,
-           timeout=None, back_off_factor=1, max_back_off=120, max_retries=None, batch_size=1000,
-            verbose=True, throttle=5,
-            callback=None, save_state=None):
-    state = RequestState(identifiers, timeout=timeout, back_off_factor=back_off_factor, max_back_off=max_back_off, max_retries=max_retries, batch_size=batch_size)
-    client = OAGClient(lookup_url)
+            policy.sleep(policy.delay(attempt, resp))
+            attempt += 1
 
-    if verbose:
-        print "Making requests to " + lookup_url + " for " + str(len(identifiers)) + " identifiers"
-        print state.print_parameters()
-        print state.print_status_report()
+    def _may_retry(self, attempt, budget):
+        if attempt >= self.retry_policy.max_retries:
+            return False
+        return budget is None or budget.spend()
 
-    next = state.next_due()
-    while True:
-        # check whether we're supposed to do anything yet
-        now = datetime.now()
-        if now < next:
-            continue
+class AsyncOAGClient(OAGClient):
+    """
+    An OAGClient which runs the batches of many jobs at once, so that one worker can have several jobs' cycles
+    in flight together rather than taking them one at a time.  submit() starts a job's cycle and returns
+    straight away; the batches of all the submitted jobs are taken in turn by one shared pool of concurrency
+    worker threads, and spaced out by the one rate limiter.  cycle() keeps the OAGClient contract, by
+    submitting and waiting.
 
-        # if a cycle is due, issue it
-        client.cycle(state, throttle, verbose)
+    The per-cycle throttle does not apply here: use a rate_limiter to pace the requests
+    """
+    def __init__(self, lookup_url, concurrency=10, **kwargs):
+        super(AsyncOAGClient, self).__init__(lookup_url, concurrency=concurrency, **kwargs)
+        if self.rate_limiter is None:
+            self.rate_limiter = RateLimiter()
+        self._ready = threading.Condition()
+        self._active = deque()
+        self._workers = []
+        self._closed = False
+
+    def cycle(self, state, throttle=0, verbose=False):
+        return self.submit(state, verbose).wait()
+
+    def cycle_all(self, states, verbose=False):
+        """
+        Run a cycle of each of the states together, returning once they are all done
+        """
+        cycles = [self.submit(state, verbose) for state in states]
+        return [c.wait() for c in cycles]
+
+    def submit(self, state, verbose=False):
+        """
+        Start a cycle of the state, returning a handle whose wait() blocks until the cycle is done (raising if
+        any of its batches failed) and returns the state
+        """
+        due = self._due(state, verbose)
         if verbose:
-            print state.print_status_report()
+            print "Job " + str(state.id) + ": " + str(len(due)) + " due; requesting in batches of " + str(state.batch_size)
+        cycle = _Cycle(self, state, self._feed(due, state), self.retry_policy.budget())
+        with self._ready:
+            if self._closed:
+                raise ValueError("client is closed")
+            self._active.append(cycle)
+            while len(self._workers) < self.concurrency:
+                w = threading.Thread(target=self._work)
+                w.daemon = True
+                w.start()
+                self._workers.append(w)
+            self._ready.notify_all()
+        return cycle
+
+    def close(self):
+        with self._ready:
+            self._closed = True
+            self._ready.notify_all()
+        for w in self._workers:
+            w.join()
+        self._workers = []
+
+    def _work(self):
+        while True:
+            task = self._take()
+            if task is None:
+                return
+            cycle, batch = task
+            try:
+                self.rate_limiter.acquire()
+                result = self._query(batch, cycle.budget, self._observer(cycle.state, batch))
+                with cycle.lock:
+                    self._record(cycle.state, result)
+            except Exception:
+                cycle.failed(sys.exc_info())
+            with self._ready:
+                cycle.outstanding -= 1
+                cycle.check_done()
+
+    def _take(self):
+        # round robin over the jobs, so that a large one does not hold up the rest
+        with self._ready:
+            while not self._closed:
+                while len(self._active) > 0:
+                    cycle = self._active[0]
+                    self._active.rotate(-1)
+                    batch = cycle.next_batch()
+                    if batch is None:
+                        self._active.remove(cycle)
+                        cycle.check_done()
+                        continue
+                    cycle.outstanding += 1
+                    return cycle, batch
+                self._ready.wait()
+            return None
+
+class _Cycle(object):
+    """
+    One job's cycle in an AsyncOAGClient.  next_batch and check_done are called with the client's lock held
+    """
+    def __init__(self, client, state, batches, budget):
+        self.client = client
+        self.state = state
+        self.batches = batches
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.outstanding = 0
+        self.exhausted = False
+        self.failure = None
+        self.done = threading.Event()
+
+    def next_batch(self):
+        if self.exhausted or self.failure is not None:
+            self.exhausted = True
+            return None
+        batch = next(self.batches, None)
+        if batch is None:
+            self.exhausted = True
+        return batch
+
+    def failed(self, exc_info):
+        # as with OAGClient, the first batch which fails outright fails the cycle
+        with self.lock:
+            if self.failure is None:
+                self.failure = exc_info
+
+    def check_done(self):
+        if self.exhausted and self.outstanding == 0:
+            self.done.set()
+
+    def wait(self):
+        self.done.wait()
+        if self.client.sink is not None:
+            self.client.sink.flush(self.state.id)
+        if self.failure is not None:
+            raise self.failure[0], self.failure[1], self.failure[2]
+        return self.state
+
+class ResultBatch(object):
+    """
+    The results of one batch, with the flush_success/flush_error interface of a RequestState, so that a
+    callback written for a state (such as those from csv_closure and oagr.doaj_closure) can take them
+    """
+    def __init__(self, successes, errors, job=None):
+        self.success_buffer = successes
+        self.error_buffer = errors
+        self.job = job
+
+    def flush_success(self):
+        buffer = self.success_buffer
+        self.success_buffer = []
+        return buffer
+
+    def flush_error(self):
+        buffer = self.error_buffer
+        self.error_buffer = []
+        return buffer
+
+class StreamingSink(object):
+    """
+    Passes each batch of results to a callback on a background thread, as the OAGClient records them.  No more
+    than max_batches wait in the queue: when the callback falls behind (e.g. a slow write back to ES),
+    write() blocks, which holds up the lookups rather than letting the results pile up in memory.
+
+    One sink may take the results of several jobs (e.g. from an AsyncOAGClient).  If the callback raises on a
+    job's batch, that job's later batches are dropped, and the exception is raised from every write() for the
+    job until a flush() for the job, which raises it too and then clears it.  Other jobs carry on
+    """
+    def __init__(self, callback, max_batches=4):
+        self.callback = callback
+        self._queue = Queue.Queue(max_batches)
+        self._failures = {}
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def write(self, successes, errors, job=None):
+        self._check(job, clear=False)
+        if len(successes) == 0 and len(errors) == 0:
+            return
+        self._start()
+        self._queue.put(ResultBatch(successes, errors, job))
+
+    def flush(self, job=None):
+        """
+        Wait until the callback has been given every batch written so far, then raise the failure of the given
+        job's batches (or with no job, of any)
+        """
+        if self._thread is not None:
+            self._queue.join()
+        self._check(job)
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            if self._thread is not None:
+                self._queue.put(None)
+                self._thread.join()
+                self._thread = None
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = self._queue.get()
+            try:
+                if batch is None:
+                    return
+                if batch.job not in self._failures:
+                    self.callback(batch)
+            except Exception:
+                with self._lock:
+                    self._failures[batch.job] = sys.exc_info()
+            finally:
+                self._queue.task_done()
+
+    def _check(self, job=None, clear=True):
+        with self._lock:
+            jobs = self._failures.keys()[:1] if job is None else [j for j in [job] if j in self._failures]
+            if len(jobs) == 0:
+                return
+            failure = self._failures.pop(jobs[0]) if clear else self._failures[jobs[0]]
+        raise failure[0], failure[1], failure[2]
+
+def csv_closure(success_file, error_file, **kwargs):
+    """
+    Make a callback which appends the identifier and licence title of each success, and the identifier and
+    message of each error, to CSV files.  The files are kept open between calls: see output.ResultCallback for
+    the other options (e.g. format="jsonl" to keep the whole result, compress, rotation)
+    """
+    return output.ResultCallback(success_file, error_file, **kwargs)
 
-        # run the callback on the state
-        if callback is not None:
-            callback(state)
+class Scheduler(object):
+    """
+    Drives a RequestState through OAG cycles, sleeping until the next identifier is due rather than
+    polling.  The sleep is cut short by wake() (e.g. after new identifiers have been added to the
+    state) or stop() (e.g. from a signal handler)
+    """
+    def __init__(self, client, throttle=5, verbose=True, callback=None, save_state=None, clock=None):
+        self.client = client
+        self.throttle = throttle
+        self.verbose = verbose
+        self.callback = callback
+        self.save_state = save_state
+        self.clock = clock if clock is not None else SYSTEM_CLOCK
+        self.wakeup = threading.Event()
+        self.shutdown = threading.Event()
 
-        # run the save method if there is one
-        if save_state is not None:
-            save_state(state)
+    def wake(self):
+        self.wakeup.set()
 
-        # if we are finished, break
-        if state.finished():
-            print "FINISHED"
-            break
+    def stop(self):
+        self.shutdown.set()
+        self.wakeup.set()
+
+    def run(self, state):
+        while not self.shutdown.is_set():
+            # clear the wakeup before looking at the state, so that work added from here on is not missed
+            self.wakeup.clear()
+            next = state.next_due()
+            now = self.clock.now()
+            if next is not None and not next < now:
+                # items are only due strictly after their due time, so always sleep a little
+                seconds = max((next - now).total_seconds(), 0.001)
+                self.clock.wait(seconds, self.wakeup)
+                continue
+
+            # if a cycle is due, issue it
+            self.client.cycle(state, self.throttle, self.verbose)
+            if self.verbose:
+                print state.print_status_report()
+
+            # run the callback on the state
+            if self.callback is not None:
+                self.callback(state)
+
+            # run the save method if there is one
+            if self.save_state is not None:
+                self.save_state(state)
+
+            # if we are finished, break
+            if state.finished():
+                print "FINISHED"
+                break
+
+            next = state.next_due()
+            if next is not None:
+                print "Next request is due at", datetime.strftime(next, "%Y-%m-%d %H:%M:%S")
+        return state
+
+def _install_shutdown_handlers(scheduler):
+    previous = {}
+    def handler(signum, frame):
+        print "Caught signal", signum, "- shutting down"
+        scheduler.stop()
+    for signum in [signal.SIGINT, signal.SIGTERM]:
+        try:
+            previous[signum] = signal.signal(signum, handler)
+        except ValueError:
+            # signal handlers can only be installed from the main thread
+            pass
+    return previous
+
+def _restore_handlers(previous):
+    for signum, handler in previous.iteritems():
+        signal.signal(signum, handler)
+
+def oag_it(lookup_url, identifiers,
+           timeout=None, back_off_factor=1, max_back_off=120, max_retries=None, batch_size=1000,
+            verbose=True, throttle=5, concurrency=1, requests_per_second=None, http_timeout=None, compress=False,
+            callback=None, save_state=None, clock=None, state_path=None, sink=None):
+    """
+    Look up the identifiers, which may be any iterable.  With a state_path the job is kept on disk (see
+    diskstate.DiskRequestState) rather than in memory, and the identifiers are read from the iterable in
+    chunks.  With a sink (see StreamingSink) the results are streamed to it batch by batch, rather than
+    buffered for the callback
+    """
+    if state_path is not None:
+        from doaj2oag import diskstate
+        state = diskstate.DiskRequestState(state_path, identifiers, timeout=timeout, back_off_factor=back_off_factor, max_back_off=max_back_off, max_retries=max_retries, batch_size=batch_size, clock=clock)
+    else:
+        state = RequestState(identifiers, timeout=timeout, back_off_factor=back_off_factor, max_back_off=max_back_off, max_retries=max_retries, batch_size=batch_size, clock=clock)
+    limiter = RateLimiter(requests_per_second) if requests_per_second is not None else None
+    client = OAGClient(lookup_url, concurrency=concurrency, rate_limiter=limiter, timeout=http_timeout, compress=compress, sink=sink)
+
+    if verbose:
+        print "Making requests to " + lookup_url
+        print state.print_parameters()
+        print state.print_status_report()
 
-        # if we have done work here, update the next due time for the busy
-        # loop aboge
-        next = state.next_due()
-        print "Next request is due at", datetime.strftime(next, "%Y-%m-%d %H:%M:%S")
+    scheduler = Scheduler(client, throttle=throttle, verbose=verbose, callback=callback, save_state=save_state, clock=clock)
+    previous = _install_shutdown_handlers(scheduler)
+    try:
+        scheduler.run(state)
+    finally:
+        _restore_handlers(previous)
+        # finish off the callback's files (e.g. the gzip trailer of csv_closure's)
+        if callback is not None and hasattr(callback, "close"):
+            callback.close()
+    return state
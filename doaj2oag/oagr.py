@@ -1,64 +1,308 @@
 import esprit
-from portality.core import app
-from doaj2oag import oag
-import time, sys, csv
-from datetime import datetime
+from portality.core import config
+from portality.lib import querycache
+from doaj2oag import oag, doiindex, cache, output
+import time, sys, json, hashlib, os, socket, uuid, argparse, multiprocessing, threading
+from datetime import datetime, timedelta
+
+_timestamp_format = "%Y-%m-%dT%H:%M:%SZ"
+
+class LeaseLost(Exception):
+    """
+    Raised when a job document has been changed by another worker since we claimed it
+    """
+    pass
+
+def make_client(lookup_url, sink=None):
+    """
+    Build an OAG client with the connection settings from the config
+    """
+    rps = config.get("OAG_REQUESTS_PER_SECOND")
+    limiter = oag.RateLimiter(rps) if rps is not None else None
+    policy = oag.RetryPolicy(max_retries=config.get("OAG_MAX_RETRIES", 10),
+                             cap=config.get("OAG_RETRY_CAP", 60),
+                             job_budget=config.get("OAG_JOB_RETRY_BUDGET"))
+    controller = None
+    if config.get("OAG_ADAPTIVE_BATCH_SIZE", False):
+        controller = oag.AdaptiveBatchSize(target_latency=config.get("OAG_TARGET_LATENCY", 10),
+                                           min_size=config.get("OAG_MIN_BATCH_SIZE", 10),
+                                           max_size=config.get("OAG_MAX_BATCH_SIZE", 1000))
+    result_cache = None
+    if config.get("OAG_CACHE_PATH") is not None:
+        result_cache = cache.ResultCache(config.get("OAG_CACHE_PATH"),
+                                         ttl=config.get("OAG_CACHE_TTL", 30 * 24 * 60 * 60),
+                                         error_ttl=config.get("OAG_CACHE_ERROR_TTL", 24 * 60 * 60),
+                                         max_entries=config.get("OAG_CACHE_MAX_ENTRIES", 1000000))
+    klass = oag.AsyncOAGClient if config.get("OAG_MULTIPLEX_JOBS", False) else oag.OAGClient
+    return klass(lookup_url,
+                 concurrency=config.get("OAG_CONCURRENCY", 1),
+                 rate_limiter=limiter,
+                 pool_size=config.get("OAG_POOL_SIZE"),
+                 timeout=config.get("OAG_TIMEOUT"),
+                 compress=config.get("OAG_COMPRESS", False),
+                 retry_policy=policy,
+                 batch_controller=controller,
+                 cache=result_cache,
+                 sink=sink)
+
+class ESDOIIndex(doiindex.DOIIndex):
+    """
+    The DOI index, kept in the "doi_index" type with one small document per DOI, so that it is shared by
+    every job runner and every harvest
+    """
+    def __init__(self, conn, staleness=None, error_staleness=None, chunk_size=1000):
+        super(ESDOIIndex, self).__init__(staleness, error_staleness)
+        self.conn = conn
+        self.type = "doi_index"
+        self.chunk_size = chunk_size
+
+    @classmethod
+    def from_config(cls, conn):
+        if not config.get("DOI_INDEX", False):
+            return None
+        return cls(conn, config.get("DOI_INDEX_STALENESS"), config.get("DOI_INDEX_ERROR_STALENESS"))
+
+    def lookup(self, keys):
+        entries = {}
+        for i in range(0, len(keys), self.chunk_size):
+            resp = esprit.raw.mget(self.conn, self.type, keys[i:i + self.chunk_size])
+            for obj in esprit.raw.unpack_mget(resp):
+                if obj is not None:
+                    entries[obj.get("id")] = (datetime.strptime(obj.get("found"), _timestamp_format), obj.get("status"))
+        return entries
+
+    def store(self, entries):
+        keys = entries.keys()
+        for i in range(0, len(keys), self.chunk_size):
+            lines = []
+            for k in keys[i:i + self.chunk_size]:
+                found, status = entries[k]
+                lines.append(json.dumps({"index" : {"_id" : k}}))
+                lines.append(json.dumps({"id" : k, "found" : found.strftime(_timestamp_format), "status" : status}))
+            resp = esprit.raw.raw_bulk(self.conn, "\n".join(lines) + "\n", self.type)
+            _bulk_failures(resp, len(lines) / 2)
 
 class JobRunner(object):
-    def __init__(self, lookup_url, es_throttle=2, oag_throttle=5, verbose=True, callback=None):
+    """
+    Runs the jobs stored in the "jobs" type as they fall due.
+
+    A job is stored as a full snapshot of its RequestState in "jobs", alongside a summary (status, next due
+    time, counts, log_seq and log_ids).  After each cycle only the entries which changed are written, as a new
+    document in the "jobs_log" type, and the summary in the job document is updated to add it to log_ids.
+    Loading a job replays the entries in its log_ids over the snapshot.  Once a job has compact_every log
+    entries the next save writes a fresh snapshot and clears out the log.
+
+    Several runners (in different processes or on different hosts) may work on the same jobs index.  A runner
+    claims a due job by setting a lease (owner and expiry) on the job document, conditional on the version it
+    read, and only processes the jobs it has claimed.  While a cycle runs the lease is renewed every third of
+    lease_seconds.  Saves are conditional on the version too, and release the lease.  If a runner dies, its
+    leases expire after lease_seconds and the jobs are claimed again.  Each runner's log entries have ids of
+    their own, so a runner which has lost its lease cannot overwrite the entry of the one which took it over
+    """
+    def __init__(self, lookup_url, es_throttle=2, oag_throttle=5, verbose=True, callback=None, client=None, compact_every=20, lease_seconds=1800, doi_index=None, multiplex_size=10):
         self.es_throttle = es_throttle
-        self.conn = esprit.raw.Connection(app.config.get("ELASTIC_SEARCH_HOST"), app.config.get("ELASTIC_SEARCH_DB"))
+        self.conn = esprit.raw.Connection(config.get("ELASTIC_SEARCH_HOST"), config.get("ELASTIC_SEARCH_DB"))
         self.index = "jobs"
+        self.log_index = "jobs_log"
         self.lookup_url = lookup_url
-        self.client = oag.OAGClient(lookup_url)
+        self.client = client if client is not None else make_client(lookup_url)
         self.verbose = verbose
         self.oag_throttle = oag_throttle
         self.callback = callback
+        self.compact_every = compact_every
+        self.lease_seconds = lease_seconds
+        self.multiplex_size = multiplex_size
+        self.worker_id = socket.gethostname() + ":" + str(os.getpid()) + ":" + uuid.uuid4().hex[:8]
+
+        # the ids of the log entries on top of the snapshot of each job we have loaded or saved
+        self.log_ids = {}
+
+        # the document version of each job we hold the lease on, and a lock so that renewing the leases does
+        # not change the version between a save reading it and writing
+        self.versions = {}
+        self._lease_lock = threading.RLock()
+
+        # where to record the results we get, and to check for existing ones when making jobs
+        self.doi_index = doi_index if doi_index is not None else ESDOIIndex.from_config(self.conn)
 
     @classmethod
     def make_job(cls, state):
+        """
+        Save the state as a new job, less any identifiers which already have a fresh result in the DOI index.
+        Returns the job id, or None if there was nothing left to look up
+        """
         r = JobRunner(None)
+        if r.doi_index is not None:
+            before = len(state.pending)
+            r.doi_index.prune(state)
+            if len(state.pending) < before:
+                print before - len(state.pending), "DOIs already have a recent result"
+        if len(state.pending) == 0:
+            print "No DOIs left to look up; not creating job"
+            return None
         r.save_job(state)
+        return state.id
 
-    def has_due(self):
+    def has_due(self, chunk_size=10):
+        """
+        Yield (state, n, of) for each job which is due, soonest first.  The due ids come from a single query
+        against the job summaries, and the jobs themselves are fetched chunk_size at a time as the generator
+        is consumed, so that each is fresh when it is processed and only one chunk is in memory at once
+        """
         now = datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
         query = {
             "query" : {
-                "bool" : {
-                    "must" : [
-                        {
-                            "range" : {
-                                "pending.due" : {
-                                    "lte" : now
+                "filtered" : {
+                    "query" : {"match_all" : {}},
+                    "filter" : {
+                        "bool" : {
+                            "must" : [
+                                {"range" : {"start" : {"lte" : now}}},
+                                {
+                                    "bool" : {
+                                        "should" : [
+                                            {"missing" : {"field" : "lease_expires"}},
+                                            {"range" : {"lease_expires" : {"lte" : now}}}
+                                        ]
+                                    }
                                 }
-                            }
-                        },
-                        {
-                            "range" : {
-                                "start" : {
-                                    "lte" : now
+                            ],
+                            "should" : [
+                                {"range" : {"next_due" : {"lte" : now}}},
+                                # jobs saved before the summary was introduced have no next_due, so they are
+                                # taken as due if they are not finished; the first save gives them a summary
+                                {
+                                    "bool" : {
+                                        "must" : [
+                                            {"missing" : {"field" : "next_due"}}
+                                        ],
+                                        "must_not" : [
+                                            {"term" : {"status" : "finished"}}
+                                        ]
+                                    }
                                 }
-                            }
+                            ]
                         }
-                    ]
+                    }
                 }
             },
-            # FIXME: removed because of a bug in ES around date sorting
-            # "sort" : [{"pending.due" : {"order" : "asc", "mode" : "min"}}],
+            # sort on the top level summary, rather than the nested pending.due which ES cannot sort dates on.
+            # Jobs from before the summary go first, as we cannot tell how overdue they are
+            "sort" : [{"next_due" : {"order" : "asc", "missing" : "_first"}}],
             "fields" : ["id"],
             "size" : 10000
         }
 
         resp = esprit.raw.search(self.conn, self.index, query=query)
-        results = esprit.raw.unpack_result(resp)
+        ids = [res.get("id") for res in esprit.raw.unpack_result(resp)]
         counter = 0
-        for res in results:
-            id = res.get("id")
-            resp2 = esprit.raw.get(self.conn, self.index, id)
-            obj = esprit.raw.unpack_get(resp2)
-            state = oag.RequestState.from_json(obj)
-            counter += 1
-            yield state, counter, len(results)
+        for i in range(0, len(ids), chunk_size):
+            for state in self.load_jobs(ids[i:i + chunk_size], claim=True):
+                counter += 1
+                yield state, counter, len(ids)
+
+    def load_job(self, id, claim=False):
+        states = self.load_jobs([id], claim)
+        return states[0] if len(states) > 0 else None
+
+    def load_jobs(self, ids, claim=False):
+        """
+        Load the given jobs with one mget for the snapshots and one search for all of their log entries.  If
+        claim is True, only the jobs we manage to take the lease on are returned
+        """
+        resp = esprit.raw.mget(self.conn, self.index, ids)
+        docs = [d for d in oag.loads(resp.content).get("docs", []) if d.get("found", d.get("exists"))]
+        objs = [d.get("_source") for d in docs]
+        if claim:
+            objs = self._claim(objs, dict([(d.get("_id"), d.get("_version")) for d in docs]))
+        logs = self._get_logs(dict([(obj.get("id"), self._job_log_ids(obj)) for obj in objs]))
+        return [self._restore(obj, logs.get(obj.get("id"), [])) for obj in objs]
+
+    def _claim(self, objs, versions):
+        now = datetime.now()
+        free = [obj for obj in objs if self._lease_free(obj, now)]
+        if len(free) == 0:
+            return []
+        # anything we fail to take has been changed (most likely claimed) by another worker since we read it
+        with self._lease_lock:
+            claimed = self._take_leases([obj.get("id") for obj in free], versions)
+        return [obj for obj in free if obj.get("id") in claimed]
+
+    def renew_leases(self, ids):
+        """
+        Push back the expiry of our leases on the given jobs, so that a long cycle does not lose them.  If a
+        job has been taken over, the version we hold is kept, so that our next save raises LeaseLost
+        """
+        with self._lease_lock:
+            held = [id for id in ids if self.versions.get(id) is not None]
+            if len(held) > 0:
+                self._take_leases(held, dict(self.versions))
+
+    def _take_leases(self, ids, versions):
+        # set our lease on each job, conditional on the given versions, returning the ids we now hold
+        expires = (datetime.now() + timedelta(seconds=self.lease_seconds)).strftime(_timestamp_format)
+        lines = []
+        for id in ids:
+            lines.append(json.dumps({"update" : {"_id" : id, "_version" : versions.get(id)}}))
+            lines.append(json.dumps({"doc" : {"lease_owner" : self.worker_id, "lease_expires" : expires}}))
+        resp = esprit.raw.raw_bulk(self.conn, "\n".join(lines) + "\n", self.index)
+        if resp.status_code != 200:
+            return set()
+
+        taken = set()
+        for item in resp.json().get("items", []):
+            result = item.get("update", {})
+            if result.get("error") is None and result.get("status", 200) < 300:
+                taken.add(result.get("_id"))
+                self.versions[result.get("_id")] = result.get("_version")
+        return taken
+
+    def _keep_leases(self, ids):
+        """
+        Renew the leases on the given jobs in the background until the returned event is set
+        """
+        stop = threading.Event()
+        def renew():
+            while not stop.wait(self.lease_seconds / 3.0):
+                self.renew_leases(ids)
+        t = threading.Thread(target=renew)
+        t.daemon = True
+        t.start()
+        return stop
+
+    def _lease_free(self, obj, now):
+        if obj.get("lease_owner") in [None, self.worker_id] or obj.get("lease_expires") is None:
+            return True
+        return datetime.strptime(obj.get("lease_expires"), _timestamp_format) <= now
+
+    def _job_log_ids(self, obj):
+        # jobs saved before log entries had per-writer ids only have the number of entries
+        if obj.get("log_ids") is not None:
+            return obj.get("log_ids")
+        return [obj.get("id") + "." + str(n) for n in range(1, obj.get("log_seq", 0) + 1)]
+
+    def _get_logs(self, log_ids):
+        """
+        Fetch the log entries of each job with one mget.  Only the entries the job document lists are part of
+        its state (not, for example, one written by a runner which then lost its lease), in the order listed
+        """
+        wanted = [id for ids in log_ids.values() for id in ids]
+        if len(wanted) == 0:
+            return {}
+        resp = esprit.raw.mget(self.conn, self.log_index, wanted)
+        entries = dict([(entry.get("id"), entry) for entry in esprit.raw.unpack_mget(resp) if entry is not None])
+        logs = {}
+        for job, ids in log_ids.iteritems():
+            logs[job] = [entries[id] for id in ids if id in entries]
+        return logs
+
+    def _restore(self, obj, log):
+        state = oag.RequestState.from_json(obj)
+        for entry in log:
+            state.apply_changes(entry.get("changes", {}))
+        state.clear_changes()
+        self.log_ids[state.id] = self._job_log_ids(obj)
+        return state
 
     def job_statuses(self):
         query = {
@@ -78,21 +322,142 @@ class JobRunner(object):
     def save_job(self, state):
         print "Saving state to ElasticSearch ...",
         sys.stdout.flush()
-        j = state.json()
+        log_ids = self.log_ids.get(state.id)
+        if self.doi_index is not None:
+            self.doi_index.record(state.changes())
+        try:
+            if log_ids is None or len(log_ids) >= self.compact_every or not self._save_changes(state, log_ids):
+                self._save_snapshot(state, log_ids)
+            print "Complete"
+        except LeaseLost:
+            print "Lost the lease on job " + state.id + "; another worker has taken it over"
+        state.clear_changes()
+
+    def _summary(self, state):
+        # saving a job also releases our lease on it
         is_finished = state.finished()
-        j["status"] = "finished" if is_finished else "active"
-        esprit.raw.store(self.conn, self.index, j, j.get("id"))
-        print "Complete"
+        next = state.next_due() if not is_finished else None
+        return {
+            "status" : "finished" if is_finished else "active",
+            "lease_owner" : None,
+            "lease_expires" : None,
+            "next_due" : next.strftime(_timestamp_format) if next is not None else None,
+            "batch_size" : state.batch_size,
+            "counts" : {
+                "success" : len(state.success),
+                "error" : len(state.error),
+                "pending" : len(state.pending)
+            }
+        }
+
+    def _save_snapshot(self, state, old_ids=None):
+        j = state.json()
+        j.update(self._summary(state))
+        j["log_seq"] = 0
+        j["log_ids"] = []
+        # a new job has no version, as nobody else can have claimed it yet
+        self._versioned(state.id, "index", j)
+        self.log_ids[state.id] = []
+
+        # the log entries are now contained in the snapshot.  If we fail to delete them they are harmless, as
+        # only the entries listed in the job document are replayed
+        if old_ids:
+            self._delete_log(old_ids)
+
+    def _save_changes(self, state, log_ids):
+        seq = len(log_ids) + 1
+        entry_id = state.id + "." + str(seq) + "." + self.worker_id
+        entry = {"id" : entry_id, "job" : state.id, "seq" : seq, "writer" : self.worker_id, "changes" : state.changes()}
+        resp = esprit.raw.store(self.conn, self.log_index, entry, entry_id)
+        if resp.status_code >= 300:
+            return False
+
+        summary = self._summary(state)
+        summary["log_seq"] = seq
+        summary["log_ids"] = log_ids + [entry_id]
+        try:
+            if not self._versioned(state.id, "update", {"doc" : summary}):
+                return False
+        except LeaseLost:
+            # the job does not list our entry, so nobody will replay it
+            self._delete_log([entry_id])
+            raise
+
+        self.log_ids[state.id] = summary["log_ids"]
+        return True
+
+    def _delete_log(self, ids):
+        lines = [json.dumps({"delete" : {"_type" : self.log_index, "_id" : id}}) for id in ids]
+        esprit.raw.raw_bulk(self.conn, "\n".join(lines) + "\n")
+
+    def _versioned(self, id, action, body):
+        """
+        Write to the job document, conditional on it being the version we last saw (if any).  Raises LeaseLost
+        on a version conflict, and returns False if the write fails for any other reason
+        """
+        with self._lease_lock:
+            meta = {"_id" : id}
+            if self.versions.get(id) is not None:
+                meta["_version"] = self.versions.get(id)
+            lines = [json.dumps({action : meta}), oag.dumps(body)]
+            resp = esprit.raw.raw_bulk(self.conn, "\n".join(lines) + "\n", self.index)
+            if resp.status_code != 200:
+                return False
+            result = resp.json().get("items", [{}])[0].get(action, {})
+            if result.get("status") == 409:
+                self.versions.pop(id, None)
+                raise LeaseLost(id)
+            if result.get("error") is not None:
+                return False
+
+            # the save released the lease, so we will need a fresh claim (and version) to write again
+            self.versions.pop(id, None)
+            return True
 
     def cycle_state(self, state):
+        self._start_cycle(state)
+
+        # issue the cycle request
+        renewing = self._keep_leases([state.id])
+        try:
+            self.client.cycle(state, self.oag_throttle, self.verbose)
+        finally:
+            renewing.set()
+        self._finish_cycle(state)
+
+    def cycle_states(self, states):
+        """
+        Run a cycle of each of the states at once through an AsyncOAGClient, then finish each one as it
+        completes.  If any of the cycles fail, the first failure is raised once the rest are finished
+        """
+        cycles = []
+        renewing = self._keep_leases([state.id for state in states])
+        for state in states:
+            self._start_cycle(state)
+            cycles.append(self.client.submit(state, self.verbose))
+        failure = None
+        try:
+            for state, cycle in zip(states, cycles):
+                try:
+                    cycle.wait()
+                except Exception:
+                    if failure is None:
+                        failure = sys.exc_info()
+                    continue
+                self._finish_cycle(state)
+        finally:
+            renewing.set()
+        if failure is not None:
+            raise failure[0], failure[1], failure[2]
+
+    def _start_cycle(self, state):
         if self.verbose:
             now = datetime.now()
             print now.strftime("%Y-%m-%d %H:%M:%S") + " Processing job " + state.id
             print state.print_parameters()
             print state.print_status_report()
 
-        # issue the cycle request
-        self.client.cycle(state, self.oag_throttle, self.verbose)
+    def _finish_cycle(self, state):
         if self.verbose:
             print state.print_status_report()
 
@@ -121,15 +486,7 @@ class JobRunner(object):
         col_counter = 0
         while True:
             time.sleep(self.es_throttle)
-            states = self.has_due()
-            found = False
-            for state, n, of in states:
-                found = True
-                col_counter = 0
-                print ""
-                print "Processing", n, "of", of, "in this round of jobs\n"
-                self.cycle_state(state)
-            if not found:
+            if not self.run_round():
                 print ".",
                 sys.stdout.flush()
                 col_counter += 1
@@ -137,52 +494,153 @@ class JobRunner(object):
                     print ""
                     col_counter = 0
             else:
+                col_counter = 0
                 print "Job Statuses"
                 self.print_job_statuses()
 
-def doaj_closure():
+    def run_round(self):
+        """
+        Run a cycle of each job which is due, returning whether there were any
+        """
+        found = False
+        if isinstance(self.client, oag.AsyncOAGClient):
+            # take on the due jobs multiplex_size at a time, so that each chunk is loaded and claimed only
+            # when we are ready to start its cycles
+            states = []
+            for state, n, of in self.has_due(chunk_size=self.multiplex_size):
+                states.append(state)
+                if len(states) < self.multiplex_size and n < of:
+                    continue
+                found = True
+                print ""
+                print "Processing", n - len(states) + 1, "to", n, "of", of, "in this round of jobs together\n"
+                self.cycle_states(states)
+                states = []
+            # some of the jobs may have been claimed by another runner, leaving the last chunk short
+            if len(states) > 0:
+                found = True
+                self.cycle_states(states)
+        else:
+            # claim each job only as it is about to run, as the leases of jobs waiting their turn would not be
+            # renewed
+            for state, n, of in self.has_due(chunk_size=1):
+                found = True
+                print ""
+                print "Processing", n, "of", of, "in this round of jobs\n"
+                self.cycle_state(state)
+        return found
+
+def doaj_closure(page_size=1000, bulk_size=500, skip_unchanged=True):
+    """
+    Make a callback which writes the licences found for a job back to the DOAJ articles with those DOIs.
+
+    Only the licence fragment is sent, as a partial update, so concurrent edits to the rest of the article
+    are preserved.  With skip_unchanged, articles whose current licence hashes the same as the new one are
+    not written at all
+    """
 
-    conn = esprit.raw.Connection(app.config.get("ELASTIC_SEARCH_HOST"), app.config.get("ELASTIC_SEARCH_DB"))
+    conn = esprit.raw.Connection(config.get("ELASTIC_SEARCH_HOST"), config.get("ELASTIC_SEARCH_DB"))
+    # only the errors are written out locally; the successes go to DOAJ
+    error_log = output.ResultWriter(config.get("OAG_ERROR_FILE", "oag_error.csv"),
+                                    format=config.get("OAG_ERROR_FORMAT", "csv"),
+                                    compress=config.get("OAG_ERROR_COMPRESS", False),
+                                    max_bytes=config.get("OAG_ERROR_MAX_BYTES"))
 
-    def get_by_doi(doi):
+    def get_by_dois(dois):
+        """
+        Locate the DOAJ articles carrying any of the given DOIs with a single terms query (paged only if there
+        are more matches than fit on a page).  Returns a dict of doi to the list of matching articles
+        """
+        wanted = set(dois)
+        found = {}
         query = {
             "query" : {
-                "term" : {
-                    "bibjson.identifier.id.exact" : doi
+                "terms" : {
+                    "bibjson.identifier.id.exact" : list(wanted)
                 }
-            }
+            },
+            "_source" : ["id", "bibjson.identifier", "bibjson.license"] if skip_unchanged else ["id", "bibjson.identifier"],
+            "size" : page_size,
+            "from" : 0
         }
-        resp = esprit.raw.search(conn, "article", query=query)
-        res = esprit.raw.unpack_result(resp)
-        return res
+        while True:
+            resp = esprit.raw.search(conn, "article", query=query)
+            res = esprit.raw.unpack_result(resp)
+            for r in res:
+                for ident in r.get("bibjson", {}).get("identifier", []):
+                    if ident.get("id") in wanted:
+                        found.setdefault(ident.get("id"), []).append(r)
+            if len(res) < page_size:
+                break
+            query["from"] += page_size
+        return found
+
+    def write_licences(licences):
+        """
+        Set bibjson.license on each of the articles in the dict of article id to licence, as partial updates
+        through the bulk API.  Returns the number of articles which could not be updated
+        """
+        failed = 0
+        ids = licences.keys()
+        for i in range(0, len(ids), bulk_size):
+            chunk = ids[i:i + bulk_size]
+            lines = []
+            for id in chunk:
+                lines.append(json.dumps({"update" : {"_id" : id, "_retry_on_conflict" : 3}}))
+                lines.append(json.dumps({"doc" : {"bibjson" : {"license" : licences[id]}}, "detect_noop" : True}))
+            resp = esprit.raw.raw_bulk(conn, "\n".join(lines) + "\n", "article")
+            failed += _bulk_failures(resp, len(chunk))
+        return failed
 
     def doaj_callback(state):
         success = state.flush_success()
         if len(success) > 0:
             print "Writing", len(success), "detected licences to DOAJ ..."
+
+        # first work out the licence for each doi
+        licences = {}
         for s in success:
-            # first locate the id of the doaj object to be updated
-            doajobjs = []
             identifier = None
             for i in s.get("identifier", [{}]):
                 if i.get("type") == "doi":
                     identifier = i.get("id")
-                    doajobjs = get_by_doi(i.get("id"))
                     break
-            if len(doajobjs) == 0:
+            if identifier is None:
                 print "Unable to trace DOAJ item to write to", identifier
                 continue
+            licences[identifier] = s.get("license")
 
-            # add the licence information to every record we get back
-            for doajobj in doajobjs:
+        # then locate all the doaj objects to be updated in one go
+        doajobjs = get_by_dois(licences.keys()) if len(licences) > 0 else {}
+
+        # add the licence information to every record we get back
+        updates = {}
+        unchanged = 0
+        for doi, licence in licences.iteritems():
+            if len(doajobjs.get(doi, [])) == 0:
+                print "Unable to trace DOAJ item to write to", doi
+                continue
+            digest = _licence_hash(licence)
+            for doajobj in doajobjs[doi]:
                 bibjson = doajobj.get("bibjson")
                 if bibjson is None:
                     print "no bibjson record"
                     continue
-                bibjson["license"] = s.get("license")
+                if skip_unchanged and _licence_hash(bibjson.get("license")) == digest:
+                    unchanged += 1
+                    continue
+                updates[doajobj.get("id")] = licence
 
-                # now save the record
-                esprit.raw.store(conn, "article", doajobj, doajobj.get("id"))
+        if unchanged > 0:
+            print "Skipping", unchanged, "DOAJ records whose licence has not changed"
+
+        # now save the records
+        if len(updates) > 0:
+            failed = write_licences(updates)
+            if failed > 0:
+                print failed, "of", len(updates), "DOAJ records could not be updated"
+            # cached searches may now be out of date
+            querycache.invalidate(config.get("QUERY_CACHE_GENERATION_FILE"))
 
         if len(success) > 0:
             print "Finished writing to DOAJ"
@@ -191,19 +649,64 @@ def doaj_closure():
         if len(errors) > 0:
             print "Writing", len(errors), "errors to CSV ...",
             sys.stdout.flush()
-        with open("oag_error.csv", "a") as f:
-            writer = csv.writer(f)
-            for e in errors:
-                identifier = e.get("identifier", [{}]).get("id")
-                msg = e.get("error")
-                csv_row = [identifier, msg]
-                clean_row = [unicode(c).encode("utf8", "replace") if c is not None else "" for c in csv_row]
-                writer.writerow(clean_row)
+        error_log.write(errors if error_log.format == "jsonl" else [output.error_row(e) for e in errors])
+        error_log.flush()
         if len(success) > 0:
             print "Complete"
 
+    doaj_callback.close = error_log.close
     return doaj_callback
 
+def _licence_hash(licence):
+    if licence is None:
+        return None
+    return hashlib.sha1(json.dumps(licence, sort_keys=True)).hexdigest()
+
+def _bulk_failures(resp, count):
+    """
+    Report each item which failed in a bulk request, returning the number of failures
+    """
+    if resp.status_code != 200:
+        print "Bulk request failed with status", resp.status_code, resp.text
+        return count
+    failed = 0
+    for item in resp.json().get("items", []):
+        for action, result in item.iteritems():
+            if result.get("error") is not None or result.get("status", 200) >= 300:
+                print "Unable to", action, "DOAJ record", result.get("_id"), "-", result.get("error")
+                failed += 1
+    return failed
+
+def run_workers(count, lookup_url):
+    """
+    Run the given number of JobRunners, each in its own process, sharing the due jobs between them
+    """
+    workers = [multiprocessing.Process(target=_run_worker, args=(lookup_url,)) for i in range(count)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+def _run_worker(lookup_url):
+    callback = doaj_closure()
+    if config.get("OAG_STREAM_RESULTS", False):
+        # write the licences back batch by batch as the lookups come in, rather than after each whole cycle
+        sink = oag.StreamingSink(callback, max_batches=config.get("OAG_SINK_QUEUE_SIZE", 4))
+        runner = JobRunner(lookup_url, client=make_client(lookup_url, sink=sink), multiplex_size=config.get("OAG_MULTIPLEX_SIZE", 10))
+    else:
+        runner = JobRunner(lookup_url, callback=callback, multiplex_size=config.get("OAG_MULTIPLEX_SIZE", 10))
+    try:
+        runner.run()
+    finally:
+        callback.close()
+
 if __name__ == "__main__":
-    runner = JobRunner(app.config.get("OAG_LOOKUP_URL"), callback=doaj_closure())
-    runner.run()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-w", "--workers", type=int, default=config.get("OAG_WORKERS", 1),
+                        help="number of worker processes to run on this host")
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        run_workers(args.workers, config.get("OAG_LOOKUP_URL"))
+    else:
+        _run_worker(config.get("OAG_LOOKUP_URL"))
\ No newline at end of file
@@ -0,0 +1,162 @@
+"""
+Long-lived output files for lookup results, which stay open between callbacks rather than being reopened for
+every batch, with buffered writes, periodic fsync, rotation by size or age, and optional gzip.
+
+    callback = output.ResultCallback("oag_success.jsonl", "oag_error.jsonl", format="jsonl", compress=True)
+    ...
+    callback.close()
+"""
+import os, csv, json, gzip, time
+from datetime import datetime
+
+FORMATS = ["csv", "jsonl"]
+
+class ResultWriter(object):
+    """
+    Appends records to one file: rows (lists of cells) as CSV, or objects as JSON lines.
+
+    buffer_size - bytes to buffer before writing to the OS.  Call flush() at the end of each batch of writes
+        (as ResultCallback does) so that nothing is left in the buffer while the writer is idle
+    fsync_interval - seconds between fsyncs, so that no more than that much output is lost in a crash
+    max_bytes, max_age - once the file is this big, or this many seconds old, it is moved aside (to the path
+        with a timestamp before the extension) and a new one started
+    compress - gzip the output; the path should end in .gz
+    """
+    def __init__(self, path, format="csv", compress=False, buffer_size=64 * 1024, fsync_interval=60, max_bytes=None, max_age=None):
+        if format not in FORMATS:
+            raise ValueError("format must be one of " + ", ".join(FORMATS))
+        self.path = path
+        self.format = format
+        self.compress = compress
+        self.buffer_size = buffer_size
+        self.fsync_interval = fsync_interval
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._raw = None
+        self._file = None
+        self._writer = None
+        self._opened = None
+        self._synced = None
+
+    def write(self, records):
+        if len(records) == 0:
+            return
+        if self._file is None:
+            self._open()
+        if self.format == "csv":
+            self._writer.writerows(records)
+        else:
+            self._file.writelines([json.dumps(r) + "\n" for r in records])
+
+        now = time.time()
+        if self._should_rotate(now):
+            self.rotate()
+        elif self.fsync_interval is not None and now - self._synced >= self.fsync_interval:
+            self.sync()
+
+    def flush(self):
+        """
+        Hand everything written so far to the OS (finishing the current gzip block), and fsync it if the
+        fsync_interval is up
+        """
+        if self._file is None:
+            return
+        if self.fsync_interval is not None and time.time() - self._synced >= self.fsync_interval:
+            self.sync()
+            return
+        self._file.flush()
+        if self._raw is not self._file:
+            self._raw.flush()
+
+    def sync(self):
+        if self._file is None:
+            return
+        self._file.flush()
+        if self._raw is not self._file:
+            self._raw.flush()
+        os.fsync(self._raw.fileno())
+        self._synced = time.time()
+
+    def rotate(self):
+        """
+        Close the current file and move it aside, so that the next write starts a new one
+        """
+        if self._file is None:
+            return
+        self.close()
+        root, ext = os.path.splitext(self.path)
+        if ext == ".gz":
+            root, inner = os.path.splitext(root)
+            ext = inner + ext
+        stamp = root + "." + datetime.now().strftime("%Y%m%dT%H%M%S")
+        # don't overwrite a file rotated within the same second
+        target, n = stamp + ext, 0
+        while os.path.exists(target):
+            n += 1
+            target = stamp + "-" + str(n) + ext
+        os.rename(self.path, target)
+
+    def close(self):
+        if self._file is None:
+            return
+        self.sync()
+        self._file.close()
+        if self._raw is not self._file:
+            self._raw.close()
+        self._raw = self._file = self._writer = None
+
+    def _open(self):
+        self._raw = open(self.path, "ab", self.buffer_size)
+        self._file = gzip.GzipFile(fileobj=self._raw, mode="ab") if self.compress else self._raw
+        if self.format == "csv":
+            self._writer = csv.writer(self._file)
+        self._opened = self._synced = time.time()
+
+    def _should_rotate(self, now):
+        if self.max_age is not None and now - self._opened >= self.max_age:
+            return True
+        # the size of the file as written so far (for gzip, compressed, less what the compressor holds back)
+        return self.max_bytes is not None and self._raw.tell() >= self.max_bytes
+
+def _cell(value):
+    if value is None:
+        return ""
+    if isinstance(value, unicode):
+        return value.encode("utf8", "replace")
+    return value if isinstance(value, str) else str(value)
+
+def success_row(s):
+    return [_cell(s.get("identifier", [{}])[0].get("id")), _cell(s.get("license", [{}])[0].get("title"))]
+
+def error_row(e):
+    return [_cell(e.get("identifier", {}).get("id")), _cell(e.get("error"))]
+
+class ResultCallback(object):
+    """
+    A callback for oag.Scheduler, oagr.JobRunner or oag.StreamingSink which writes the successes and errors
+    flushed from the state to a pair of ResultWriters.  As CSV, each success is the identifier and licence
+    title, and each error the identifier and message; as JSON lines, the whole of each result is kept
+    """
+    def __init__(self, success_file, error_file, format="csv", **kwargs):
+        self.format = format
+        self.success = ResultWriter(success_file, format=format, **kwargs)
+        self.error = ResultWriter(error_file, format=format, **kwargs)
+
+    def __call__(self, state):
+        self.write_success(state.flush_success())
+        self.write_error(state.flush_error())
+        self.flush()
+
+    def write_success(self, successes):
+        self.success.write(successes if self.format == "jsonl" else [success_row(s) for s in successes])
+
+    def write_error(self, errors):
+        self.error.write(errors if self.format == "jsonl" else [error_row(e) for e in errors])
+
+    def flush(self):
+        self.success.flush()
+        self.error.flush()
+
+    def close(self):
+        self.success.close()
+        self.error.close()
@@ -3,7 +3,7 @@ from flask import Flask, request, abort, render_template, redirect, make_respons
 from flask.views import View
 
 import portality.models as models
-from portality.core import app
+from portality.core import app, initialise_index
 from portality import settings
 
 from portality.view.query import blueprint as query
@@ -19,5 +19,7 @@ def page_not_found(e):
 
 
 if __name__ == "__main__":
+    if app.config.get("INITIALISE_INDEX", False):
+        initialise_index(app)
     app.run(host=app.config.get("HOST", "0.0.0.0"), debug=app.config['DEBUG'], port=app.config['PORT'])
 
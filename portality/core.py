@@ -1,30 +1,67 @@
-import os, requests, json, esprit
-from flask import Flask
+"""
+The app's configuration and the Flask app itself.
+
+Importing this module only loads the configuration, so that scripts which need nothing else (such as oagr and
+dois) start quickly and do not touch the index:
+
+    from portality.core import config
+
+The Flask app is built the first time anything on core.app is used, and the index is created and mapped
+only when asked, with initialise_index() (see portality/initialise.py).
+"""
+import os, threading
 from functools import wraps
 from urllib import unquote
 
-from flask import request, redirect, url_for, flash
 from portality import settings
 
+class Config(dict):
+    """
+    The upper case settings from the settings module and the app.cfg file, loaded as flask.Config would
+    """
+    def from_object(self, obj):
+        for key in dir(obj):
+            if key.isupper():
+                self[key] = getattr(obj, key)
+
+    def from_pyfile(self, filename):
+        d = type(os)("config")
+        d.__file__ = filename
+        execfile(filename, d.__dict__)
+        self.from_object(d)
+
+def load_config():
+    config = Config()
+    config.from_object(settings)
+    # parent directory
+    here = os.path.dirname(os.path.abspath( __file__ ))
+    config_path = os.path.join(os.path.dirname(here), 'app.cfg')
+    if os.path.exists(config_path):
+        config.from_pyfile(config_path)
+    return config
+
+config = load_config()
+
 def create_app():
+    from flask import Flask
     app = Flask(__name__)
     configure_app(app)
-    if app.config.get('INITIALISE_INDEX',False): initialise_index(app)
     setup_jinja(app)
     setup_error_email(app)
     return app
 
 def configure_app(app):
-    app.config.from_object(settings)
-    # parent directory
-    here = os.path.dirname(os.path.abspath( __file__ ))
-    config_path = os.path.join(os.path.dirname(here), 'app.cfg')
-    if os.path.exists(config_path):
-        app.config.from_pyfile(config_path)
+    app.config.update(config)
 
-def initialise_index(app):
-    mappings = app.config["MAPPINGS"]
-    conn = esprit.raw.Connection(app.config['ELASTIC_SEARCH_HOST'], app.config['ELASTIC_SEARCH_DB'])
+def initialise_index(app=None):
+    """
+    Create the index and put any missing mappings.  This is no longer done when the app starts; run
+    portality/initialise.py (or the app directly, with INITIALISE_INDEX set) instead
+    """
+    import esprit
+    cfg = app.config if app is not None else config
+    mappings = cfg["MAPPINGS"]
+    conn = esprit.raw.Connection(cfg['ELASTIC_SEARCH_HOST'], cfg['ELASTIC_SEARCH_DB'])
     if not esprit.raw.index_exists(conn):
         print "Creating Index; host:" + str(conn.host) + " port:" + str(conn.port) + " db:" + str(conn.index)
         esprit.raw.create_index(conn)
@@ -59,13 +96,39 @@ def setup_jinja(app):
         return ''
     app.jinja_env.filters['debug']=jinja_debug
 
-app = create_app()
+class LazyApp(object):
+    """
+    Stands in for the Flask app, building it with create_app the first time it is used
+    """
+    def __init__(self, factory):
+        self.__dict__["_factory"] = factory
+        self.__dict__["_app"] = None
+        self.__dict__["_lock"] = threading.Lock()
+
+    def get_app(self):
+        if self._app is None:
+            with self._lock:
+                if self._app is None:
+                    self.__dict__["_app"] = self._factory()
+        return self._app
+
+    def __getattr__(self, name):
+        return getattr(self.get_app(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.get_app(), name, value)
+
+    def __call__(self, environ, start_response):
+        return self.get_app()(environ, start_response)
+
+app = LazyApp(create_app)
 
 # a decorator to be used elsewhere (or in this file) in the app,
 # anywhere where a view f() should be served only over SSL
 def ssl_required(fn):
     @wraps(fn)
     def decorated_view(*args, **kwargs):
+        from flask import request, redirect
         if app.config.get("SSL"):
             if request.is_secure:
                 return fn(*args, **kwargs)
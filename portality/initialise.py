@@ -0,0 +1,11 @@
+"""
+Create the index and put the mappings in MAPPINGS which it does not have yet.  Run this once when setting up
+a new index, or after adding a mapping:
+
+    python portality/initialise.py
+"""
+from portality.core import config, initialise_index
+
+if __name__ == "__main__":
+    print "Initialising index " + config.get("ELASTIC_SEARCH_DB") + " at " + config.get("ELASTIC_SEARCH_HOST")
+    initialise_index()
@@ -1,5 +1,5 @@
 import smtplib, os
-from portality.core import app
+from portality.core import config
 
 from email.MIMEMultipart import MIMEMultipart
 from email.MIMEBase import MIMEBase
@@ -28,10 +28,10 @@ def send_mail(to, fro, subject, text, files=[], server="localhost"):
         msg.attach(part)
 
     # now deal with connecting to the server
-    server = app.config.get("SMTP_SERVER")
-    server_port = app.config.get("SMTP_PORT")
-    smtp_user = app.config.get("SMTP_USER")
-    smtp_pass = app.config.get("SMTP_PASS")
+    server = config.get("SMTP_SERVER")
+    server_port = config.get("SMTP_PORT")
+    smtp_user = config.get("SMTP_USER")
+    smtp_pass = config.get("SMTP_PASS")
 
     smtp = smtplib.SMTP()  # just doing SMTP(server, server_port) does not work with Mailtrap
     # but doing .connect explicitly afterwards works both with Mailtrap and with Mandrill
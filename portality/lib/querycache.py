@@ -0,0 +1,89 @@
+"""
+An in-memory cache of query pass-through responses, so that the same search (e.g. the facet counts the search
+page asks for on every load) is only sent to the index once in a while.
+
+Entries expire after a TTL, and the least recently used are dropped beyond max_entries.  Anything which
+changes the index can empty every process's cache by calling invalidate() with the shared generation file:
+each cache looks at the file's modification time (at most once a second), and starts again when it moves.
+"""
+import os, json, time, hashlib, threading
+from collections import OrderedDict
+
+def invalidate(generation_file):
+    """
+    Tell every QueryCache sharing the generation file that the index has changed
+    """
+    if generation_file is None:
+        return
+    with open(generation_file, "w") as f:
+        f.write(repr(time.time()))
+    # make sure the modification time moves, even within the filesystem's timestamp resolution
+    now = time.time()
+    os.utime(generation_file, (now, now))
+
+class QueryCache(object):
+    def __init__(self, max_entries=1000, ttl=300, generation_file=None, check_every=1):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.generation_file = generation_file
+        self.check_every = check_every
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = self._read_generation()
+        self._checked = time.time()
+
+    @classmethod
+    def key(cls, *parts):
+        """
+        A key for a request made up of the given parts (e.g. the model path, query and filter terms), which is
+        the same however the keys of the query objects are ordered
+        """
+        return hashlib.sha1(json.dumps(parts, sort_keys=True, separators=(",", ":"))).hexdigest()
+
+    def get(self, key):
+        """
+        The (body, etag) cached for the key, or None
+        """
+        self._check_generation()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            if entry[2] <= time.time():
+                return None
+            # put it back at the most recently used end
+            self._entries[key] = entry
+            return entry[0], entry[1]
+
+    def put(self, key, body):
+        """
+        Cache the response body for the key, returning its etag
+        """
+        etag = hashlib.sha1(body).hexdigest()
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (body, etag, time.time() + self.ttl)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return etag
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _read_generation(self):
+        if self.generation_file is None:
+            return None
+        try:
+            return os.stat(self.generation_file).st_mtime
+        except OSError:
+            return None
+
+    def _check_generation(self):
+        if self.generation_file is None or time.time() - self._checked < self.check_every:
+            return
+        self._checked = time.time()
+        generation = self._read_generation()
+        if generation != self._generation:
+            self._generation = generation
+            self.clear()
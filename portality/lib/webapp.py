@@ -1,4 +1,4 @@
-import re
+import re, zlib
 from unicodedata import normalize
 from functools import wraps
 from flask import request, current_app, flash
@@ -18,11 +18,45 @@ def jsonp(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         callback = request.args.get('callback', False)
-        if callback:
-            content = str(callback) + '(' + str(f(*args,**kwargs).data) + ')'
-            return current_app.response_class(content, mimetype='application/javascript')
-        else:
-            return f(*args, **kwargs)
+        resp = f(*args, **kwargs)
+        if not callback:
+            return resp
+        # pass the body through chunk by chunk, rather than copying it into a new string, as it may be
+        # streaming from upstream
+        def wrapped(body):
+            yield str(callback) + '('
+            for chunk in body:
+                yield chunk
+            yield ')'
+        return current_app.response_class(wrapped(resp.response), status=resp.status_code, mimetype='application/javascript')
+    return decorated_function
+
+def gzip_chunks(chunks, level=6):
+    """Gzip an iterable of strings as it goes"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        out = compressor.compress(chunk)
+        if out:
+            yield out
+    yield compressor.flush()
+
+def gzipped(f):
+    """Gzips the response body for clients which accept it, streaming it if it is streamed"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        resp = f(*args, **kwargs)
+        if resp.status_code != 200 or 'gzip' not in request.accept_encodings or 'Content-Encoding' in resp.headers:
+            return resp
+        resp.response = gzip_chunks(resp.response)
+        resp.headers['Content-Encoding'] = 'gzip'
+        resp.headers.add('Vary', 'Accept-Encoding')
+        # the gzipped body is not byte for byte the version a strong etag describes
+        etag, weak = resp.get_etag()
+        if etag is not None and not weak:
+            resp.set_etag(etag, weak=True)
+        # the length is not known until the body has been sent
+        resp.headers.pop('Content-Length', None)
+        return resp
     return decorated_function
 
 
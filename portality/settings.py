@@ -7,6 +7,79 @@ from esprit import mappings
 # FIXME: need to sort out how portentious is going to do config
 OAG_LOOKUP_URL = 'http://howopenisit.org/lookup/'
 
+# number of batches to have in flight to the lookup service at once
+OAG_CONCURRENCY = 1
+
+# run the cycles of a round's due jobs together, OAG_MULTIPLEX_SIZE jobs at a time, sharing the
+# OAG_CONCURRENCY worker threads and the rate limit between them, rather than one job at a time
+OAG_MULTIPLEX_JOBS = False
+OAG_MULTIPLEX_SIZE = 10
+
+# the most batch requests per second to send to the lookup service, across all workers (None for no limit).
+# With OAG_CONCURRENCY above 1 this is the only limit: the throttle between batches only applies to one at a time
+OAG_REQUESTS_PER_SECOND = None
+
+# number of keep-alive connections to pool to the lookup service (None for enough to cover OAG_CONCURRENCY)
+OAG_POOL_SIZE = None
+
+# seconds to wait for the lookup service to respond to a batch (None to wait indefinitely)
+OAG_TIMEOUT = 300
+
+# gzip the batches sent to the lookup service, and ask for gzipped responses
+OAG_COMPRESS = False
+
+# how many times to retry a failed batch, and the longest (jittered, exponential) wait between retries in seconds
+OAG_MAX_RETRIES = 10
+OAG_RETRY_CAP = 60
+
+# total retries allowed across all the batches in one cycle of a job (None for no limit beyond OAG_MAX_RETRIES)
+OAG_JOB_RETRY_BUDGET = 50
+
+# adapt each job's batch size to the lookup service's response times, growing batches while they are
+# answered within the target latency (seconds) and shrinking them on timeouts and server errors
+OAG_ADAPTIVE_BATCH_SIZE = False
+OAG_TARGET_LATENCY = 10
+OAG_MIN_BATCH_SIZE = 10
+OAG_MAX_BATCH_SIZE = 1000
+
+# number of job runner processes for oagr to start on this host.  Runners on any number of hosts can share
+# the jobs index, as each claims a job through an expiring lease before working on it
+OAG_WORKERS = 1
+
+# a local SQLite cache of lookup results, consulted before going to the lookup service (None to disable).
+# Successes are kept for OAG_CACHE_TTL seconds and errors for OAG_CACHE_ERROR_TTL, up to OAG_CACHE_MAX_ENTRIES
+OAG_CACHE_PATH = None
+OAG_CACHE_TTL = 30 * 24 * 60 * 60
+OAG_CACHE_ERROR_TTL = 24 * 60 * 60
+OAG_CACHE_MAX_ENTRIES = 1000000
+
+# write the results back to DOAJ as each batch comes in, rather than once the job's whole cycle is done.  At
+# most OAG_SINK_QUEUE_SIZE batches wait to be written; beyond that the lookups are held up until they are
+OAG_STREAM_RESULTS = False
+OAG_SINK_QUEUE_SIZE = 4
+
+# where oagr writes the identifiers OAG could not give a result for: "csv" (identifier and message) or "jsonl"
+# (the whole error).  The file is moved aside and a new one started once it reaches OAG_ERROR_MAX_BYTES
+OAG_ERROR_FILE = "oag_error.csv"
+OAG_ERROR_FORMAT = "csv"
+OAG_ERROR_COMPRESS = False
+OAG_ERROR_MAX_BYTES = None
+
+# doajclone and clone2server: the number of slices of the source to copy at once, and the size of each _bulk
+# request to the target
+CLONE_SLICES = 8
+CLONE_BULK_BYTES = 5 * 1024 * 1024
+
+# where the incremental (--incremental) runs of dois, doajclone and clone2server record the last_updated of the
+# latest change they have seen from each source
+HIGH_WATER_FILE = "high_water.json"
+
+# keep an index of the DOIs we have OAG results for, and leave them out of new jobs until the result is
+# older than the staleness (seconds; None to trust results forever).  Errors go stale sooner
+DOI_INDEX = False
+DOI_INDEX_STALENESS = 30 * 24 * 60 * 60
+DOI_INDEX_ERROR_STALENESS = 7 * 24 * 60 * 60
+
 # ========================
 # MAIN SETTINGS
 
@@ -30,7 +103,7 @@ SSL = False
 # elasticsearch settings
 ELASTIC_SEARCH_HOST = "http://localhost:9200" # remember the http:// or https://
 ELASTIC_SEARCH_DB = "doaj"
-INITIALISE_INDEX = True # whether or not to try creating the index and required index types on startup
+INITIALISE_INDEX = True # whether or not to try creating the index and required index types when the app is run directly (otherwise, see portality/initialise.py)
 
 # QUERY_ENDPOINT = "http://staging.doaj.cottagelabs.com/query/journal,article"
 # QUERY_ENDPOINT = "http://localhost:9200/doaj/article/_search"
@@ -66,19 +139,58 @@ MAPPINGS = {
             ]
         )
     ),
-    "jobs" : mappings.for_type(
-        "jobs",
-            mappings.dynamic_templates(
-            [
+    # the entries of a job are only ever loaded with it, never searched (polling uses the summary fields), and
+    # their timestamps are epoch seconds, so they are stored but not indexed
+    "jobs" : {
+        "jobs" : {
+            "dynamic_templates" : [
                 mappings.EXACT,
-            ]
-        )
-    )
+            ],
+            "properties" : {
+                "pending" : {"type" : "object", "enabled" : False},
+                "success" : {"type" : "object", "enabled" : False},
+                "error" : {"type" : "object", "enabled" : False}
+            }
+        }
+    },
+    "doi_index" : {
+        "doi_index" : {
+            "properties" : {
+                "id" : {"type" : "string", "index" : "not_analyzed"},
+                "status" : {"type" : "string", "index" : "not_analyzed"},
+                "found" : {"type" : "date"}
+            }
+        }
+    },
+    # the changes to each job since its last snapshot; only the job and sequence number need to be searchable
+    "jobs_log" : {
+        "jobs_log" : {
+            "properties" : {
+                "job" : {"type" : "string", "index" : "not_analyzed"},
+                "seq" : {"type" : "integer"},
+                "changes" : {"type" : "object", "enabled" : False}
+            }
+        }
+    }
 }
 
 # ========================
 # QUERY SETTINGS
 
+# cache query endpoint responses in memory, for up to QUERY_CACHE_TTL seconds and QUERY_CACHE_MAX_ENTRIES
+# responses.  oagr empties the cache of every app process on the host when it writes licences to the index, by
+# touching QUERY_CACHE_GENERATION_FILE.  It must be the same absolute path for every process, wherever it is
+# started from
+QUERY_CACHE = True
+QUERY_CACHE_TTL = 300
+QUERY_CACHE_MAX_ENTRIES = 1000
+QUERY_CACHE_GENERATION_FILE = os.path.join(BASE_FILE_PATH, "query_cache.generation")
+
+# searches asking for more than QUERY_STREAM_MIN_SIZE records are not cached, but streamed from the index to the
+# client QUERY_STREAM_CHUNK_SIZE bytes at a time (gzipped, if the client accepts it).  None to never stream
+QUERY_STREAM_MIN_SIZE = 100
+QUERY_STREAM_CHUNK_SIZE = 64 * 1024
+
 # list index types that should not be queryable via the query endpoint
 NO_QUERY = []
 SU_ONLY = ["account"]
@@ -3,21 +3,25 @@ An elasticsearch query pass-through.
 Has auth control, so it is better than exposing your ES index directly.
 '''
 
-import json, urllib2
+import json, urllib2, requests
 
 from flask import Blueprint, request, abort, make_response
 from flask.ext.login import current_user
 
 import portality.models as models
 from portality.core import app
-from portality.lib import webapp
+from portality.lib import webapp, querycache
 
 
 blueprint = Blueprint('query', __name__)
 
+# built on first use, from the QUERY_CACHE settings
+_cache = None
+
 # pass queries direct to index. POST only for receipt of complex query objects
 @blueprint.route('/<path:path>', methods=['GET','POST'])
 @blueprint.route('/', methods=['GET','POST'])
+@webapp.gzipped
 @webapp.jsonp
 def query(path='Pages'):
     pathparts = path.strip('/').split('/')
@@ -76,7 +80,7 @@ def query(path='Pages'):
         abort(404)
 
     if len(pathparts) > 1 and pathparts[1] == '_mapping':
-        resp = make_response( json.dumps(klass().query(endpoint='_mapping')) )
+        resp = _cached_response([modelname, '_mapping'], lambda: klass().query(endpoint='_mapping'))
     elif len(pathparts) == 2 and pathparts[1] not in ['_mapping','_search']:
         if request.method == 'POST':
             abort(401)
@@ -134,10 +138,77 @@ def query(path='Pages'):
         if default_filter:
             terms.update(_default_filter(subpaths))
 
-        resp = make_response( json.dumps(klass().query(q=qs, terms=terms, should_terms=shoulds)) )
+        if _streamable(klass, qs, terms, shoulds):
+            resp = _streamed_response(klass, qs)
+        else:
+            resp = _cached_response([modelname, qs, terms, shoulds], lambda: klass().query(q=qs, terms=terms, should_terms=shoulds))
 
     resp.mimetype = "application/json"
     return resp
 
+def _query_cache():
+    global _cache
+    if _cache is None and app.config.get("QUERY_CACHE", False):
+        _cache = querycache.QueryCache(max_entries=app.config.get("QUERY_CACHE_MAX_ENTRIES", 1000),
+                                       ttl=app.config.get("QUERY_CACHE_TTL", 300),
+                                       generation_file=app.config.get("QUERY_CACHE_GENERATION_FILE"))
+    return _cache
+
+def _cached_response(key_parts, run_query):
+    """
+    Respond with the result of run_query, from the cache if the same request has been answered recently.  The
+    response carries an ETag, and a request which already has that version gets a 304
+    """
+    cache = _query_cache()
+    if cache is None:
+        return make_response(json.dumps(run_query()))
+
+    key = cache.key(*key_parts)
+    cached = cache.get(key)
+    if cached is not None:
+        body, etag = cached
+    else:
+        body = json.dumps(run_query())
+        etag = cache.put(key, body)
+
+    # a jsonp response wraps the body, so it is not the version the etag describes.  A gzipped response
+    # carries the etag as weak, so it is compared weakly
+    if request.if_none_match.contains_weak(etag) and not request.args.get('callback'):
+        resp = make_response('', 304)
+    else:
+        resp = make_response(body)
+    resp.set_etag(etag)
+    return resp
+
+def _streamable(klass, qs, terms, shoulds):
+    """
+    Whether to stream the results straight from the index rather than through the model: for queries asking
+    for more than QUERY_STREAM_MIN_SIZE records, with no filters for the model to add
+    """
+    min_size = app.config.get("QUERY_STREAM_MIN_SIZE")
+    if min_size is None or not isinstance(qs, dict) or terms or shoulds or getattr(klass, "__type__", None) is None:
+        return False
+    try:
+        return int(qs.get("size", 10)) > min_size
+    except (TypeError, ValueError):
+        return False
+
+def _streamed_response(klass, qs):
+    """
+    Pass the index's response body through to the client as it arrives, a chunk at a time, without parsing
+    and re-serialising it, so that the memory used does not grow with the size of the result
+    """
+    url = app.config["ELASTIC_SEARCH_HOST"].rstrip("/") + "/" + app.config["ELASTIC_SEARCH_DB"] + "/" + klass.__type__ + "/_search"
+    upstream = requests.post(url, data=json.dumps(qs), stream=True)
+
+    def body():
+        try:
+            for chunk in upstream.iter_content(app.config.get("QUERY_STREAM_CHUNK_SIZE", 64 * 1024)):
+                yield chunk
+        finally:
+            upstream.raw.release_conn()
+
+    return app.response_class(body(), status=upstream.status_code)
+
 def _default_filter(subpaths):
     return None
\ No newline at end of file
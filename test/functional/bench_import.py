@@ -0,0 +1,38 @@
+"""
+Time importing portality.core for its config, as oagr and dois do, against building the Flask app too, each in
+a fresh interpreter, and check that the config-only import neither loads Flask nor talks to the index
+
+    python test/functional/bench_import.py [runs]
+"""
+import sys, os, subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+CONFIG_ONLY = "from portality.core import config; config.get('ELASTIC_SEARCH_HOST')"
+FULL_APP = "from portality.core import app; app.config.get('ELASTIC_SEARCH_HOST')"
+
+PROBE = """
+import sys, time
+t = time.time()
+%s
+elapsed = time.time() - t
+print elapsed, int('flask' in sys.modules), int(sys.modules['portality.core'].app._app is not None)
+"""
+
+def run(statement):
+    out = subprocess.check_output([sys.executable, "-c", PROBE % statement], cwd=ROOT)
+    elapsed, flask, built = out.strip().split("\n")[-1].split()
+    return float(elapsed), flask == "1", built == "1"
+
+def bench(label, statement, runs):
+    results = [run(statement) for i in range(runs)]
+    times = sorted([r[0] for r in results])
+    print label, "median %.1fms," % (times[len(times) // 2] * 1000), "min %.1fms;" % (times[0] * 1000), \
+        "flask loaded:", results[0][1], "app built:", results[0][2]
+    return results[0]
+
+if __name__ == "__main__":
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    elapsed, flask, built = bench("config only", CONFIG_ONLY, runs)
+    assert not flask and not built, "importing the config should not build the app"
+    bench("full app", FULL_APP, runs)
@@ -0,0 +1,31 @@
+"""
+Time serialising and loading a large RequestState, with epoch and with (legacy) string timestamps
+
+    python test/functional/bench_state_json.py [count]
+"""
+import sys, time
+from doaj2oag import oag
+
+def timed(label, fn):
+    t = time.time()
+    result = fn()
+    print label, "%.3fs" % (time.time() - t)
+    return result
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    state = oag.RequestState(["10.1234/%09d" % i for i in range(count)])
+    state.record_result({"results" : [{"identifier" : [{"id" : "10.1234/%09d" % i}]} for i in range(0, count, 2)]})
+    print "encoder:", oag.fastjson.__name__
+
+    j = timed("json()", state.json)
+    s = timed("dumps", lambda: oag.dumps(j))
+    j = timed("loads", lambda: oag.loads(s))
+    timed("from_json", lambda: oag.RequestState.from_json(j))
+
+    # the same state as older versions saved it, with every timestamp as a string
+    for field, entries in [("found", j["success"]), ("due", j["pending"])]:
+        for e in entries:
+            e["init"] = oag.RequestState.parse_time(e["init"]).strftime(oag.RequestState._timestamp_format)
+            e[field] = oag.RequestState.parse_time(e[field]).strftime(oag.RequestState._timestamp_format)
+    timed("from_json (legacy timestamps)", lambda: oag.RequestState.from_json(j))
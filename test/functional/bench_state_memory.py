@@ -0,0 +1,40 @@
+"""
+Measure the memory used per identifier by a RequestState, against the dict entries it used to keep
+
+    python test/functional/bench_state_memory.py [count]
+"""
+import sys, gc
+from datetime import datetime
+from doaj2oag import oag
+
+def deep_size(obj, seen=None):
+    seen = seen if seen is not None else set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum([deep_size(k, seen) + deep_size(v, seen) for k, v in obj.iteritems()])
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum([deep_size(o, seen) for o in obj])
+    elif hasattr(obj, "__slots__"):
+        size += sum([deep_size(getattr(obj, s), seen) for s in obj.__slots__])
+    return size
+
+def legacy_entries(count):
+    now = datetime.utcnow()
+    return dict([("10.1234/%09d" % i, {"init" : now, "due" : now, "requested" : 0, "maxed" : False}) for i in range(count)])
+
+def slotted_entries(count):
+    state = oag.RequestState(["10.1234/%09d" % i for i in range(count)])
+    return state.pending
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    for name, make in [("dict", legacy_entries), ("slots", slotted_entries)]:
+        gc.collect()
+        entries = make(count)
+        # leave the identifier strings out, as they are the same either way
+        seen = set([id(k) for k in entries.keys()])
+        print name, float(deep_size(entries, seen)) / count, "bytes per identifier"
+        del entries
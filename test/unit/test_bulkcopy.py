@@ -0,0 +1,148 @@
+from unittest import TestCase
+import threading, json, os, shutil, tempfile, BaseHTTPServer, SocketServer
+
+from doaj2oag import bulkcopy, harvest, oag
+
+def _ranges(q, found):
+    # gather the (field, range) filters from the (possibly nested) filtered queries
+    if isinstance(q, dict):
+        for k, v in q.iteritems():
+            if k == "range":
+                found.extend(v.items())
+            else:
+                _ranges(v, found)
+    return found
+
+def _in_range(value, r):
+    return ("gte" not in r or value >= r["gte"]) and ("lt" not in r or value < r["lt"]) and ("gt" not in r or value > r["gt"])
+
+class StubESHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path.endswith("/_bulk"):
+            if len(self.server.failures) > 0:
+                self._respond(self.server.failures.pop(0), {})
+                return
+            lines = body.strip().split("\n")
+            items = []
+            with self.server.lock:
+                for meta, doc in zip(lines[0::2], lines[1::2]):
+                    id = json.loads(meta)["index"]["_id"]
+                    self.server.written[id] = json.loads(doc)
+                    items.append({"index" : {"_id" : id, "status" : 201}})
+                self.server.bulks += 1
+            self._respond(200, {"items" : items})
+            return
+
+        q = json.loads(body)
+        docs = sorted(self.server.docs, key=lambda d: d["id"])
+        for field, r in _ranges(q.get("query"), []):
+            docs = [d for d in docs if _in_range(d[field], r)]
+        hits = [{"_id" : d["id"], "_type" : "article", "_source" : d, "sort" : [d["id"]]} for d in docs[:q.get("size")]]
+        self._respond(200, {"hits" : {"hits" : hits}})
+
+    def _respond(self, status, obj):
+        resp = json.dumps(obj)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(resp)))
+        self.end_headers()
+        self.wfile.write(resp)
+
+    def log_message(self, *args):
+        pass
+
+class StubESServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, docs):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), StubESHandler)
+        self.docs = docs
+        self.written = {}
+        self.failures = []
+        self.bulks = 0
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self, path):
+        return "http://127.0.0.1:" + str(self.server_address[1]) + path
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class TestBulkCopy(TestCase):
+
+    def setUp(self):
+        # hex ids spread evenly over the first digit, as DOAJ's are
+        self.docs = [{"id" : "%x%031d" % (i % 16, i), "title" : "article " + str(i), "last_updated" : "2014-01-01T00:00:%02dZ" % i} for i in range(60)]
+        self.server = StubESServer(self.docs)
+        self.dir = tempfile.mkdtemp()
+        self.checkpoint = os.path.join(self.dir, "copy.json")
+        self.policy = oag.RetryPolicy(sleep=lambda x: None)
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.dir)
+
+    def _copy(self, **kwargs):
+        return bulkcopy.copy(self.server.url("/src/article/_search"), self.server.url("/dst/article"), slices=4, page_size=7,
+                             bulk_bytes=500, checkpoint=self.checkpoint, retry_policy=self.policy, verbose=False, **kwargs)
+
+    def test_01_hex_partitions(self):
+        assert bulkcopy.hex_partitions(4) == ["4", "8", "c"]
+        assert len(bulkcopy.hex_partitions(32)) == 31
+        assert bulkcopy.hex_partitions(32)[0] == "08"
+
+    def test_02_copy_with_retry(self):
+        self.server.failures = [503]
+        stats = self._copy()
+        assert stats["docs"] == 60
+        assert stats["failed"] == 0
+        assert sorted(self.server.written.keys()) == sorted([d["id"] for d in self.docs])
+        # with 500 byte bulks, there are several per slice
+        assert self.server.bulks > 4
+
+        # a finished copy clears its checkpoint, so the next one copies everything again
+        assert not os.path.exists(self.checkpoint)
+
+    def test_03_resume(self):
+        ids = sorted([d["id"] for d in self.docs if d["id"] < "4"])
+        progress = {"slice-" + str(i) : {"done" : True} for i in range(1, 4)}
+        progress["slice-0"] = {"after" : ids[0], "done" : False, "docs" : 1}
+        with open(self.checkpoint, "w") as f:
+            json.dump({"slices" : 4, "mode" : "range", "progress" : progress}, f)
+
+        stats = self._copy()
+        assert sorted(self.server.written.keys()) == ids[1:]
+        assert stats["docs"] == len(ids) - 1
+        # the copy is complete, so the checkpoint has gone
+        assert not os.path.exists(self.checkpoint)
+
+    def test_04_incremental(self):
+        marks = os.path.join(self.dir, "high_water.json")
+        source = self.server.url("/src/article/_search")
+        assert self._copy(high_water=harvest.HighWaterMark(marks, source))["docs"] == 60
+        # the checkpoint is cleared once the mark has moved on
+        assert not os.path.exists(self.checkpoint)
+
+        self.docs[3]["last_updated"] = "2014-02-01T00:00:00Z"
+        self.docs[40]["last_updated"] = "2014-03-01T00:00:00Z"
+        self.server.written = {}
+        high_water = harvest.HighWaterMark(marks, source)
+        assert high_water.since == "2014-01-01T00:00:59Z"
+        # the two changed, and the one last updated at the mark itself
+        assert self._copy(high_water=high_water)["docs"] == 3
+        assert sorted(self.server.written.keys()) == sorted([self.docs[i]["id"] for i in [3, 40, 59]])
+        assert harvest.HighWaterMark(marks, source).since == "2014-03-01T00:00:00Z"
+
+    def test_05_copy_twice(self):
+        assert self._copy()["docs"] == 60
+        self.docs.append({"id" : "f" * 32, "title" : "new article", "last_updated" : "2014-01-02T00:00:00Z"})
+        self.server.written = {}
+        assert self._copy()["docs"] == 61
+        assert "f" * 32 in self.server.written
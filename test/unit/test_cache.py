@@ -0,0 +1,72 @@
+from unittest import TestCase
+from datetime import datetime, timedelta
+import os, shutil, tempfile
+
+from doaj2oag import cache, oag
+
+def _result(ident):
+    return {"identifier" : [{"id" : ident, "type" : "doi"}], "license" : [{"title" : "CC BY"}]}
+
+def _error(ident):
+    return {"identifier" : {"id" : ident, "type" : "doi"}, "error" : "not found"}
+
+class RecordingClient(oag.OAGClient):
+    def __init__(self, *args, **kwargs):
+        super(RecordingClient, self).__init__("http://localhost/lookup", *args, **kwargs)
+        self.sent = []
+
+    def _query(self, batch, budget=None, observe=None):
+        self.sent.extend(batch)
+        return {"results" : [_result(b) for b in batch if not b.endswith("x")],
+                "errors" : [_error(b) for b in batch if b.endswith("x")]}
+
+class TestResultCache(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "cache.db")
+        self.past = datetime.now() - timedelta(seconds=10)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_01_get_put(self):
+        c = cache.ResultCache(self.path)
+        c.put({"results" : [_result("10.1234/A")], "errors" : [_error("10.1234/x")]})
+        found = c.get(["10.1234/a", "10.1234/X", "10.1234/b"])
+        assert sorted(found.keys()) == ["10.1234/X", "10.1234/a"]
+        assert found["10.1234/a"][0] is False
+        assert found["10.1234/a"][1]["license"][0]["title"] == "CC BY"
+        assert found["10.1234/X"][0] is True
+
+        # and it persists
+        c.close()
+        assert len(cache.ResultCache(self.path).get(["10.1234/a"])) == 1
+
+    def test_02_expiry_and_eviction(self):
+        c = cache.ResultCache(self.path, error_ttl=0, max_entries=3)
+        c.put({"errors" : [_error("10.1234/x")]})
+        assert c.get(["10.1234/x"]) == {}
+
+        for i in range(5):
+            c.put({"results" : [_result("10.1234/" + str(i))]})
+        c.evict()
+        assert sorted(c.get(["10.1234/" + str(i) for i in range(5)]).keys()) == ["10.1234/2", "10.1234/3", "10.1234/4"]
+
+    def test_03_cycle(self):
+        c = cache.ResultCache(self.path)
+        client = RecordingClient(cache=c)
+        state = oag.RequestState(["10.1234/a", "10.1234/b", "10.1234/x"], start=self.past)
+        client.cycle(state)
+        assert sorted(client.sent) == ["10.1234/a", "10.1234/b", "10.1234/x"]
+
+        # a second job only sends what is not in the cache, but gets results for all of them
+        client.sent = []
+        state2 = oag.RequestState(["10.1234/A", "10.1234/c", "10.1234/x"], start=self.past)
+        client.cycle(state2)
+        assert client.sent == ["10.1234/c"]
+        assert sorted(state2.success.keys()) == ["10.1234/A", "10.1234/c"]
+        assert state2.error.keys() == ["10.1234/x"]
+        assert state2.finished()
+        ids = sorted([s["identifier"][0]["id"] for s in state2.flush_success()])
+        assert ids == ["10.1234/A", "10.1234/c"]
@@ -0,0 +1,87 @@
+from unittest import TestCase
+from datetime import datetime, timedelta
+import os, shutil, tempfile
+
+from doaj2oag import diskstate, oag
+
+def _processing(ids):
+    return {"processing" : [{"identifier" : {"id" : i, "type" : "doi"}} for i in ids]}
+
+def _results(ids):
+    return {"results" : [{"identifier" : [{"id" : i, "type" : "doi"}], "license" : [{"title" : "CC BY"}]} for i in ids]}
+
+def _errors(ids):
+    return {"errors" : [{"identifier" : {"id" : i, "type" : "doi"}, "error" : "broken"} for i in ids]}
+
+class TestDiskRequestState(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "state.db")
+        self.past = datetime.now() - timedelta(seconds=10)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_01_due_and_finished(self):
+        # the identifiers can come from a generator, and are read in chunks
+        state = diskstate.DiskRequestState(self.path, (i for i in ["a", "b", "c", "a"]), start=self.past, chunk_size=2)
+        assert sorted(state.get_due()) == ["a", "b", "c"]
+        assert state.next_due() == self.past
+        assert not state.finished()
+
+        state.record_result(_results(["a"]))
+        state.record_result(_errors(["b"]))
+        assert state.get_due() == ["c"]
+        assert len(state.flush_success()) == 1
+        assert len(state.flush_error()) == 1
+        assert state.print_status_report() == "1 received; 1 errors; 1 pending"
+
+        state.record_result(_results(["c"]))
+        assert state.get_due() == []
+        assert state.next_due() is None
+        assert state.finished()
+
+    def test_02_backoff_maxed_and_reopen(self):
+        state = diskstate.DiskRequestState(self.path, ["a", "b"], start=self.past, max_retries=2, due_limit=1)
+        # only due_limit of the due identifiers are handed out at a time
+        assert len(state.get_due()) == 1
+
+        state.record_result(_processing(["a"]))
+        assert state.get_due() == ["b"]
+        state.record_result(_results(["b"]))
+        assert state.next_due() > datetime.now()
+        state.batch_size = 50
+        state.close()
+
+        state = diskstate.DiskRequestState.open(self.path)
+        assert state.batch_size == 50
+        assert state.print_status_report() == "1 received; 0 errors; 1 pending"
+        state.clock = FixedClock(datetime.now() + timedelta(seconds=10))
+        assert state.get_due() == ["a"]
+        state.record_result(_processing(["a"]))
+        assert state.next_due() is None
+        assert state.finished()
+
+    def test_03_cycle(self):
+        client = RecordingClient()
+        state = diskstate.DiskRequestState(self.path, ["10.1234/%d" % i for i in range(25)], start=self.past, batch_size=10)
+        client.cycle(state)
+        assert len(client.sent) == 25
+        assert state.finished()
+
+class FixedClock(oag.Clock):
+    def __init__(self, now):
+        self._now = now
+
+    def now(self):
+        return self._now
+
+class RecordingClient(oag.OAGClient):
+    def __init__(self, *args, **kwargs):
+        super(RecordingClient, self).__init__("http://localhost/lookup", *args, **kwargs)
+        self.sent = []
+
+    def _query(self, batch, budget=None, observe=None):
+        self.sent.extend(batch)
+        return _results(batch)
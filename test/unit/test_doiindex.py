@@ -0,0 +1,62 @@
+from unittest import TestCase
+from datetime import datetime, timedelta
+
+from doaj2oag import doiindex, oag
+
+class FixedClock(oag.Clock):
+    def __init__(self, now):
+        self.current = now
+
+    def now(self):
+        return self.current
+
+class TestDOIIndex(TestCase):
+
+    def setUp(self):
+        self.now = datetime(2014, 6, 1)
+        self.clock = FixedClock(self.now)
+
+    def tearDown(self):
+        pass
+
+    def test_01_normalise(self):
+        assert doiindex.normalise(" 10.1234/ABC.1 ") == "10.1234/ABC.1"
+        assert doiindex.normalise("doi:10.1234/abc") == "10.1234/abc"
+        assert doiindex.normalise("DOI: 10.1234/abc") == "10.1234/abc"
+        assert doiindex.normalise("http://dx.doi.org/10.1234/abc") == "10.1234/abc"
+        assert doiindex.normalise("https://doi.org/10.1234/abc") == "10.1234/abc"
+        assert doiindex.normalise(u"10.1234/caf\xe9") is None
+        assert doiindex.normalise("not a doi") is None
+        assert doiindex.normalise("") is None
+        assert doiindex.normalise(None) is None
+
+    def test_02_unique(self):
+        dois = ["10.1234/abc", "doi:10.1234/ABC", "10.1234/def", "rubbish", "http://dx.doi.org/10.1234/def"]
+        assert list(doiindex.unique(dois)) == ["10.1234/abc", "10.1234/def"]
+
+    def test_03_fresh_and_stale(self):
+        index = doiindex.DOIIndex(staleness=3600, error_staleness=60, clock=self.clock)
+        index.store({
+            "10.1234/recent" : (self.now - timedelta(seconds=120), "success"),
+            "10.1234/old" : (self.now - timedelta(seconds=7200), "success"),
+            "10.1234/error" : (self.now - timedelta(seconds=120), "error")
+        })
+        assert index.fresh(["10.1234/RECENT", "10.1234/old", "10.1234/error", "10.1234/new"]) == set(["10.1234/recent"])
+        assert index.filter(["10.1234/recent", "10.1234/old", "doi:10.1234/old", "10.1234/new"]) == ["10.1234/old", "10.1234/new"]
+
+    def test_04_state(self):
+        index = doiindex.DOIIndex(clock=self.clock)
+        start = self.now - timedelta(seconds=10)
+        state = oag.RequestState(["10.1234/a", "10.1234/b"], start=start, clock=self.clock, index=index)
+        state.record_result({"results" : [{"identifier" : [{"id" : "10.1234/a", "type" : "doi"}]}]})
+        index.record(state.changes())
+
+        # a second job with an overlapping set of DOIs only looks up the new ones
+        state2 = oag.RequestState(["10.1234/A", "10.1234/b", "10.1234/c"], start=start, clock=self.clock, index=index)
+        assert sorted(state2.pending.keys()) == ["10.1234/b", "10.1234/c"]
+
+        # and pruning an existing state takes out the ones which have since been found
+        state3 = oag.RequestState(["10.1234/a", "10.1234/d"], start=start, clock=self.clock)
+        index.prune(state3)
+        assert state3.pending.keys() == ["10.1234/d"]
+        assert state3.get_due() == ["10.1234/d"]
@@ -0,0 +1,161 @@
+from unittest import TestCase
+import threading, json, os, shutil, tempfile, BaseHTTPServer, SocketServer
+from urlparse import urlparse, parse_qs
+
+from doaj2oag import harvest
+
+class StubSearchHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        self.server.requests.append((url.path, body))
+        self.server.content_types.append(self.headers.get("Content-Type"))
+
+        if url.path == "/_search/scroll":
+            offset = int(body)
+            size = self.server.scroll_size
+        else:
+            q = json.loads(body)
+            size = q.get("size")
+            self.server.scroll_size = size
+            self.server.sources.append(q.get("_source"))
+            offset = 0
+            if "search_after" in q:
+                offset = [d["id"] for d in self.server.docs].index(q["search_after"][0]) + 1
+            elif "filtered" in q.get("query", {}):
+                gt = q["query"]["filtered"]["filter"]["range"]["id"]["gt"]
+                offset = len([d for d in self.server.docs if d["id"] <= gt])
+
+        page = self.server.docs[offset:offset + size]
+        hits = [{"_source" : d, "sort" : [d["id"]]} for d in page]
+        res = {"hits" : {"hits" : hits}}
+        if "scroll" in params:
+            res["_scroll_id"] = str(offset + size)
+        self._respond(res)
+
+    def do_DELETE(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.cleared += 1
+        self._respond({})
+
+    def _respond(self, obj):
+        resp = json.dumps(obj)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(resp)))
+        self.end_headers()
+        self.wfile.write(resp)
+
+    def log_message(self, *args):
+        pass
+
+class StubSearchServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, docs):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), StubSearchHandler)
+        self.docs = docs
+        self.requests = []
+        self.sources = []
+        self.content_types = []
+        self.cleared = 0
+        self.scroll_size = None
+        self.thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:" + str(self.server_address[1]) + "/doaj/article/_search"
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class TestHarvest(TestCase):
+
+    def setUp(self):
+        docs = []
+        for i in range(25):
+            docs.append({"id" : "%03d" % i, "bibjson" : {"identifier" : [{"type" : "doi", "id" : " 10.1234/%d " % i}, {"type" : "eissn", "id" : "1234-5678"}]}})
+        self.server = StubSearchServer(docs)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_01_modes(self):
+        for mode in harvest.MODES:
+            records = list(harvest.iterate(self.server.url, page_size=10, mode=mode))
+            assert [r["id"] for r in records] == ["%03d" % i for i in range(25)], mode
+        assert self.server.cleared == 1
+
+    def test_02_limit(self):
+        records = list(harvest.iterate(self.server.url, page_size=10, limit=12))
+        assert len(records) == 12
+        # the limit stops us before the third page, and the scroll is still cleared
+        assert len(self.server.requests) == 2
+        assert self.server.cleared == 1
+
+    def test_03_dois(self):
+        dois = list(harvest.dois(self.server.url, page_size=10, mode="range"))
+        assert dois == ["10.1234/%d" % i for i in range(25)]
+        assert self.server.sources[0] == ["bibjson.identifier"]
+
+    def test_04_content_type(self):
+        # query pass-throughs (such as portality's) only read a POSTed query sent as JSON
+        list(harvest.iterate(self.server.url, page_size=10, mode="range"))
+        assert len(self.server.content_types) == 3
+        assert set(self.server.content_types) == set(["application/json"])
+
+    def test_05_scroll_id_as_text(self):
+        list(harvest.iterate(self.server.url, page_size=10, mode="scroll"))
+        sent = zip(self.server.requests, self.server.content_types)
+        assert sent[0][1] == "application/json"
+        scrolls = [(body, ct) for (path, body), ct in sent if path == "/_search/scroll"]
+        # each scroll request carries the bare id from the page before, as plain text
+        assert scrolls == [("10", "text/plain"), ("20", "text/plain"), ("30", "text/plain")]
+
+    def test_06_page_size_bounded(self):
+        for size in [0, harvest.MAX_PAGE_SIZE + 1]:
+            self.assertRaises(ValueError, list, harvest.iterate(self.server.url, page_size=size))
+        assert len(self.server.requests) == 0
+        list(harvest.iterate(self.server.url, page_size=harvest.MAX_PAGE_SIZE, mode="range"))
+        assert self.server.sources == [None]
+
+class TestHighWaterMark(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "high_water.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_01_track_and_commit(self):
+        mark = harvest.HighWaterMark(self.path, "doaj")
+        # nothing seen yet, so the query is left alone
+        assert mark.query({"query" : {"term" : {"a" : "b"}}}) == {"query" : {"term" : {"a" : "b"}}}
+
+        mark.track({"last_updated" : "2014-05-01T00:00:00Z"})
+        mark.track({"last_updated" : "2014-06-01T00:00:00Z"})
+        mark.track({"id" : "no timestamp"})
+        # not moved on until committed
+        assert harvest.HighWaterMark(self.path, "doaj").since is None
+        mark.commit()
+
+        mark = harvest.HighWaterMark(self.path, "doaj")
+        assert mark.since == "2014-06-01T00:00:00Z"
+        q = mark.query({"query" : {"term" : {"a" : "b"}}})
+        assert q["query"]["filtered"]["query"] == {"term" : {"a" : "b"}}
+        assert q["query"]["filtered"]["filter"] == {"range" : {"last_updated" : {"gte" : "2014-06-01T00:00:00Z"}}}
+
+        # each source has its own mark, and a nested field can be tracked
+        other = harvest.HighWaterMark(self.path, "other", field="admin.created_date")
+        assert other.since is None
+        other.track({"admin" : {"created_date" : "2013-01-01T00:00:00Z"}})
+        other.commit()
+        assert harvest.HighWaterMark(self.path, "other", field="admin.created_date").since == "2013-01-01T00:00:00Z"
+        assert harvest.HighWaterMark(self.path, "doaj").since == "2014-06-01T00:00:00Z"
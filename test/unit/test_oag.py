@@ -1,4 +1,19 @@
 from unittest import TestCase
+from datetime import datetime, timedelta
+from cStringIO import StringIO
+import threading, time, json, gzip, random, os, shutil, tempfile, BaseHTTPServer, SocketServer
+import requests
+
+from doaj2oag import oag
+
+def _processing(ids):
+    return {"processing" : [{"identifier" : {"id" : i, "type" : "doi"}} for i in ids]}
+
+def _results(ids):
+    return {"results" : [{"identifier" : [{"id" : i, "type" : "doi"}], "license" : [{"title" : "CC BY"}]} for i in ids]}
+
+def _errors(ids):
+    return {"errors" : [{"identifier" : {"id" : i, "type" : "doi"}, "error" : "broken"} for i in ids]}
 
 class TestSnapshot(TestCase):
 
@@ -9,4 +24,596 @@ class TestSnapshot(TestCase):
         pass
 
     def test_01(self):
-        pass
\ No newline at end of file
+        pass
+
+class TestRequestState(TestCase):
+
+    def setUp(self):
+        self.past = datetime.now() - timedelta(seconds=10)
+
+    def tearDown(self):
+        pass
+
+    def test_01_due_and_finished(self):
+        state = oag.RequestState(["a", "b", "c"], start=self.past)
+        assert sorted(state.get_due()) == ["a", "b", "c"]
+        # asking again does not lose anything, as no results have been recorded
+        assert sorted(state.get_due()) == ["a", "b", "c"]
+        assert state.next_due() == self.past
+        assert not state.finished()
+
+        state.record_result(_results(["a"]))
+        state.record_result(_errors(["b"]))
+        assert state.get_due() == ["c"]
+        assert "a" in state.success
+        assert "b" in state.error
+
+        state.record_result(_results(["c"]))
+        assert state.get_due() == []
+        assert state.next_due() is None
+        assert state.finished()
+
+    def test_02_backoff_and_maxed(self):
+        state = oag.RequestState(["a", "b"], start=self.past, max_retries=2)
+        state.record_result(_processing(["a"]))
+        assert state.get_due() == ["b"]
+        assert state.next_due() == self.past
+        assert state.pending["a"].due > datetime.now()
+
+        state.record_result(_processing(["b"]))
+        assert state.get_due() == []
+        assert state.next_due() == min(state.pending["a"].due, state.pending["b"].due)
+
+        # force both to be due again, and retry them to their maximum
+        state.pending["a"].due = self.past
+        state.pending["b"].due = self.past
+        state._rebuild_schedule()
+        assert sorted(state.get_due()) == ["a", "b"]
+        state.record_result(_processing(["a", "b"]))
+        assert state.pending["a"].maxed
+        assert state.get_due() == []
+        assert state.next_due() is None
+        assert state.finished()
+
+    def test_03_json_round_trip(self):
+        state = oag.RequestState(["a", "b", "c"], start=self.past.replace(microsecond=0))
+        state.record_result(_results(["a"]))
+        state.record_result(_processing(["b"]))
+
+        j = state.json()
+        state2 = oag.RequestState.from_json(j)
+        assert state2.id == state.id
+        assert state2.get_due() == ["c"]
+        assert "a" in state2.success
+        assert not state2.finished()
+        assert sorted(state2.json()["pending"]) == sorted(j["pending"])
+
+    def test_04_changes(self):
+        state = oag.RequestState(["a", "b", "c", "d"], start=self.past.replace(microsecond=0))
+        snapshot = state.json()
+        state.clear_changes()
+        assert state.changes() == {"batch_size" : 1000, "success" : [], "error" : [], "pending" : [], "removed" : []}
+
+        state.record_result(_results(["a"]))
+        state.record_result(_errors(["b"]))
+        state.record_result(_processing(["c"]))
+        state.batch_size = 50
+        changes = state.changes()
+        assert len(changes["success"]) == 1
+        assert len(changes["error"]) == 1
+        assert len(changes["pending"]) == 1
+
+        # replaying the changes over the snapshot gets us the current state
+        restored = oag.RequestState.from_json(snapshot)
+        restored.apply_changes(changes)
+        assert restored.batch_size == 50
+        assert sorted(restored.success.keys()) == ["a"]
+        assert sorted(restored.error.keys()) == ["b"]
+        assert sorted(restored.pending.keys()) == ["c", "d"]
+        assert restored.get_due() == ["d"]
+        assert sorted(restored.json()["pending"]) == sorted(state.json()["pending"])
+
+    def test_05_epoch_and_legacy_timestamps(self):
+        start = self.past.replace(microsecond=0)
+        state = oag.RequestState(["a"], start=start)
+        j = state.json()
+        assert j["pending"][0]["due"] == oag.RequestState.epoch(start)
+        assert oag.RequestState.from_json(j).pending["a"].due == start
+
+        # states saved before epoch timestamps have them as strings
+        legacy = start.strftime(oag.RequestState._timestamp_format)
+        j["pending"] = [{"id" : "a", "init" : legacy, "due" : legacy, "requested" : 1, "maxed" : False}]
+        j["success"] = [{"id" : "b", "init" : legacy, "found" : legacy, "requested" : 1, "maxed" : False}]
+        state2 = oag.RequestState.from_json(oag.loads(oag.dumps(j)))
+        assert state2.pending["a"].due == start
+        assert state2.pending["a"].requested == 1
+        assert state2.success["b"].found == start
+        assert state2.json()["success"][0]["found"] == oag.RequestState.epoch(start)
+
+    def test_06_removals_are_changes(self):
+        state = oag.RequestState(["a", "b", "c"], start=self.past.replace(microsecond=0))
+        snapshot = state.json()
+        state.clear_changes()
+
+        state.remove_identifiers(["b", "z"])
+        changes = state.changes()
+        assert changes["removed"] == ["b"]
+
+        # a state rebuilt from the snapshot and the saved changes no longer has the removed id
+        restored = oag.RequestState.from_json(snapshot)
+        restored.apply_changes(json.loads(json.dumps(changes)))
+        assert sorted(restored.pending.keys()) == ["a", "c"]
+        assert sorted(restored.get_due()) == ["a", "c"]
+
+class FakeClock(oag.Clock):
+    def __init__(self, start):
+        self.current = start
+        self.waited = 0
+
+    def now(self):
+        return self.current
+
+    def wait(self, seconds, wakeup=None):
+        self.waited += seconds
+        self.current += timedelta(seconds=seconds)
+
+class StubClient(object):
+    """Reports each identifier as processing on its first request, and as a result on the next"""
+    def __init__(self):
+        self.seen = set()
+        self.cycles = 0
+
+    def cycle(self, state, throttle=0, verbose=False):
+        self.cycles += 1
+        due = state.get_due()
+        state.record_result(_processing([d for d in due if d not in self.seen]))
+        state.record_result(_results([d for d in due if d in self.seen]))
+        self.seen.update(due)
+        return state
+
+class TestScheduler(TestCase):
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_01_sleeps_until_due(self):
+        clock = FakeClock(datetime(2014, 1, 1))
+        state = oag.RequestState(["a", "b"], back_off_factor=10, max_back_off=60, start=datetime(2014, 1, 1), clock=clock)
+        client = StubClient()
+        scheduler = oag.Scheduler(client, throttle=0, verbose=False, clock=clock)
+        scheduler.run(state)
+
+        assert state.finished()
+        assert sorted(state.success.keys()) == ["a", "b"]
+        assert client.cycles == 2
+        # the back off for the first retry is 2**1 * 10 seconds, which we slept through rather than span
+        assert clock.waited >= 20
+
+    def test_02_stop(self):
+        clock = FakeClock(datetime(2014, 1, 1))
+        state = oag.RequestState(["a"], start=datetime(2014, 1, 2), clock=clock)
+        client = StubClient()
+        scheduler = oag.Scheduler(client, throttle=0, verbose=False, clock=clock)
+        scheduler.stop()
+        scheduler.run(state)
+        assert client.cycles == 0
+        assert not state.finished()
+
+    def test_03_add_identifiers(self):
+        clock = FakeClock(datetime(2014, 1, 1))
+        state = oag.RequestState(["a"], start=datetime(2014, 1, 1), clock=clock)
+        state.record_result(_results(["a"]))
+        state.add_identifiers(["a", "b"])
+        assert state.pending.keys() == ["b"]
+        assert not state.finished()
+        assert state.next_due() == datetime(2014, 1, 1)
+
+class CountingClient(oag.OAGClient):
+    """Answers every batch with results after a short delay, recording how many were in flight at once"""
+    def __init__(self, *args, **kwargs):
+        super(CountingClient, self).__init__("http://localhost/lookup", *args, **kwargs)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.queries = 0
+
+    def _query(self, batch, budget=None, observe=None):
+        with self.lock:
+            self.in_flight += 1
+            self.queries += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(0.05)
+        with self.lock:
+            self.in_flight -= 1
+        return _results(batch)
+
+class TestOAGClient(TestCase):
+
+    def setUp(self):
+        self.past = datetime.now() - timedelta(seconds=10)
+
+    def tearDown(self):
+        pass
+
+    def test_01_concurrent_cycle(self):
+        ids = [str(i) for i in range(100)]
+        state = oag.RequestState(ids, batch_size=10, start=self.past)
+        client = CountingClient(concurrency=4)
+        client.cycle(state)
+
+        assert client.queries == 10
+        assert 1 < client.max_in_flight <= 4
+        assert len(state.success) == 100
+        assert len(state.flush_success()) == 100
+        assert state.finished()
+
+    def test_02_sequential_cycle(self):
+        ids = [str(i) for i in range(30)]
+        state = oag.RequestState(ids, batch_size=10, start=self.past)
+        client = CountingClient()
+        client.cycle(state)
+        assert client.queries == 3
+        assert client.max_in_flight == 1
+        assert len(state.success) == 30
+
+    def test_03_rate_limiter(self):
+        limiter = oag.RateLimiter(50)
+        start = time.time()
+        for i in range(6):
+            limiter.acquire()
+        # the first is immediate, the remaining five are spaced at 1/50th of a second
+        assert time.time() - start >= 0.09
+
+    def test_04_concurrency_ignores_throttle(self):
+        # with the JobRunner's default throttle and no rate limit, the pool still runs batches in parallel
+        state = oag.RequestState([str(i) for i in range(40)], batch_size=10, start=self.past)
+        client = CountingClient(concurrency=4)
+        start = time.time()
+        client.cycle(state, throttle=5)
+        assert time.time() - start < 2
+        assert client.max_in_flight > 1
+        assert len(state.success) == 40
+
+        # and one limiter paces every cycle
+        assert client.rate_limiter is not None
+        limiter = client.rate_limiter
+        client.cycle(oag.RequestState([str(i) for i in range(20)], batch_size=10, start=self.past), throttle=5)
+        assert client.rate_limiter is limiter
+
+class CountingAsyncClient(CountingClient, oag.AsyncOAGClient):
+    pass
+
+class FailingAsyncClient(oag.AsyncOAGClient):
+    def _query(self, batch, budget=None, observe=None):
+        if "bad" in batch:
+            raise requests.exceptions.HTTPError("400 Client Error")
+        return _results(batch)
+
+class TestAsyncOAGClient(TestCase):
+
+    def setUp(self):
+        self.past = datetime.now() - timedelta(seconds=10)
+
+    def test_01_jobs_share_the_workers(self):
+        states = [oag.RequestState([str(j) + "-" + str(i) for i in range(20)], batch_size=10, start=self.past) for j in range(3)]
+        client = CountingAsyncClient(concurrency=4)
+        try:
+            client.cycle_all(states)
+        finally:
+            client.close()
+
+        # six batches across the three jobs, run on the one pool
+        assert client.queries == 6
+        assert 1 < client.max_in_flight <= 4
+        assert all([state.finished() and len(state.success) == 20 for state in states])
+
+    def test_02_failure_is_per_job(self):
+        good = oag.RequestState(["a", "b"], batch_size=1, start=self.past)
+        bad = oag.RequestState(["bad"], batch_size=1, start=self.past)
+        empty = oag.RequestState([], start=self.past)
+        client = FailingAsyncClient("http://localhost/lookup", concurrency=2)
+        try:
+            cycles = [client.submit(s) for s in [good, bad, empty]]
+            assert cycles[0].wait() is good
+            self.assertRaises(requests.exceptions.HTTPError, cycles[1].wait)
+            assert cycles[2].wait() is empty
+        finally:
+            client.close()
+        assert len(good.success) == 2
+        assert "bad" in bad.pending
+
+    def test_03_sink_failure_stays_with_its_job(self):
+        written = []
+        def fussy(batch):
+            if any([s["identifier"][0]["id"].startswith("bad") for s in batch.flush_success()]):
+                raise ValueError("broken")
+            written.append(batch.job)
+        sink = oag.StreamingSink(fussy)
+        bad = oag.RequestState(["bad-" + str(i) for i in range(20)], batch_size=10, start=self.past)
+        good = oag.RequestState(["good-" + str(i) for i in range(20)], batch_size=10, start=self.past)
+        client = CountingAsyncClient(concurrency=2, sink=sink)
+        try:
+            cycles = [client.submit(bad), client.submit(good)]
+            # the good job finishes cleanly, even after the bad one's write has failed
+            time.sleep(0.3)
+            cycles[1].wait()
+            self.assertRaises(ValueError, cycles[0].wait)
+        finally:
+            client.close()
+            sink.close()
+        assert written == [good.id, good.id]
+
+class StubLookupHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        # one handler is created per connection, and handles all the requests sent down it
+        self.server.connections += 1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length")))
+        if len(self.server.failures) > 0:
+            status, headers = self.server.failures.pop(0)
+            self.server.failed += 1
+            self.send_response(status)
+            for k, v in headers.iteritems():
+                self.send_header(k, v)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        if self.headers.get("Content-Encoding") == "gzip":
+            self.server.compressed += 1
+            body = gzip.GzipFile(fileobj=StringIO(body)).read()
+        self.server.requests += 1
+
+        resp = json.dumps(_results(json.loads(body)))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            buf = StringIO()
+            with gzip.GzipFile(fileobj=buf, mode="wb") as f:
+                f.write(resp)
+            resp = buf.getvalue()
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(resp)))
+        self.end_headers()
+        self.wfile.write(resp)
+
+    def log_message(self, *args):
+        pass
+
+class StubLookupServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), StubLookupHandler)
+        self.connections = 0
+        self.requests = 0
+        self.compressed = 0
+        self.failed = 0
+        # (status, headers) to respond with, in order, before serving any real responses
+        self.failures = []
+        self.thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:" + str(self.server_address[1]) + "/lookup/"
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class TestOAGClientHTTP(TestCase):
+
+    def setUp(self):
+        self.server = StubLookupServer()
+        self.past = datetime.now() - timedelta(seconds=10)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_01_connection_reuse(self):
+        ids = [str(i) for i in range(50)]
+        state = oag.RequestState(ids, batch_size=5, start=self.past)
+        client = oag.OAGClient(self.server.url, timeout=10)
+        client.cycle(state)
+
+        assert self.server.requests == 10
+        assert self.server.connections == 1
+        assert len(state.success) == 50
+
+    def test_02_compression(self):
+        ids = [str(i) for i in range(20)]
+        state = oag.RequestState(ids, batch_size=5, start=self.past)
+        client = oag.OAGClient(self.server.url, concurrency=2, timeout=10, compress=True)
+        client.cycle(state)
+
+        assert self.server.requests == 4
+        assert self.server.compressed == 4
+        assert self.server.connections <= 2
+        assert len(state.success) == 20
+
+class TestRetryPolicy(TestCase):
+
+    def setUp(self):
+        self.server = StubLookupServer()
+        self.sleeps = []
+        self.policy = oag.RetryPolicy(max_retries=3, base=2, cap=5, sleep=self.sleeps.append, rng=random.Random(42))
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_01_server_errors_retried_with_jitter(self):
+        self.server.failures = [(503, {}), (500, {})]
+        client = oag.OAGClient(self.server.url, retry_policy=self.policy)
+        result = client._query(["a"])
+
+        assert len(result.get("results")) == 1
+        assert self.server.failed == 2
+        assert len(self.sleeps) == 2
+        assert 0 <= self.sleeps[0] <= 2
+        assert 0 <= self.sleeps[1] <= 4
+
+    def test_02_retry_after(self):
+        self.server.failures = [(429, {"Retry-After" : "7"})]
+        client = oag.OAGClient(self.server.url, retry_policy=self.policy)
+        client._query(["a"])
+        assert self.sleeps == [7]
+
+    def test_03_client_errors_not_retried(self):
+        self.server.failures = [(400, {})]
+        client = oag.OAGClient(self.server.url, retry_policy=self.policy)
+        with self.assertRaises(requests.exceptions.HTTPError):
+            client._query(["a"])
+        assert self.server.failed == 1
+        assert self.sleeps == []
+
+    def test_04_retries_exhausted(self):
+        self.server.failures = [(503, {})] * 5
+        client = oag.OAGClient(self.server.url, retry_policy=self.policy)
+        with self.assertRaises(requests.exceptions.HTTPError):
+            client._query(["a"])
+        assert self.server.failed == 4
+        assert len(self.sleeps) == 3
+
+    def test_05_job_budget(self):
+        self.server.failures = [(503, {})] * 5
+        client = oag.OAGClient(self.server.url, retry_policy=self.policy)
+        with self.assertRaises(requests.exceptions.HTTPError):
+            client._query(["a"], oag.RetryBudget(1))
+        assert self.server.failed == 2
+
+    def test_06_connection_errors_retried(self):
+        url = self.server.url
+        self.server.stop()
+        client = oag.OAGClient(url, retry_policy=self.policy)
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            client._query(["a"])
+        assert len(self.sleeps) == 3
+        # restart a server so that tearDown has something to stop
+        self.server = StubLookupServer()
+
+class TestAdaptiveBatchSize(TestCase):
+
+    def setUp(self):
+        self.past = datetime.now() - timedelta(seconds=10)
+
+    def tearDown(self):
+        pass
+
+    def test_01_aimd(self):
+        state = oag.RequestState([], batch_size=100)
+        controller = oag.AdaptiveBatchSize(target_latency=1, min_size=10, max_size=120, step=10, factor=0.5)
+
+        controller.observe(state, 100, 0.5)
+        assert state.batch_size == 110
+        # a short batch (e.g. the tail of the due list) tells us nothing about bigger ones
+        controller.observe(state, 20, 0.5)
+        assert state.batch_size == 110
+        controller.observe(state, 110, 0.5)
+        controller.observe(state, 120, 0.5)
+        assert state.batch_size == 120
+
+        controller.observe(state, 120, 2)
+        assert state.batch_size == 60
+        controller.observe(state, 60, 0.1, failed=True)
+        controller.observe(state, 30, 0.1, failed=True)
+        controller.observe(state, 15, 0.1, failed=True)
+        assert state.batch_size == 10
+
+    def test_02_cycle_adapts_and_saves(self):
+        server = StubLookupServer()
+        try:
+            server.failures = [(503, {})]
+            ids = [str(i) for i in range(100)]
+            state = oag.RequestState(ids, batch_size=20, start=self.past)
+            controller = oag.AdaptiveBatchSize(target_latency=10, min_size=5, max_size=100, step=5)
+            policy = oag.RetryPolicy(sleep=lambda x: None)
+            client = oag.OAGClient(server.url, retry_policy=policy, batch_controller=controller)
+            client.cycle(state)
+
+            # halved to 10 by the 503, then grown by 5 for each full batch after it: the retried 20, then
+            # 15, 20 and 25, leaving a short final batch of 20
+            assert len(state.success) == 100
+            assert server.requests == 5
+            assert state.batch_size == 30
+            assert oag.RequestState.from_json(state.json()).batch_size == 30
+        finally:
+            server.stop()
+
+class TestStreamingSink(TestCase):
+
+    def setUp(self):
+        self.past = datetime.now() - timedelta(seconds=10)
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_01_backpressure(self):
+        release = threading.Event()
+        seen = []
+        def slow(batch):
+            release.wait()
+            seen.extend(batch.flush_success())
+        sink = oag.StreamingSink(slow, max_batches=2)
+
+        # one batch with the callback and two queued; the fourth has to wait for room
+        for i in range(3):
+            sink.write(_results([str(i)])["results"], [])
+        writer = threading.Thread(target=sink.write, args=(_results(["3"])["results"], []))
+        writer.start()
+        writer.join(0.2)
+        assert writer.is_alive()
+
+        release.set()
+        writer.join()
+        sink.flush()
+        assert sorted([s["identifier"][0]["id"] for s in seen]) == ["0", "1", "2", "3"]
+        sink.close()
+
+    def test_02_cycle_streams_to_csv_closure(self):
+        success_file = os.path.join(self.dir, "success.csv")
+        error_file = os.path.join(self.dir, "error.csv")
+        callback = oag.csv_closure(success_file, error_file)
+        sink = oag.StreamingSink(callback)
+        state = oag.RequestState([str(i) for i in range(25)], batch_size=10, start=self.past)
+        CountingClient(concurrency=2, sink=sink).cycle(state)
+        sink.close()
+        callback.close()
+
+        # the results went to the sink as they arrived, and are not held in the state
+        assert state.flush_success() == []
+        with open(success_file) as f:
+            assert len(f.readlines()) == 25
+
+    def test_03_callback_failure(self):
+        def broken(batch):
+            raise ValueError("broken")
+        sink = oag.StreamingSink(broken)
+        sink.write(_results(["a"])["results"], [])
+        self.assertRaises(ValueError, sink.flush)
+        sink.flush()
+        sink.close()
+
+    def test_04_concurrent_cycle_with_failing_sink(self):
+        written = []
+        def flaky(batch):
+            if len(written) > 0:
+                raise ValueError("broken")
+            written.extend(batch.flush_success())
+        sink = oag.StreamingSink(flaky)
+        state = oag.RequestState([str(i) for i in range(100)], batch_size=10, start=self.past)
+        # the failure is raised from the cycle, rather than lost with the worker which saw it
+        self.assertRaises(ValueError, CountingClient(concurrency=4, sink=sink).cycle, state)
+        assert len(written) == 10
+        # and kept for the next flush to report
+        self.assertRaises(ValueError, sink.flush)
+        sink.close()
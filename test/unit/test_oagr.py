@@ -0,0 +1,469 @@
+from unittest import TestCase
+import sys, types, time, threading, json, os, shutil, tempfile, requests, BaseHTTPServer, SocketServer
+from datetime import datetime, timedelta
+from urlparse import urlparse
+
+def _fake_esprit():
+    """
+    The few esprit calls oagr (and the settings) use, for when esprit is not installed.  They make the same
+    requests, so the stub ES below answers them either way
+    """
+    raw = types.ModuleType("esprit.raw")
+
+    class Connection(object):
+        def __init__(self, host, index, port=9200):
+            self.host, self.index, self.port = host, index, port
+
+    def url(conn, type=None, endpoint=None):
+        return conn.host.rstrip("/") + "/" + conn.index + ("/" + type if type else "") + ("/" + endpoint if endpoint is not None else "")
+
+    def unpack(hits):
+        return [h.get("_source") if "_source" in h else h.get("fields") for h in hits]
+
+    raw.Connection = Connection
+    raw.search = lambda conn, type=None, query=None: requests.post(url(conn, type, "_search"), data=json.dumps(query))
+    raw.unpack_result = lambda resp: unpack(resp.json().get("hits", {}).get("hits", []))
+    raw.mget = lambda conn, type, ids: requests.post(url(conn, type, "_mget"), data=json.dumps({"ids" : ids}))
+    raw.unpack_mget = lambda resp: unpack(resp.json().get("docs", []))
+    raw.store = lambda conn, type, record, id=None: requests.put(url(conn, type, id), data=json.dumps(record))
+    raw.raw_bulk = lambda conn, data, type="": requests.post(url(conn, type, "_bulk"), data=data)
+
+    mappings = types.ModuleType("esprit.mappings")
+    mappings.EXACT = {}
+    mappings.for_type = lambda typename, *mapping: {typename : {}}
+    mappings.dynamic_templates = lambda templates: {"dynamic_templates" : templates}
+
+    esprit = types.ModuleType("esprit")
+    esprit.raw = raw
+    esprit.mappings = mappings
+    return {"esprit" : esprit, "esprit.raw" : raw, "esprit.mappings" : mappings}
+
+try:
+    import esprit
+except ImportError:
+    sys.modules.update(_fake_esprit())
+
+from doaj2oag import oag, oagr
+
+def _merge(target, changes):
+    for k, v in changes.iteritems():
+        if isinstance(v, dict) and isinstance(target.get(k), dict):
+            _merge(target[k], v)
+        else:
+            target[k] = v
+
+def _filter_source(source, fields):
+    # the subset of the source on the given dotted paths, as _source filtering returns
+    out = {}
+    for field in fields:
+        parts = field.split(".")
+        src, dst = source, out
+        for part in parts[:-1]:
+            if not isinstance(src.get(part), dict):
+                src = None
+                break
+            src = src[part]
+            dst = dst.setdefault(part, {})
+        if src is not None and parts[-1] in src:
+            dst[parts[-1]] = src[parts[-1]]
+    return out
+
+class StubESHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Enough of the ES 1.x document, _mget, _bulk and _search APIs for the job store and write-back"""
+    protocol_version = "HTTP/1.1"
+
+    def do_PUT(self):
+        index, type, id = self._parts()
+        with self.server.lock:
+            version = self.server.put(type, id, json.loads(self._body()))
+        self._respond(201, {"_index" : index, "_type" : type, "_id" : id, "_version" : version, "created" : True})
+
+    def do_POST(self):
+        index, type, endpoint = self._parts()
+        body = self._body()
+        with self.server.lock:
+            if endpoint == "_bulk":
+                self._respond(200, {"items" : self.server.bulk(type, body)})
+            elif endpoint == "_mget":
+                docs = []
+                for id in json.loads(body).get("ids", []):
+                    doc = self.server.docs.get((type, id))
+                    if doc is None:
+                        docs.append({"_type" : type, "_id" : id, "found" : False})
+                    else:
+                        docs.append({"_type" : type, "_id" : id, "found" : True, "_version" : doc["_version"], "_source" : doc["_source"]})
+                self._respond(200, {"docs" : docs})
+            elif endpoint == "_search":
+                q = json.loads(body)
+                self.server.searches.append(q)
+                self._respond(200, {"hits" : {"hits" : self.server.search(type, q)}})
+            else:
+                self._respond(404, {})
+
+    def _parts(self):
+        parts = [p for p in urlparse(self.path).path.split("/") if p != ""]
+        if len(parts) == 2 and parts[1].startswith("_"):
+            # an index wide endpoint, with no type
+            parts = [parts[0], None, parts[1]]
+        return (parts + [None, None, None])[:3]
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _respond(self, status, obj):
+        resp = json.dumps(obj)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(resp)))
+        self.end_headers()
+        self.wfile.write(resp)
+
+    def log_message(self, *args):
+        pass
+
+class StubESServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), StubESHandler)
+        self.docs = {}
+        self.searches = []
+        self.bulks = []
+        self.fail_ids = set()
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self):
+        return "http://127.0.0.1:" + str(self.server_address[1])
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def put(self, type, id, source):
+        version = self.docs.get((type, id), {}).get("_version", 0) + 1
+        self.docs[(type, id)] = {"_source" : source, "_version" : version}
+        return version
+
+    def bulk(self, type, body):
+        lines = [json.loads(l) for l in body.strip().split("\n")]
+        self.bulks.append(list(lines))
+        items = []
+        while len(lines) > 0:
+            action, meta = lines.pop(0).items()[0]
+            t, id = meta.get("_type", type), meta.get("_id")
+            doc = self.docs.get((t, id))
+            source = lines.pop(0) if action != "delete" else None
+            if id in self.fail_ids:
+                result = {"status" : 500, "error" : "stub failure"}
+            elif meta.get("_version") is not None and (doc is None or doc["_version"] != meta["_version"]):
+                result = {"status" : 409, "error" : "VersionConflictEngineException"}
+            elif action == "delete":
+                result = {"status" : 200 if self.docs.pop((t, id), None) is not None else 404}
+            elif action == "index":
+                result = {"status" : 201, "_version" : self.put(t, id, source)}
+            elif doc is None:
+                result = {"status" : 404, "error" : "DocumentMissingException"}
+            else:
+                updated = json.loads(json.dumps(doc["_source"]))
+                _merge(updated, source.get("doc", {}))
+                if source.get("detect_noop") and updated == doc["_source"]:
+                    result = {"status" : 200, "_version" : doc["_version"]}
+                else:
+                    result = {"status" : 200, "_version" : self.put(t, id, updated)}
+            result["_id"] = id
+            items.append({action : result})
+        return items
+
+    def search(self, type, q):
+        docs = [(id, doc["_source"]) for (t, id), doc in sorted(self.docs.items()) if t == type]
+        terms = q.get("query", {}).get("terms")
+        if terms is not None:
+            # only the article identifier lookup is needed here
+            wanted = set(terms.values()[0])
+            docs = [(id, d) for id, d in docs if len(wanted & set([i.get("id") for i in d.get("bibjson", {}).get("identifier", [])])) > 0]
+        start = q.get("from", 0)
+        docs = docs[start:start + q.get("size", 10)]
+        if "_source" in q:
+            docs = [(id, _filter_source(d, q["_source"])) for id, d in docs]
+        return [{"_type" : type, "_id" : id, "_source" : d} for id, d in docs]
+
+class FindingClient(object):
+    """Stands in for an OAGClient, finding a licence for each of the given identifiers which is due"""
+    def __init__(self, found):
+        self.found = found
+
+    def cycle(self, state, throttle=0, verbose=False):
+        due = state.get_due()
+        state.record_result({"results" : [{"identifier" : [{"id" : d, "type" : "doi"}], "license" : [{"title" : "CC BY"}]} for d in due if d in self.found]})
+        return state
+
+class ESTestCase(TestCase):
+
+    def setUp(self):
+        self.server = StubESServer()
+        self.dir = tempfile.mkdtemp()
+        self.saved = dict(oagr.config)
+        oagr.config.update({
+            "ELASTIC_SEARCH_HOST" : self.server.url(),
+            "ELASTIC_SEARCH_DB" : "doaj",
+            "DOI_INDEX" : False,
+            "OAG_ERROR_FILE" : os.path.join(self.dir, "oag_error.csv"),
+            "QUERY_CACHE_GENERATION_FILE" : os.path.join(self.dir, "query_cache.generation")
+        })
+
+    def tearDown(self):
+        oagr.config.clear()
+        oagr.config.update(self.saved)
+        self.server.stop()
+        shutil.rmtree(self.dir)
+
+class TestJobLeases(ESTestCase):
+
+    def setUp(self):
+        super(TestJobLeases, self).setUp()
+        self.ids = ["10.1234/" + str(i) for i in range(10)]
+        state = oag.RequestState(self.ids, start=datetime.now() - timedelta(seconds=10))
+        self.job = state.id
+        self._runner().save_job(state)
+
+    def _runner(self, found=None):
+        return oagr.JobRunner(None, client=FindingClient(found or []), verbose=False)
+
+    def _job(self):
+        return self.server.docs[("jobs", self.job)]
+
+    def _expire_lease(self):
+        self._job()["_source"]["lease_expires"] = (datetime.now() - timedelta(seconds=1)).strftime(oagr._timestamp_format)
+
+    def test_01_claim(self):
+        a, b = self._runner(), self._runner()
+        assert len(a.load_jobs([self.job], claim=True)) == 1
+        assert self._job()["_source"]["lease_owner"] == a.worker_id
+        # the lease keeps other runners off the job until it expires
+        assert b.load_jobs([self.job], claim=True) == []
+        self._expire_lease()
+        assert len(b.load_jobs([self.job], claim=True)) == 1
+        assert self._job()["_source"]["lease_owner"] == b.worker_id
+
+    def test_02_version_conflict(self):
+        a = self._runner()
+        a.load_jobs([self.job], claim=True)
+        # someone else writes to the job after we claimed it
+        self.server.put("jobs", self.job, self._job()["_source"])
+        self.assertRaises(oagr.LeaseLost, a._versioned, self.job, "update", {"doc" : {"status" : "active"}})
+
+    def test_03_race(self):
+        a = self._runner(found=self.ids[:3])
+        b = self._runner(found=self.ids[3:5])
+        state_a = a.load_job(self.job, claim=True)
+        a.client.cycle(state_a)
+
+        # a's lease lapses mid-cycle, and b claims the job, looks up and saves it
+        self._expire_lease()
+        state_b = b.load_job(self.job, claim=True)
+        b.cycle_state(state_b)
+
+        # a's save is refused, and leaves nothing behind to be replayed
+        a.save_job(state_a)
+        log_ids = self._job()["_source"]["log_ids"]
+        assert len(log_ids) == 1 and log_ids[0].endswith(b.worker_id)
+        assert [id for t, id in self.server.docs.keys() if t == "jobs_log"] == log_ids
+
+        # the job holds b's results, and none of a's
+        state = self._runner().load_job(self.job)
+        assert sorted(state.success.keys()) == sorted(self.ids[3:5])
+        assert len(state.pending) == 8
+
+    def test_04_renew(self):
+        a = self._runner(found=self.ids[:2])
+        a.lease_seconds = 60
+        state = a.load_job(self.job, claim=True)
+        expires = self._job()["_source"]["lease_expires"]
+        self._job()["_source"]["lease_expires"] = (datetime.now() + timedelta(seconds=1)).strftime(oagr._timestamp_format)
+        a.renew_leases([self.job])
+        assert self._job()["_source"]["lease_expires"] >= expires
+
+        # the renewal moved the version on, and the save still goes through on the new one
+        a.client.cycle(state)
+        a.save_job(state)
+        assert self._job()["_source"]["lease_owner"] is None
+        assert len(self._runner().load_job(self.job).success) == 2
+
+class FindingAsyncClient(oag.AsyncOAGClient):
+    """Finds a licence for every identifier, without going to the lookup service"""
+    def _query(self, batch, budget=None, observe=None):
+        return {"results" : [{"identifier" : [{"id" : d, "type" : "doi"}], "license" : [{"title" : "CC BY"}]} for d in batch]}
+
+class SlowFindingClient(FindingClient):
+    """Finds everything, taking a while about it, and records each identifier it looks up"""
+    def __init__(self, looked_up, lock):
+        super(SlowFindingClient, self).__init__([])
+        self.looked_up = looked_up
+        self.lock = lock
+
+    def cycle(self, state, throttle=0, verbose=False):
+        due = state.get_due()
+        with self.lock:
+            self.looked_up.extend(due)
+        time.sleep(0.4)
+        self.found = due
+        return super(SlowFindingClient, self).cycle(state, throttle, verbose)
+
+class TestSequentialRound(ESTestCase):
+
+    def test_01_no_job_claimed_twice(self):
+        start = datetime.now() - timedelta(seconds=10)
+        ids = ["10.1234/" + str(i) for i in range(8)]
+        saver = oagr.JobRunner(None, client=FindingClient([]), verbose=False)
+        for i in ids:
+            saver.save_job(oag.RequestState([i], start=start))
+
+        # two runners with leases shorter than it takes to work through every job
+        looked_up = []
+        lock = threading.Lock()
+        runners = [oagr.JobRunner(None, client=SlowFindingClient(looked_up, lock), verbose=False, lease_seconds=2) for i in range(2)]
+        jobs = lambda: [d["_source"] for (t, id), d in self.server.docs.items() if t == "jobs"]
+        def work(runner):
+            deadline = time.time() + 20
+            while time.time() < deadline and any([j["status"] != "finished" for j in jobs()]):
+                runner.run_round()
+        threads = [threading.Thread(target=work, args=(r,)) for r in runners]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        # every job was done, and none was looked up by both runners
+        assert all([j["status"] == "finished" for j in jobs()])
+        assert sorted(looked_up) == ids
+
+class TestMultiplexedRound(ESTestCase):
+
+    def test_01_chunks(self):
+        start = datetime.now() - timedelta(seconds=10)
+        saver = oagr.JobRunner(None, client=FindingClient([]), verbose=False)
+        for i in range(25):
+            saver.save_job(oag.RequestState(["10.1234/" + str(i)], start=start))
+
+        chunks = []
+        server = self.server
+        class RecordingRunner(oagr.JobRunner):
+            def cycle_states(self, states):
+                # the jobs claimed (and not yet released) when each chunk starts
+                claimed = len([d for (t, id), d in server.docs.items() if t == "jobs" and d["_source"].get("lease_owner") is not None])
+                chunks.append((len(states), claimed))
+                super(RecordingRunner, self).cycle_states(states)
+
+        client = FindingAsyncClient("http://localhost/lookup", concurrency=2)
+        runner = RecordingRunner(None, client=client, verbose=False, multiplex_size=10)
+        assert runner.run_round()
+        client.close()
+
+        # only the chunk about to start has been loaded and claimed
+        assert chunks == [(10, 10), (10, 10), (5, 5)]
+        assert all([d["_source"]["status"] == "finished" for (t, id), d in self.server.docs.items() if t == "jobs"])
+
+def _article(id, doi, licence):
+    return {"id" : id, "bibjson" : {"title" : "Article " + id, "identifier" : [{"type" : "doi", "id" : doi}, {"type" : "eissn", "id" : "1234-5678"}], "license" : licence}, "admin" : {"in_doaj" : True}}
+
+def _success(doi, title):
+    return {"identifier" : [{"id" : doi, "type" : "doi"}], "license" : [{"title" : title}]}
+
+class TestDOAJClosure(ESTestCase):
+
+    def setUp(self):
+        super(TestDOAJClosure, self).setUp()
+        self.server.put("article", "a1", _article("a1", "10.1234/changed", [{"title" : "old"}]))
+        self.server.put("article", "a2", _article("a2", "10.1234/unchanged", [{"title" : "CC BY"}]))
+        self.server.put("article", "a3", _article("a3", "10.1234/failed", [{"title" : "old"}]))
+        # two articles may carry the same DOI
+        self.server.put("article", "a4", _article("a4", "10.1234/changed", None))
+        self.server.fail_ids = set(["a3"])
+        self.batch = [_success(doi, "CC BY") for doi in ["10.1234/changed", "10.1234/unchanged", "10.1234/failed", "10.1234/unmatched"]]
+
+    def _updates(self):
+        # the article ids and bodies sent as updates
+        updates = []
+        for lines in self.server.bulks:
+            for meta, body in zip(lines[0::2], lines[1::2]):
+                updates.append((meta["update"]["_id"], meta["update"], body))
+        return updates
+
+    def test_01_bulk_lookup_and_write(self):
+        callback = oagr.doaj_closure()
+        callback(oag.ResultBatch(self.batch, [{"identifier" : {"id" : "10.1234/err", "type" : "doi"}, "error" : "not found"}]))
+        callback.close()
+
+        # every DOI is resolved with one terms query, fetching only the fields needed
+        assert len(self.server.searches) == 1
+        search = self.server.searches[0]
+        assert sorted(search["query"]["terms"]["bibjson.identifier.id.exact"]) == sorted([s["identifier"][0]["id"] for s in self.batch])
+        assert "bibjson.license" in search["_source"] and "bibjson.title" not in search["_source"]
+
+        # the matched articles are written in one bulk request, as partial updates of the licence alone
+        assert len(self.server.bulks) == 1
+        updates = self._updates()
+        assert sorted([u[0] for u in updates]) == ["a1", "a3", "a4"]
+        for id, meta, body in updates:
+            assert meta["_retry_on_conflict"] == 3
+            assert body["doc"] == {"bibjson" : {"license" : [{"title" : "CC BY"}]}}
+        for id in ["a1", "a4"]:
+            source = self.server.docs[("article", id)]["_source"]
+            assert source["bibjson"]["license"] == [{"title" : "CC BY"}]
+            # the rest of the article is left as it was
+            assert source["bibjson"]["title"] == "Article " + id and source["admin"] == {"in_doaj" : True}
+        # the failed item is left alone, and the errors logged
+        assert self.server.docs[("article", "a3")]["_source"]["bibjson"]["license"] == [{"title" : "old"}]
+        with open(oagr.config["OAG_ERROR_FILE"]) as f:
+            assert f.read().strip() == "10.1234/err,not found"
+        # the query cache is told the index has changed
+        assert os.path.exists(oagr.config["QUERY_CACHE_GENERATION_FILE"])
+
+    def test_02_skip_unchanged(self):
+        # the same licence, however its keys are ordered, is not written again
+        self.server.put("article", "a2", _article("a2", "10.1234/unchanged", [{"url" : "http://example.com", "title" : "CC BY"}]))
+        version = self.server.docs[("article", "a2")]["_version"]
+        callback = oagr.doaj_closure()
+        callback(oag.ResultBatch([{"identifier" : [{"id" : "10.1234/unchanged", "type" : "doi"}], "license" : [{"title" : "CC BY", "url" : "http://example.com"}]}], []))
+        callback.close()
+        assert self.server.bulks == []
+        assert self.server.docs[("article", "a2")]["_version"] == version
+
+    def test_03_detect_noop(self):
+        version = self.server.docs[("article", "a2")]["_version"]
+        callback = oagr.doaj_closure(skip_unchanged=False)
+        callback(oag.ResultBatch(self.batch, []))
+        callback.close()
+
+        # without the hash check the licence is not fetched, and every match is sent
+        assert "bibjson.license" not in self.server.searches[0]["_source"]
+        updates = self._updates()
+        assert sorted([u[0] for u in updates]) == ["a1", "a2", "a3", "a4"]
+        # but the index does not rewrite a document the update does not change
+        assert all([body["detect_noop"] for id, meta, body in updates])
+        assert self.server.docs[("article", "a2")]["_version"] == version
+        assert self.server.docs[("article", "a1")]["_version"] == version + 1
+
+class _BulkResponse(object):
+    def __init__(self, status_code, items):
+        self.status_code = status_code
+        self.items = items
+        self.text = json.dumps({"items" : items})
+
+    def json(self):
+        return {"items" : self.items}
+
+class TestBulkFailures(TestCase):
+
+    def test_01_count(self):
+        items = [
+            {"update" : {"_id" : "a1", "status" : 200}},
+            {"update" : {"_id" : "a2", "status" : 409, "error" : "VersionConflictEngineException"}},
+            {"update" : {"_id" : "a3", "status" : 404, "error" : "DocumentMissingException"}}
+        ]
+        assert oagr._bulk_failures(_BulkResponse(200, items), 3) == 2
+        # a request which fails outright fails every item in it
+        assert oagr._bulk_failures(_BulkResponse(500, []), 3) == 3
@@ -0,0 +1,69 @@
+from unittest import TestCase
+import os, shutil, tempfile, gzip, json, csv, zlib
+
+from doaj2oag import output, oag
+
+def _result(ident, title):
+    return {"identifier" : [{"id" : ident, "type" : "doi"}], "license" : [{"title" : title, "url" : "http://example.com/" + ident}]}
+
+def _error(ident):
+    return {"identifier" : {"id" : ident, "type" : "doi"}, "error" : "not found"}
+
+class TestResultWriter(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_01_csv_stays_open(self):
+        success_file = os.path.join(self.dir, "success.csv")
+        error_file = os.path.join(self.dir, "error.csv")
+        callback = output.ResultCallback(success_file, error_file)
+        for i in range(3):
+            state = oag.ResultBatch([_result("10.1234/" + str(i), u"CC BY \xe9")], [_error("10.1234/x" + str(i))])
+            callback(state)
+        handle = callback.success._raw
+        callback(oag.ResultBatch([_result("10.1234/3", None)], []))
+        assert callback.success._raw is handle
+        callback.close()
+
+        with open(success_file) as f:
+            rows = list(csv.reader(f))
+        assert rows[0] == ["10.1234/0", "CC BY \xc3\xa9"]
+        assert rows[3] == ["10.1234/3", ""]
+        with open(error_file) as f:
+            assert list(csv.reader(f))[2] == ["10.1234/x2", "not found"]
+
+    def test_02_jsonl_gzip_and_rotation(self):
+        path = os.path.join(self.dir, "success.jsonl.gz")
+        writer = output.ResultWriter(path, format="jsonl", compress=True, buffer_size=0, max_bytes=1)
+        writer.write([_result("10.1234/a", "CC BY")])
+        writer.write([_result("10.1234/b", "CC BY")])
+        writer.close()
+
+        # each write went past max_bytes, so each is in a rotated file of its own
+        files = sorted(os.listdir(self.dir))
+        assert len(files) == 2
+        assert all([f.startswith("success.") and f.endswith(".jsonl.gz") for f in files])
+        records = []
+        for name in files:
+            with gzip.open(os.path.join(self.dir, name)) as f:
+                records.extend([json.loads(line) for line in f])
+        # the whole licence is kept
+        assert sorted([r["license"][0]["url"] for r in records]) == ["http://example.com/10.1234/a", "http://example.com/10.1234/b"]
+
+    def test_03_callback_flushes(self):
+        success_file = os.path.join(self.dir, "success.jsonl.gz")
+        error_file = os.path.join(self.dir, "error.jsonl.gz")
+        callback = output.ResultCallback(success_file, error_file, format="jsonl", compress=True)
+        callback(oag.ResultBatch([_result("10.1234/a", "CC BY")], []))
+
+        # nothing is left in the buffer once the callback returns, even though the file is still open
+        with open(success_file, "rb") as f:
+            data = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(f.read())
+        assert json.loads(data)["identifier"][0]["id"] == "10.1234/a"
+        callback.close()
+        with gzip.open(success_file) as f:
+            assert len(f.readlines()) == 1
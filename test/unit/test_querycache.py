@@ -0,0 +1,47 @@
+from unittest import TestCase
+import os, shutil, tempfile, time
+
+from portality.lib import querycache
+
+class TestQueryCache(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.generation = os.path.join(self.dir, "generation")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_01_key_is_canonical(self):
+        a = querycache.QueryCache.key("Article", {"query" : {"match_all" : {}}, "size" : 10, "facets" : {"a" : 1, "b" : 2}})
+        b = querycache.QueryCache.key("Article", {"facets" : {"b" : 2, "a" : 1}, "size" : 10, "query" : {"match_all" : {}}})
+        assert a == b
+        assert a != querycache.QueryCache.key("Journal", {"query" : {"match_all" : {}}, "size" : 10, "facets" : {"a" : 1, "b" : 2}})
+
+    def test_02_lru_and_ttl(self):
+        cache = querycache.QueryCache(max_entries=2)
+        etag = cache.put("a", '{"hits" : 1}')
+        cache.put("b", '{"hits" : 2}')
+        assert cache.get("a") == ('{"hits" : 1}', etag)
+        # b is now the least recently used, so it makes way for c
+        cache.put("c", '{"hits" : 3}')
+        assert cache.get("b") is None
+        assert cache.get("a") is not None
+
+        cache = querycache.QueryCache(ttl=0)
+        cache.put("a", "{}")
+        assert cache.get("a") is None
+
+    def test_03_invalidate(self):
+        cache = querycache.QueryCache(generation_file=self.generation, check_every=0)
+        cache.put("a", "{}")
+        assert cache.get("a") is not None
+        # e.g. from oagr, in another process
+        querycache.invalidate(self.generation)
+        assert cache.get("a") is None
+
+        cache.put("a", "{}")
+        assert cache.get("a") is not None
+        time.sleep(0.01)
+        querycache.invalidate(self.generation)
+        assert cache.get("a") is None